@@ -0,0 +1,50 @@
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from pipelines.pagination import paginate_by_odometer
+
+ODOMETER_PARAMS = ('after', 'before', 'distance')
+
+
+class OdometerCursorPagination(BasePagination):
+    """
+    Постраничный вывод по курсору одометра (см. pipelines.pagination).
+    Включается параметрами after, before, distance или page_size,
+    без них список отдаётся целиком, как раньше.
+    """
+    odometer_field = 'odometr_data'
+    page_size = 50
+    max_page_size = 500
+
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        if not any(params.get(name) for name in ODOMETER_PARAMS + ('page_size',)):
+            return None
+        self.request = request
+        field = getattr(view, 'odometer_field', self.odometer_field)
+        self.page = paginate_by_odometer(queryset, field, params, self.get_page_size(request))
+        return self.page.rows
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get('page_size', self.page_size))
+        except ValueError:
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def get_link(self, name, cursor):
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        for param in ODOMETER_PARAMS:
+            url = remove_query_param(url, param)
+        return replace_query_param(url, name, cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_link('after', self.page.next_cursor),
+            'previous': self.get_link('before', self.page.previous_cursor),
+            'start': self.page.start,
+            'results': data,
+        })
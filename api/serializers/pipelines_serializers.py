@@ -2,8 +2,9 @@ from rest_framework import serializers
 
 from api.serializers.equipments_serializers import DepartmentSerializer
 from api.serializers.users_serializers import UserSerializer
-from pipelines.models import (Anomaly, Bend, ComplexPlan, Defect,
-                              DiagnosticDocument, Diagnostics, Hole, Node,
+from pipelines.models import (Anomaly, Bend, ComplexPlan,
+                              DiagnosticDocument, Diagnostics,
+                              DiagnosticStats, Hole, Node,
                               NodeState, Pipe, PipeDepartment, PipeDocument,
                               PipeLimit, Pipeline, PipeState, PlannedWork,
                               Repair, Tube, TubeUnit, TubeVersion,
@@ -94,15 +95,35 @@ class NodeStateSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class PipeStateChangeSerializer(serializers.Serializer):
+    """Элемент пакетного изменения состояний участков (id — участок)"""
+    id = serializers.IntegerField()
+    state_type = serializers.ChoiceField(choices=PipeState.STATE_CHOICES)
+    start_date = serializers.DateField()
+    end_date = serializers.DateField(required=False, allow_null=True, default=None)
+    description = serializers.CharField(required=False, allow_blank=True, default='')
+
+
+class NodeStateChangeSerializer(serializers.Serializer):
+    """Элемент пакетного изменения состояний узлов (id — узел)"""
+    id = serializers.IntegerField()
+    state_type = serializers.ChoiceField(choices=NodeState.NODE_STATES)
+    description = serializers.CharField(required=False, allow_blank=True, default='')
+
+
 class PipeLimitSerializer(serializers.ModelSerializer):
     class Meta:
         model = PipeLimit
         fields = [
+            'id',
+            'pipe',
             'pressure_limit',
             'limit_reason',
             'start_date',
-            'end_date'
+            'end_date',
+            'revision',
         ]
+        read_only_fields = ['id', 'pipe', 'revision']
 
 
 class TubeUnitSerializer(serializers.ModelSerializer):
@@ -188,9 +209,8 @@ class TubeSerializer(serializers.ModelSerializer):
         read_only_fields = ["id", "pipe_name"]
 
     def get_files(self, obj):
-        print(obj)
         """Возвращает файлы последней версии трубы"""
-        latest_version = obj.versions.order_by("-date").first()
+        latest_version = obj.latest_version
         if latest_version:
             # Получаем все документы последней версии
             tube_docs = latest_version.tube_docs.all()
@@ -200,8 +220,8 @@ class TubeSerializer(serializers.ModelSerializer):
     def to_representation(self, instance):
         """Добавляем данные из последней версии TubeVersion"""
         representation = super().to_representation(instance)
-        # Получаем последнюю версию
-        latest_version = instance.versions.order_by("-date").first()
+        # Последняя версия хранится в Tube.latest_version
+        latest_version = instance.latest_version
         if latest_version:
             # Обновляем representation данными из последней версии
             version_serializer = TubeVersionSerializer(latest_version)
@@ -245,6 +265,10 @@ class PipeSerializer(serializers.ModelSerializer):
         ]
 
     def get_departments(self, obj):
+        if hasattr(obj, 'department_links'):
+            department_links = obj.department_links
+        else:
+            department_links = obj.pipedepartment_set.select_related('department')
         return [
             {
                 'id': pd.department.id,
@@ -252,26 +276,27 @@ class PipeSerializer(serializers.ModelSerializer):
                 'start_point': pd.start_point,
                 'end_point': pd.end_point
             }
-            for pd in obj.pipedepartment_set.select_related('department')
+            for pd in department_links
         ]
 
     def get_pipeline(self, obj):
         return obj.pipeline.title
 
     def get_state(self, obj):
-        current_state = obj.current_state
-        if current_state:
-            return PipeStateSerializer(current_state).data
+        if obj.current_state:
+            return PipeStateSerializer(obj.current_state).data
         return None
 
     def get_limit(self, obj):
-        limit = obj.limits.filter(end_date__isnull=True).first()
-        if limit:
-            return PipeLimitSerializer(limit).data
+        if obj.current_limit:
+            return PipeLimitSerializer(obj.current_limit).data
         return None
 
     def get_last_repair(self, obj):
-        last_repair = obj.pipe_repairs.order_by('-start_date').first()
+        if hasattr(obj, 'repairs_by_date'):
+            last_repair = obj.repairs_by_date[0] if obj.repairs_by_date else None
+        else:
+            last_repair = obj.pipe_repairs.order_by('-start_date').first()
         if last_repair:
             return {
                 'id': last_repair.id,
@@ -281,7 +306,10 @@ class PipeSerializer(serializers.ModelSerializer):
         return None
 
     def get_last_diagnostics(self, obj):
-        last_diagnostics = obj.pipe_diagnostics.order_by('-start_date').first()
+        if hasattr(obj, 'diagnostics_by_date'):
+            last_diagnostics = obj.diagnostics_by_date[0] if obj.diagnostics_by_date else None
+        else:
+            last_diagnostics = obj.pipe_diagnostics.order_by('-start_date').first()
         if last_diagnostics:
             return {
                 'id': last_diagnostics.id,
@@ -291,15 +319,22 @@ class PipeSerializer(serializers.ModelSerializer):
         return None
 
     def get_files(self, obj):
-        selected_files = PipeDocument.objects.filter(pipe=obj)
+        if hasattr(obj, 'prefetched_files'):
+            selected_files = obj.prefetched_files
+        else:
+            selected_files = PipeDocument.objects.filter(pipe=obj)
         return PipeDocumentSerializer(selected_files, many=True, required=False).data
 
     def get_tube_count(self, obj):
         """Возвращает количество труб, связанных с участком"""
+        if hasattr(obj, 'tubes_total'):
+            return obj.tubes_total
         return obj.tubes.count()  # Используем related_name='tubes' из модели Tube
 
     def get_unit_count(self, obj):
         """Возвращает количество элементов, связанных с участком"""
+        if hasattr(obj, 'units_total'):
+            return obj.units_total
         # Считаем элементы через связанные трубы
         return TubeUnit.objects.filter(tube__tube__pipe=obj).count()
 
@@ -313,6 +348,8 @@ class DiagnosticsSerializer(serializers.ModelSerializer):
     bend_count = serializers.SerializerMethodField()
     anomaly_count = serializers.SerializerMethodField()
     defects_count = serializers.SerializerMethodField()
+    danger_levels = serializers.SerializerMethodField()
+    anomaly_natures = serializers.SerializerMethodField()
 
     class Meta:
         model = Diagnostics
@@ -330,32 +367,43 @@ class DiagnosticsSerializer(serializers.ModelSerializer):
             'bend_count',
             'anomaly_count',
             'defects_count',
+            'danger_levels',
+            'anomaly_natures',
         ]
 
     def get_pipeline(self, obj):
-        first_pipe = obj.pipes.first()
-        if first_pipe:
-            return first_pipe.pipeline.title
+        # .all() использует prefetch_related('pipes__pipeline'), порядок как у first()
+        pipes = list(obj.pipes.all())
+        if pipes:
+            return pipes[0].pipeline.title
         return None
 
     def get_files(self, obj):
-        selected_files = DiagnosticDocument.objects.filter(diagnostic=obj)
-        return DiagnosticDocumentSerializer(selected_files, many=True, required=False).data
+        return DiagnosticDocumentSerializer(
+            obj.diagnostic_docs.all(), many=True, required=False
+        ).data
 
+    # Количества хранятся в DiagnosticStats и пересчитываются при импорте
     def get_tube_count(self, obj):
-        return TubeVersion.objects.filter(diagnostics=obj).count()
+        return DiagnosticStats.of(obj).tube_count
 
     def get_unit_count(self, obj):
-        return TubeUnit.objects.filter(tube__diagnostics=obj).count()
+        return DiagnosticStats.of(obj).unit_count
 
     def get_bend_count(self, obj):
-        return Bend.objects.filter(tube__diagnostics=obj).count()
+        return DiagnosticStats.of(obj).bend_count
 
     def get_anomaly_count(self, obj):
-        return Anomaly.objects.filter(tube__diagnostics=obj).count()
+        return DiagnosticStats.of(obj).anomaly_count
 
     def get_defects_count(self, obj):
-        return Defect.objects.filter(tube__diagnostics=obj).count()
+        return DiagnosticStats.of(obj).defects_count
+
+    def get_danger_levels(self, obj):
+        return DiagnosticStats.of(obj).danger_levels
+
+    def get_anomaly_natures(self, obj):
+        return DiagnosticStats.of(obj).anomaly_natures
 
     def get_length(self, obj):
         pipes = obj.pipes.all()
@@ -402,19 +450,17 @@ class NodeSerializer(serializers.ModelSerializer):
         ]
 
     def get_state(self, obj):
-        latest_state = obj.current_states[0] if hasattr(obj, 'current_states') and obj.current_states else None
-        if latest_state:
-            return NodeStateSerializer(latest_state).data
+        if obj.current_state:
+            return NodeStateSerializer(obj.current_state).data
         return None
 
     def get_department(self, obj):
-        departments = obj.equipment.departments.all()
-        if not departments.exists():
+        # филиал хранится в узле (Node.root_department)
+        if not obj.root_department_id:
             return None
-        root_department = departments.order_by('tree_id', 'level').first().get_root()
         return {
-            'id': root_department.id,
-            'name': root_department.name
+            'id': obj.root_department_id,
+            'name': obj.root_department_name
         }
 
 
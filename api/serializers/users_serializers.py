@@ -20,5 +20,5 @@ class UserSerializer(serializers.ModelSerializer):
 
     def get_apps(self, obj):
         """Возвращает список приложений, за которые отвечает пользователь"""
-        apps = obj.apps.values_list('app_name', flat=True)
-        return list(apps) if apps else []
+        # .all() использует prefetch_related('apps'), если он был сделан
+        return [app.app_name for app in obj.apps.all()]
@@ -1,26 +1,41 @@
 import datetime as dt
+import math
 
-from django.db.models import Max, Min, Prefetch, Q
-from django.http import JsonResponse
+from django.db import transaction
+from django.db.models import (Count, Max, Min, OuterRef, Prefetch, Q, Subquery,
+                              prefetch_related_objects)
+from django.db.models.functions import Coalesce
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from rest_framework import generics, permissions, status, viewsets
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.parsers import FormParser, MultiPartParser
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from api.pagination import OdometerCursorPagination
 from api.serializers.pipelines_serializers import (
-    DiagnosticDocumentSerializer, DiagnosticsSerializer, NodeStateSerializer,
-    PipeDocumentSerializer, PipeLimitSerializer, PipelineSerializer,
-    PipeSerializer, PipeStateSerializer, TubeSerializer,
+    DiagnosticDocumentSerializer, DiagnosticsSerializer,
+    NodeStateChangeSerializer, NodeStateSerializer, PipeDocumentSerializer,
+    PipeLimitSerializer, PipelineSerializer, PipeSerializer,
+    PipeStateChangeSerializer, PipeStateSerializer, TubeSerializer,
     TubeVersionDocumentSerializer)
-from equipments.models import Department, Equipment
+from equipments.trees import department_tree
+from pipelines import calibration as ili_calibration
+from pipelines import geo as ili_geo
+from pipelines import history as ili_history
+from pipelines import intervals as pipeline_intervals
+from pipelines import tiles as ili_tiles
+from pipelines.alignment import none_if_nan
 from pipelines.models import (
-    DiagnosticDocument, Diagnostics, Node, NodeState, Pipe, PipeDepartment,
-    PipeDocument, PipeLimit, Pipeline, PipeState, Tube, TubeVersion,
+    DiagnosticDocument, Diagnostics, DiagnosticStats, Node, NodeState, Pipe,
+    PipeDepartment, PipeDocument, PipeLimit, Pipeline, PipeState, Repair,
+    SchemeRevision, SchemeSnapshot, Tube, TubeUnit, TubeVersion,
     TubeVersionDocument)
+from users.access import branch_scope
 
 
 class PipeDocumentViewSet(viewsets.ModelViewSet):
@@ -53,48 +68,299 @@ class DiagnosticDocumentViewSet(viewsets.ModelViewSet):
         serializer.save()
 
 
+# Наибольшая длина периода отчёта о длительности состояний, лет
+STATE_REPORT_YEARS = 5
+
 
 class PipelineViewSet(viewsets.ModelViewSet):
     serializer_class = PipelineSerializer
     permission_classes = [IsAuthenticated]
     queryset = Pipeline.objects.all().order_by('order')
 
+    def get_scope(self):
+        """id участков и узлов ветки пользователя (корень и все потомки), см. users.access"""
+        return branch_scope(self.request.user)
+
     def get_queryset(self):
-        user_department = self.request.user.department
-        if not user_department:
+        if not self.request.user.department_id:
             return Pipeline.objects.none()
-        # Дерево: корневой департамент и все потомки
-        root = user_department.get_root()
-        departments = root.get_descendants(include_self=True)
-        # Все Pipe, связанные с этими департаментами
-        pipe_ids = PipeDepartment.objects.filter(
-            department__in=departments
-        ).values_list('pipe_id', flat=True)
-        # Всё оборудование в этих департаментах
-        equipment_ids = Equipment.objects.filter(
-            departments__in=departments
-        ).values_list('id', flat=True)
+        scope = self.get_scope()
         return Pipeline.objects.filter(
-            Q(pipes__id__in=pipe_ids) |
-            Q(nodes__equipment__in=equipment_ids)
+            Q(pipes__id__in=scope.pipe_ids) |
+            Q(nodes__id__in=scope.node_ids)
         ).distinct().order_by('order').prefetch_related(
+            Prefetch('pipes', queryset=self.get_pipes_queryset(scope.pipe_ids)),
+            Prefetch('nodes', queryset=self.get_nodes_queryset(scope.node_ids)),
+        )
+
+    def list(self, request, *args, **kwargs):
+        """
+        Схема отдаётся из готового снимка корневого филиала.
+        Снимок сбрасывается сигналами при изменении данных схемы (pipelines.signals).
+        """
+        user_department = request.user.department
+        if not user_department:
+            return super().list(request, *args, **kwargs)
+        content = SchemeSnapshot.current(user_department.tree_id)
+        if content is None:
+            content = SchemeSnapshot.get(
+                department_tree.root(user_department.pk).pk,
+                lambda: JSONRenderer().render(super(PipelineViewSet, self).list(
+                    request, *args, **kwargs
+                ).data),
+            )
+        return HttpResponse(content, content_type='application/json')
+
+    @action(detail=False, methods=['get'], url_path='changes')
+    def changes(self, request):
+        """
+        Лента изменений схемы: состояния и ограничения участков, состояния узлов,
+        созданные или закрытые после ревизии ?since=. Без since возвращает
+        только текущий курсор.
+        """
+        cursor = SchemeRevision.current_value()
+        since = request.query_params.get('since')
+        if since is None:
+            return Response({'cursor': cursor})
+        try:
+            since = int(since)
+        except ValueError:
+            return Response({'error': 'Некорректный курсор'}, status=status.HTTP_400_BAD_REQUEST)
+        if not request.user.department:
+            return Response({'cursor': cursor, 'pipe_states': [], 'pipe_limits': [], 'node_states': []})
+        scope = self.get_scope()
+        revision_range = {'revision__gt': since, 'revision__lte': cursor}
+        return Response({
+            'cursor': cursor,
+            **self.serialize_states(
+                PipeState.objects.filter(pipe_id__in=scope.pipe_ids, **revision_range),
+                PipeLimit.objects.filter(pipe_id__in=scope.pipe_ids, **revision_range),
+                NodeState.objects.filter(
+                    Q(node_id__in=scope.node_ids) | Q(node__is_shared=True),
+                    **revision_range
+                ),
+                order='revision',
+            ),
+        })
+
+    @action(detail=False, methods=['get'], url_path='as-of')
+    def as_of(self, request):
+        """
+        Состояния и ограничения участков и состояния узлов схемы,
+        действовавшие на дату ?date=ГГГГ-ММ-ДД.
+        """
+        try:
+            date = dt.date.fromisoformat(request.query_params.get('date', ''))
+        except ValueError:
+            return Response({'error': 'Некорректная дата'}, status=status.HTTP_400_BAD_REQUEST)
+        if not request.user.department:
+            return Response({'date': date, 'pipe_states': [], 'pipe_limits': [], 'node_states': []})
+        scope = self.get_scope()
+        return Response({
+            'date': date,
+            **self.serialize_states(
+                *ili_history.network_state(date, scope.pipe_ids, scope.node_ids).values(),
+                order='start_date',
+            ),
+        })
+
+    @action(detail=False, methods=['get'], url_path='state-durations')
+    def state_durations(self, request):
+        """
+        Число дней в каждом состоянии по участкам и месяцам периода
+        [?from=, ?to=) (ГГГГ-ММ-ДД). По умолчанию ?from= — начало текущего
+        года, ?to= — начало года, следующего за ?from=.
+        """
+        today = dt.date.today()
+        params = request.query_params
+        try:
+            start = dt.date.fromisoformat(params['from']) if params.get('from') else dt.date(today.year, 1, 1)
+            end = dt.date.fromisoformat(params['to']) if params.get('to') else dt.date(start.year + 1, 1, 1)
+            # та же дата через STATE_REPORT_YEARS лет, для 29 февраля — 1 марта
+            limit = (
+                dt.date(start.year + STATE_REPORT_YEARS, start.month, 1)
+                + dt.timedelta(days=start.day - 1)
+            )
+        except ValueError:
+            return Response({'error': 'Некорректный период'}, status=status.HTTP_400_BAD_REQUEST)
+        if not start < end <= limit:
+            return Response(
+                {'error': f'Период должен быть не длиннее {STATE_REPORT_YEARS} лет'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not request.user.department:
+            return Response({'months': [], 'pipes': []})
+        months, durations = ili_history.state_durations(
+            self.get_scope().pipe_ids, start, end, today=today
+        )
+        return Response({
+            'months': [month.strftime('%Y-%m') for month in months],
+            'pipes': [
+                {'pipe': pipe_id, 'states': states}
+                for pipe_id, states in sorted(durations.items())
+            ],
+        })
+
+    @action(detail=True, methods=['get'], url_path='at')
+    def at(self, request, pk=None):
+        """
+        Объекты газопровода на километре ?km= или на отрезке [?from=, ?to=]:
+        участки, зоны филиалов, крановые узлы, технологические отверстия,
+        ремонты и запланированные работы (pipelines.intervals).
+        """
+        params = request.query_params
+        try:
+            if 'km' in params:
+                start = end = float(params['km'])
+            else:
+                start, end = float(params['from']), float(params['to'])
+        except (KeyError, ValueError):
+            return Response(
+                {'error': 'Укажите ?km= или ?from= и ?to='}, status=status.HTTP_400_BAD_REQUEST
+            )
+        if not (math.isfinite(start) and math.isfinite(end)) or start > end:
+            return Response({'error': 'Некорректный отрезок'}, status=status.HTTP_400_BAD_REQUEST)
+        pipeline = get_object_or_404(Pipeline, pk=pk)
+        found = pipeline_intervals.objects_at(pipeline.pk, start, end)
+        # только объекты ветки пользователя и пограничные узлы, как на схеме
+        scope = self.get_scope()
+        pipe_ids, node_ids = scope.pipe_ids, scope.node_ids
+        found['pipes'] = [item for item in found['pipes'] if item['id'] in pipe_ids]
+        found['nodes'] = [
+            item for item in found['nodes'] if item['id'] in node_ids or item['is_shared']
+        ]
+        shared_nodes = {item['id'] for item in found['nodes'] if item['is_shared']}
+        for kind in ('departments', 'holes', 'repairs', 'planned_works'):
+            found[kind] = [
+                item for item in found[kind]
+                if item['pipe_id'] in pipe_ids
+                or item.get('node_id') in node_ids
+                or item.get('node_id') in shared_nodes
+            ]
+        return Response({'pipeline': pipeline.pk, 'from': start, 'to': end, **found})
+
+    @action(detail=False, methods=['post'], url_path='state-changes')
+    def state_changes(self, request):
+        """
+        Изменение состояний нескольких участков и узлов в одной транзакции:
+        {"pipe_states": [{"id", "state_type", "start_date", "end_date", "description"}],
+         "node_states": [{"id", "state_type", "description"}]}.
+        Возвращает созданные состояния.
+        """
+        data = request.data if isinstance(request.data, dict) else {}
+        changes = {
+            'pipe_states': PipeStateChangeSerializer(data=data.get('pipe_states', []), many=True),
+            'node_states': NodeStateChangeSerializer(data=data.get('node_states', []), many=True),
+        }
+        errors = {key: changes[key].errors for key in changes if not changes[key].is_valid()}
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+        pipe_changes = changes['pipe_states'].validated_data
+        node_changes = changes['node_states'].validated_data
+        if not pipe_changes and not node_changes:
+            return Response({'error': 'Изменения не указаны'}, status=status.HTTP_400_BAD_REQUEST)
+        for key, model, label in [('pipe_states', Pipe, 'Участки'), ('node_states', Node, 'Узлы')]:
+            ids = [change['id'] for change in changes[key].validated_data]
+            if len(ids) != len(set(ids)):
+                return Response(
+                    {'error': f'{label} указаны повторно'}, status=status.HTTP_400_BAD_REQUEST
+                )
+            missing = set(ids) - set(model.objects.filter(pk__in=ids).values_list('pk', flat=True))
+            if missing:
+                return Response(
+                    {'error': f"{label} не найдены: {', '.join(map(str, sorted(missing)))}"},
+                    status=status.HTTP_404_NOT_FOUND
+                )
+        with transaction.atomic():
+            pipe_states = PipeState.bulk_change([
+                PipeState(
+                    pipe_id=change['id'],
+                    state_type=change['state_type'],
+                    start_date=change['start_date'],
+                    end_date=change['end_date'],
+                    description=change['description'],
+                    created_by=request.user,
+                )
+                for change in pipe_changes
+            ]) if pipe_changes else []
+            node_states = NodeState.bulk_change([
+                NodeState(
+                    node_id=change['id'],
+                    state_type=change['state_type'],
+                    description=change['description'],
+                    changed_by=request.user,
+                )
+                for change in node_changes
+            ]) if node_changes else []
+            # bulk_create не отправляет сигналы, сбрасывающие снимки схемы
+            SchemeSnapshot.invalidate()
+        prefetch_related_objects([request.user], 'apps')
+        return Response({
+            'pipe_states': PipeStateSerializer(pipe_states, many=True).data,
+            'node_states': NodeStateSerializer(node_states, many=True).data,
+        }, status=status.HTTP_201_CREATED)
+
+    def serialize_states(self, pipe_states, pipe_limits, node_states, order):
+        return {
+            'pipe_states': PipeStateSerializer(
+                pipe_states.select_related('created_by').prefetch_related('created_by__apps').order_by(order),
+                many=True
+            ).data,
+            'pipe_limits': PipeLimitSerializer(pipe_limits.order_by(order), many=True).data,
+            'node_states': NodeStateSerializer(
+                node_states.select_related('changed_by').prefetch_related('changed_by__apps').order_by(order),
+                many=True
+            ).data,
+        }
+
+    def get_pipes_queryset(self, pipe_ids):
+        """
+        Участки схемы со всеми данными для PipeSerializer.
+        Количество запросов не зависит от числа участков: счётчики считаются
+        группировкой в подзапросах, связанные объекты загружаются через Prefetch.
+        """
+        tubes_total = (
+            Tube.objects.filter(pipe=OuterRef('pk'))
+            .order_by().values('pipe')
+            .annotate(total=Count('pk')).values('total')
+        )
+        units_total = (
+            TubeUnit.objects.filter(tube__tube__pipe=OuterRef('pk'))
+            .order_by().values('tube__tube__pipe')
+            .annotate(total=Count('pk')).values('total')
+        )
+        return Pipe.objects.filter(id__in=pipe_ids).order_by('start_point').annotate(
+            tubes_total=Coalesce(Subquery(tubes_total), 0),
+            units_total=Coalesce(Subquery(units_total), 0),
+        ).select_related(
+            'current_state__created_by', 'current_limit'
+        ).prefetch_related(
+            'current_state__created_by__apps',
             Prefetch(
-                'pipes',
-                queryset=Pipe.objects.filter(id__in=pipe_ids)
-                .order_by('start_point').prefetch_related('states', 'limits')
+                'pipedepartment_set',
+                queryset=PipeDepartment.objects.select_related('department'),
+                to_attr='department_links'
             ),
             Prefetch(
-                'nodes',
-                queryset=Node.objects.filter(
-                    Q(equipment__in=equipment_ids) | Q(is_shared=True)
-                ).order_by('location_point').prefetch_related(
-                    Prefetch(
-                        'states',
-                        queryset=NodeState.objects.filter(end_date__isnull=True).order_by('-start_date'),
-                        to_attr='current_states'
-                    )
-                )
-            )
+                'pipe_repairs',
+                queryset=Repair.objects.order_by('-start_date'),
+                to_attr='repairs_by_date'
+            ),
+            Prefetch(
+                'pipe_diagnostics',
+                queryset=Diagnostics.objects.order_by('-start_date'),
+                to_attr='diagnostics_by_date'
+            ),
+            Prefetch('pipe_docs', to_attr='prefetched_files'),
+        )
+
+    def get_nodes_queryset(self, node_ids):
+        return Node.objects.filter(
+            Q(id__in=node_ids) | Q(is_shared=True)
+        ).order_by('location_point').select_related(
+            'equipment', 'current_state__changed_by'
+        ).prefetch_related(
+            'current_state__changed_by__apps',
         )
 
     def get_serializer_context(self):
@@ -207,14 +473,161 @@ class PipeViewSet(viewsets.ModelViewSet):
 
 
 class TubesViewSet(viewsets.ModelViewSet):
-    queryset = Tube.objects.all()
+    queryset = Tube.objects.select_related('pipe__pipeline', 'latest_version')
     serializer_class = TubeSerializer
     parser_classes = (MultiPartParser, FormParser)
     permission_classes = [IsAuthenticated]
+    pagination_class = OdometerCursorPagination
+    odometer_field = 'latest_version__odometr_data'
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        # pipes/<pipe_id>/tubes/ — трубы одного участка
+        if 'pipe_id' in self.kwargs:
+            queryset = queryset.filter(pipe_id=self.kwargs['pipe_id'])
+        return queryset
+
+
+def valid_latitude(value):
+    """float() принимает nan и inf, поэтому диапазон проверяется явно"""
+    return math.isfinite(value) and -90 <= value <= 90
+
+
+def valid_longitude(value):
+    return math.isfinite(value) and -180 <= value <= 180
 
 
 class DiagnosticsViewSet(viewsets.ModelViewSet):
-    queryset = Diagnostics.objects.all()
+    # количества берутся из DiagnosticStats, трубопровод и файлы — из prefetch
+    queryset = DiagnosticStats.with_version(
+        Diagnostics.objects.select_related('stats').prefetch_related(
+            'pipes__pipeline', 'diagnostic_docs'
+        )
+    )
     serializer_class = DiagnosticsSerializer
     parser_classes = (MultiPartParser, FormParser)
     permission_classes = [IsAuthenticated]
+
+    @action(detail=True, methods=['get'], url_path='tiles')
+    def tiles(self, request, pk=None):
+        """
+        Столбцы труб, аномалий и отводов в окне одометра ?from=&to= (м).
+        ?lod= — уровень детализации (0 — отдельные элементы, далее агрегаты
+        по ili_tiles.LOD_BUCKETS), по умолчанию подбирается по ширине окна.
+        """
+        diagnostics = get_object_or_404(Diagnostics, pk=pk)
+        params = request.query_params
+        try:
+            start = float(params.get('from', 0))
+            end = float(params['to']) if params.get('to') else None
+            lod = int(params['lod']) if params.get('lod') else None
+        except ValueError:
+            return Response({'error': 'Некорректные параметры окна'}, status=status.HTTP_400_BAD_REQUEST)
+        if end is None:
+            end = TubeVersion.objects.filter(
+                diagnostics=diagnostics
+            ).aggregate(end=Max('odometr_data'))['end'] or 0
+        # float() принимает nan и inf, которые не выводятся в JSON
+        if not (math.isfinite(start) and math.isfinite(end)):
+            return Response({'error': 'Некорректные параметры окна'}, status=status.HTTP_400_BAD_REQUEST)
+        if lod is None:
+            lod = ili_tiles.choose_lod(start, end)
+        if not 0 <= lod < len(ili_tiles.LOD_BUCKETS) or end < start:
+            return Response({'error': 'Некорректные параметры окна'}, status=status.HTTP_400_BAD_REQUEST)
+        if lod == 0 and end - start > ili_tiles.RAW_WINDOW:
+            return Response(
+                {'error': f'Окно уровня 0 не больше {ili_tiles.RAW_WINDOW} м'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response({
+            'diagnostic': diagnostics.id,
+            'from': start,
+            'to': end,
+            'lod': lod,
+            'bucket': ili_tiles.LOD_BUCKETS[lod],
+            **ili_tiles.window(diagnostics.id, start, end, lod),
+        })
+
+    @action(detail=True, methods=['get'], url_path='kilometres')
+    def kilometres(self, request, pk=None):
+        """
+        Привязка ВТД к километражу газопровода (pipelines.calibration):
+        узлы преобразования одометра и километраж аномалий.
+        """
+        diagnostics = get_object_or_404(Diagnostics, pk=pk)
+        try:
+            calibration = ili_calibration.get_calibration(diagnostics.id)
+        except ValueError as error:
+            return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+        ids, km = ili_calibration.anomaly_kilometres(calibration)
+        return Response({
+            'diagnostic': diagnostics.id,
+            'reference_count': calibration.reference_count,
+            'odometer': calibration.odometer,
+            'kilometres': calibration.kilometres,
+            'anomalies': {'id': ids.tolist(), 'km': none_if_nan(km)},
+        })
+
+    @action(detail=True, methods=['get'], url_path='bends-nearest')
+    def bends_nearest(self, request, pk=None):
+        """
+        Ближайшие к точке ?lat=&lon= отводы ВТД (?k=, по умолчанию 10)
+        по возрастанию расстояния в метрах (pipelines.geo).
+        """
+        params = request.query_params
+        try:
+            latitude, longitude = float(params['lat']), float(params['lon'])
+            k = int(params.get('k', 10))
+        except (KeyError, ValueError):
+            return Response(
+                {'error': 'Укажите ?lat= и ?lon=, ?k= — целое число'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if k < 1:
+            return Response({'error': 'k должно быть больше 0'}, status=status.HTTP_400_BAD_REQUEST)
+        if not (valid_latitude(latitude) and valid_longitude(longitude)):
+            return Response(
+                {'error': 'Широта от -90 до 90, долгота от -180 до 180'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        diagnostics = get_object_or_404(Diagnostics, pk=pk)
+        index = ili_geo.get_index(diagnostics.id)
+        indices, distances = index.nearest(latitude, longitude, min(k, ili_geo.MAX_NEAREST))
+        return Response({
+            'diagnostic': diagnostics.id,
+            'bends': index.rows_at(indices, distances),
+        })
+
+    @action(detail=True, methods=['get'], url_path='bends-bbox')
+    def bends_bbox(self, request, pk=None):
+        """
+        Отводы ВТД в прямоугольнике ?south=&west=&north=&east= (градусы)
+        по порядку одометра, не более MAX_BBOX_RESULTS (pipelines.geo).
+        """
+        params = request.query_params
+        try:
+            south, west, north, east = (
+                float(params[name]) for name in ('south', 'west', 'north', 'east')
+            )
+        except (KeyError, ValueError):
+            return Response(
+                {'error': 'Укажите ?south=, ?west=, ?north= и ?east='},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if (
+            not all(valid_latitude(value) for value in (south, north))
+            or not all(valid_longitude(value) for value in (west, east))
+            or south > north or west > east
+        ):
+            return Response(
+                {'error': 'Некорректный прямоугольник'}, status=status.HTTP_400_BAD_REQUEST
+            )
+        diagnostics = get_object_or_404(Diagnostics, pk=pk)
+        index = ili_geo.get_index(diagnostics.id)
+        indices = index.within(south, west, north, east)
+        return Response({
+            'diagnostic': diagnostics.id,
+            'count': len(indices),
+            'truncated': len(indices) > ili_geo.MAX_BBOX_RESULTS,
+            'bends': index.rows_at(indices[:ili_geo.MAX_BBOX_RESULTS]),
+        })
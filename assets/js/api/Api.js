@@ -364,6 +364,14 @@ export default class Api {
     }).then((response) => response.json());
   }
 
+  // лента изменений схемы после курсора since (без since - только текущий курсор)
+  getPipelineChanges(since) {
+    const query = since === undefined ? '' : `?since=${since}`;
+    return fetch(`${this._baseUrl}/pipelines/changes/${query}`, {
+      headers: this._headers,
+    }).then(this._checkResponse);
+  }
+
   changePipeState(stateData) {
     return fetch(`${this._baseUrl}/pipe-states/`, {
       method: 'POST',
@@ -80,6 +80,45 @@ const pipelineScheme = new PipelineVisualizer(
   {}
 );
 
+// данные схемы в памяти и курсор ленты изменений
+let pipelinesData = [];
+let changesCursor;
+
+// текущее состояние/ограничение объекта: открытая запись заменяет текущую,
+// закрытая запись сбрасывает текущую, если это она
+function applyCurrentRecord(item, key, record) {
+  if (!item) return;
+  if (!record.end_date) {
+    item[key] = record;
+  } else if (item[key] && item[key].id === record.id) {
+    item[key] = null;
+  }
+}
+
+function applySchemeChanges(changes) {
+  const pipes = new Map();
+  const nodes = new Map();
+  pipelinesData.forEach((pipeline) => {
+    pipeline.pipes.forEach((pipe) => pipes.set(pipe.id, pipe));
+    pipeline.nodes.forEach((node) => nodes.set(node.id, node));
+  });
+  changes.pipe_states.forEach((state) => applyCurrentRecord(pipes.get(state.pipe), 'state', state));
+  changes.pipe_limits.forEach((limit) => applyCurrentRecord(pipes.get(limit.pipe), 'limit', limit));
+  changes.node_states.forEach((state) => applyCurrentRecord(nodes.get(state.node), 'state', state));
+  changesCursor = changes.cursor;
+}
+
+// обновление схемы только изменёнными состояниями вместо полной перезагрузки
+function refreshScheme() {
+  return api
+    .getPipelineChanges(changesCursor)
+    .then((changes) => {
+      applySchemeChanges(changes);
+      pipelineScheme.render(pipelinesData);
+    })
+    .catch((error) => console.error('Error refreshing pipeline:', error));
+}
+
 function submitFormLimit(data) {
   const selected = pipelineScheme.getSelectedElement();
   if (!selected) {
@@ -95,10 +134,7 @@ function submitFormLimit(data) {
   api
     .editPipeLimit(newLimit)
     .then(() => {
-      api
-        .getPipelines()
-        .then((pipelines) => pipelineScheme.render(pipelines))
-        .catch((error) => console.error('Error refreshing pipeline:', error));
+      refreshScheme();
       popupWithFormPipeLimit.close();
     })
     .catch((err) => {
@@ -121,10 +157,7 @@ function submitFormLimitEnd(data) {
   api
     .endPipeLimit(endLimit)
     .then(() => {
-      api
-        .getPipelines()
-        .then((pipelines) => pipelineScheme.render(pipelines))
-        .catch((error) => console.error('Error refreshing pipeline:', error));
+      refreshScheme();
       popupWithFormPipeLimitEnd.close();
     })
     .catch((err) => {
@@ -150,10 +183,7 @@ function submitFormChangeState(data) {
     api
       .changePipeState(newState)
       .then(() => {
-        api
-          .getPipelines()
-          .then((pipelines) => pipelineScheme.render(pipelines))
-          .catch((error) => console.error('Error refreshing pipeline:', error));
+        refreshScheme();
         popupWithFormPipeChangeState.close();
       })
       .catch((err) => {
@@ -170,10 +200,7 @@ function submitFormChangeState(data) {
     api
       .changeNodeState(newState)
       .then(() => {
-        api
-          .getPipelines()
-          .then((pipelines) => pipelineScheme.render(pipelines))
-          .catch((error) => console.error('Error refreshing pipeline:', error));
+        refreshScheme();
         popupWithFormNodeChangeState.close();
       })
       .catch((err) => {
@@ -191,9 +218,17 @@ popupWithFormNodeChangeState.setEventListeners();
 popupWithFormPipeLimit.setEventListeners();
 popupWithFormPipeLimitEnd.setEventListeners();
 
-Promise.all([initUser(), api.getPipelines()])
+// курсор берётся до загрузки схемы, чтобы не пропустить изменения между запросами
+const loadScheme = () =>
+  api.getPipelineChanges().then(({ cursor }) => {
+    changesCursor = cursor;
+    return api.getPipelines();
+  });
+
+Promise.all([initUser(), loadScheme()])
   .then(([userData, pipelines]) => {
-    pipelineScheme.render(pipelines);
+    pipelinesData = pipelines;
+    pipelineScheme.render(pipelinesData);
   })
   .catch((err) => {
     console.log(err);
@@ -5,3 +5,7 @@ class LocationsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'equipments'
     verbose_name = 'Модуль "Оборудование"'
+
+    def ready(self):
+        # сброс деревьев в памяти при изменении подразделений и оборудования
+        import equipments.trees
@@ -103,3 +103,23 @@ class Equipment(MPTTModel):
 
     def __str__(self) -> str:
         return self.name
+
+
+class CacheVersion(models.Model):
+    """Версия данных, которые процессы держат в памяти (equipments.versions)"""
+    key = models.CharField(
+        verbose_name='Ключ',
+        max_length=100,
+        unique=True
+    )
+    token = models.CharField(
+        verbose_name='Версия',
+        max_length=32
+    )
+
+    class Meta:
+        verbose_name = 'Версия кэша'
+        verbose_name_plural = 'Версии кэша'
+
+    def __str__(self) -> str:
+        return f'{self.key}: {self.token}'
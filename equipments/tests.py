@@ -1,3 +1,78 @@
 from django.test import TestCase
 
-# Create your tests here.
+from equipments import versions
+from equipments.models import CacheVersion, Department
+from equipments.trees import department_tree
+
+
+class DepartmentTreeTest(TestCase):
+    """Дерево подразделений в памяти процесса"""
+
+    def setUp(self):
+        self.root = Department.objects.create(name='ООО "Газпром трансгаз Югорск"')
+        self.ks = Department.objects.create(name='Ново-Уренгойское ЛПУМГ', parent=self.root)
+        self.other = Department.objects.create(name='Пангодинское ЛПУМГ', parent=self.root)
+        self.service = Department.objects.create(name='Служба ЛЭС', parent=self.ks)
+        self.second_root = Department.objects.create(name='Филиал')
+
+    def test_lookups_without_queries(self):
+        department_tree.get(self.root.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(department_tree.root(self.service.pk), self.root)
+            self.assertEqual(
+                department_tree.descendant_ids(self.ks.pk, include_self=True),
+                [self.ks.pk, self.service.pk]
+            )
+            self.assertEqual(
+                department_tree.root_descendant_ids(self.service.pk),
+                [self.root.pk, self.ks.pk, self.service.pk, self.other.pk]
+            )
+            self.assertEqual(department_tree.ancestors(self.service.pk), [self.root, self.ks])
+            self.assertEqual(department_tree.first_at_level(self.service.pk, 1), self.ks)
+            self.assertIsNone(department_tree.first_at_level(self.second_root.pk, 1))
+            self.assertEqual(
+                department_tree.path_label(self.service.pk),
+                'ООО "Газпром трансгаз Югорск" - Ново-Уренгойское ЛПУМГ - Служба ЛЭС'
+            )
+        with self.assertRaises(Department.DoesNotExist):
+            department_tree.get(0)
+
+    def test_matches_mptt(self):
+        for department in Department.objects.all():
+            self.assertEqual(department_tree.root(department.pk), department.get_root())
+            self.assertEqual(
+                department_tree.descendants(department.pk), list(department.get_descendants())
+            )
+            self.assertEqual(
+                department_tree.ancestors(department.pk, include_self=True),
+                list(department.get_ancestors(include_self=True))
+            )
+
+    def test_invalidated_on_save_move_and_delete(self):
+        self.assertEqual(department_tree.root(self.service.pk), self.root)
+        self.service.move_to(self.second_root)
+        self.assertEqual(department_tree.root(self.service.pk), self.second_root)
+        self.ks.refresh_from_db()
+        self.ks.name = 'Ямбургское ЛПУМГ'
+        self.ks.save()
+        self.assertEqual(department_tree.get(self.ks.pk).name, 'Ямбургское ЛПУМГ')
+        self.other.delete()
+        self.assertEqual(department_tree.descendant_ids(self.root.pk), [self.ks.pk])
+
+    def test_version_shared_through_db(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ks.refresh_from_db()
+            self.ks.name = 'Ямбургское ЛПУМГ'
+            self.ks.save()
+            # до коммита версия в БД прежняя, свой процесс видит изменение сразу
+            self.assertFalse(CacheVersion.objects.filter(key=department_tree.version_key).exists())
+            self.assertEqual(department_tree.get(self.ks.pk).name, 'Ямбургское ЛПУМГ')
+        token = CacheVersion.objects.get(key=department_tree.version_key).token
+        self.assertEqual(versions.current(department_tree.version_key)[0], token)
+        self.assertEqual(department_tree.get(self.ks.pk).name, 'Ямбургское ЛПУМГ')
+        # изменение в другом процессе: данные и версия в БД без сигналов
+        Department.objects.filter(pk=self.ks.pk).update(name='Пуровское ЛПУМГ')
+        CacheVersion.objects.filter(key=department_tree.version_key).update(token='other')
+        self.assertEqual(department_tree.get(self.ks.pk).name, 'Ямбургское ЛПУМГ')
+        versions.reset()
+        self.assertEqual(department_tree.get(self.ks.pk).name, 'Пуровское ЛПУМГ')
@@ -0,0 +1,111 @@
+"""
+Деревья подразделений и оборудования в памяти процесса.
+
+Деревья небольшие и меняются редко, а корень, потомки и предки нужны почти
+в каждом запросе. CachedTree загружает всё дерево одним запросом и отвечает
+на эти вопросы без обращения к БД. Актуальность проверяется по версии
+в БД (equipments.versions): при сохранении, перемещении или удалении узла
+версия меняется (сигналы ниже) и дерево перечитывается при следующем
+обращении, в том числе в других процессах.
+"""
+import copy
+
+from django.db.models.signals import post_delete, post_save
+from mptt.signals import node_moved
+
+from equipments import versions
+from equipments.models import Department, Equipment
+
+
+class CachedTree:
+    def __init__(self, model):
+        self.model = model
+        self.version_key = f'tree_version:{model._meta.label_lower}'
+        self.version = None
+        # узлы по id и позиции узлов в списке своего дерева (порядок lft)
+        self.state = ({}, {})
+
+    def invalidate(self, **kwargs):
+        """Меняет версию; сигнатура позволяет подключать метод к сигналам"""
+        versions.bump(self.version_key)
+        self.version = None
+
+    def load(self):
+        version = versions.current(self.version_key)
+        if version != self.version:
+            nodes, positions, trees = {}, {}, {}
+            for node in self.model.objects.order_by('tree_id', 'lft'):
+                tree = trees.setdefault(node.tree_id, [])
+                nodes[node.pk] = node
+                positions[node.pk] = (tree, len(tree))
+                tree.append(node)
+            self.state = (nodes, positions)
+            self.version = version
+        return self.state
+
+    def position(self, pk):
+        """Узлы по id, список узлов дерева и позиция узла в нём (из одной загрузки)"""
+        nodes, positions = self.load()
+        if pk not in positions:
+            # узел мог появиться в другом процессе без смены версии в локальном кэше
+            self.version = None
+            nodes, positions = self.load()
+            if pk not in positions:
+                raise self.model.DoesNotExist(f'{self.model._meta.object_name} id={pk} не найден')
+        return (nodes, *positions[pk])
+
+    def get(self, pk):
+        _, tree, index = self.position(pk)
+        # копия, чтобы изменения экземпляра не попали в общее дерево
+        return copy.copy(tree[index])
+
+    def root(self, pk):
+        _, tree, _ = self.position(pk)
+        return copy.copy(tree[0])
+
+    def descendants(self, pk, include_self=False):
+        """Потомки в порядке дерева; поддерево занимает непрерывный отрезок списка"""
+        _, tree, index = self.position(pk)
+        node = tree[index]
+        size = (node.rght - node.lft + 1) // 2
+        return [copy.copy(item) for item in tree[index + (0 if include_self else 1):index + size]]
+
+    def descendant_ids(self, pk, include_self=False):
+        _, tree, index = self.position(pk)
+        node = tree[index]
+        size = (node.rght - node.lft + 1) // 2
+        return [item.pk for item in tree[index + (0 if include_self else 1):index + size]]
+
+    def root_descendant_ids(self, pk):
+        """id всех узлов дерева, к которому относится узел (корень и потомки)"""
+        _, tree, _ = self.position(pk)
+        return [item.pk for item in tree]
+
+    def ancestors(self, pk, include_self=False):
+        """Предки от корня"""
+        nodes, tree, index = self.position(pk)
+        node = tree[index]
+        path = [node] if include_self else []
+        while node.parent_id is not None:
+            node = nodes[node.parent_id]
+            path.append(node)
+        return [copy.copy(item) for item in reversed(path)]
+
+    def first_at_level(self, pk, level):
+        """Первый в порядке дерева узел уровня level в дереве узла (КС для level=1)"""
+        _, tree, _ = self.position(pk)
+        node = next((item for item in tree if item.level == level), None)
+        return copy.copy(node) if node else None
+
+    def path_label(self, pk, separator=' - '):
+        """Названия узлов от корня до узла"""
+        return separator.join(item.name for item in self.ancestors(pk, include_self=True))
+
+
+department_tree = CachedTree(Department)
+equipment_tree = CachedTree(Equipment)
+
+for tree in (department_tree, equipment_tree):
+    post_save.connect(tree.invalidate, sender=tree.model, weak=False)
+    post_delete.connect(tree.invalidate, sender=tree.model, weak=False)
+    node_moved.connect(tree.invalidate, sender=tree.model, weak=False)
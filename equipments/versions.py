@@ -0,0 +1,105 @@
+"""
+Версии данных, которые процессы держат в памяти: деревья подразделений
+и оборудования, области видимости пользователей, подписи объектов.
+
+Версия хранится в БД (CacheVersion) и видна всем процессам — веб-серверу,
+import_ili, load_pipeline_data. Новая версия записывается после коммита
+транзакции (transaction.on_commit): читатель, собравший данные до коммита,
+держит их под прежней версией и пересоберёт, когда версия сменится. Свой
+процесс узнаёт об изменении сразу, по локальному счётчику изменений.
+
+Версии всех ключей читаются одним запросом и запоминаются до начала
+следующего HTTP-запроса, но не дольше SNAPSHOT_TTL.
+
+Сохранённые в БД данные отдельных объектов (значения фильтров, статистика
+и агрегаты ВТД) версионируются ключами object_key(): такие данные хранят
+версию, прочитанную до сборки, и сверяются с ней тем же запросом, которым
+читаются (stored). В снимок процесса эти ключи не входят.
+"""
+import time
+import uuid
+
+from django.core.signals import request_started
+from django.db import transaction
+from django.db.models import Subquery, Value
+from django.db.models.functions import Coalesce
+
+from equipments.models import CacheVersion
+
+# Вне HTTP-запросов (команды, фоновые процессы) версии перечитываются не реже, с
+SNAPSHOT_TTL = 5
+
+_snapshot = {'tokens': None, 'loaded_at': 0.0}
+# Ключи версий объектов, в снимок процесса не читаются
+OBJECT_PREFIX = 'object:'
+
+# Изменения в этом процессе: {ключ: счётчик}
+_changes = {}
+
+
+def reset(**kwargs):
+    """Забывает прочитанные версии; сигнатура позволяет подключать функцию к сигналам"""
+    _snapshot['tokens'] = None
+
+
+def stored_tokens():
+    if (
+        _snapshot['tokens'] is None
+        or time.monotonic() - _snapshot['loaded_at'] > SNAPSHOT_TTL
+    ):
+        _snapshot['tokens'] = dict(
+            CacheVersion.objects.exclude(key__startswith=OBJECT_PREFIX).values_list('key', 'token')
+        )
+        _snapshot['loaded_at'] = time.monotonic()
+    return _snapshot['tokens']
+
+
+def current(key):
+    """Версия ключа: версия в БД и число изменений в этом процессе"""
+    return stored_tokens().get(key, ''), _changes.get(key, 0)
+
+
+def object_key(name, *ids):
+    """Ключ версии сохранённых в БД данных объекта, например object_key('tiles', 5)"""
+    return ':'.join([OBJECT_PREFIX + name, *map(str, ids)])
+
+
+def write(keys, token=None):
+    token = token or uuid.uuid4().hex
+    CacheVersion.objects.filter(key__in=keys).update(token=token)
+    # новые ключи; записанные параллельно уже получили свою новую версию
+    CacheVersion.objects.bulk_create(
+        [CacheVersion(key=key, token=token) for key in keys], ignore_conflicts=True
+    )
+    reset()
+
+
+def bump(key):
+    """Меняет версию: в этом процессе сразу, для остальных — после коммита"""
+    _changes[key] = _changes.get(key, 0) + 1
+    bump_stored([key])
+
+
+def bump_stored(keys, token=None):
+    """
+    Меняет версии ключей объектов в БД после коммита; token — новая версия,
+    если она уже записана вместе с данными, собранными в этой транзакции.
+    """
+    keys = list(dict.fromkeys(keys))
+    if keys:
+        transaction.on_commit(lambda: write(keys, token))
+
+
+def read(key):
+    """Версия ключа в БД, прочитанная в обход снимка (до сборки сохраняемых данных)"""
+    return CacheVersion.objects.filter(key=key).values_list('token', flat=True).first() or ''
+
+
+def stored(key):
+    """Версия ключа в БД как выражение запроса, '' — ключ не менялся"""
+    return Coalesce(
+        Subquery(CacheVersion.objects.filter(key=key).values('token')[:1]), Value('')
+    )
+
+
+request_started.connect(reset, weak=False)
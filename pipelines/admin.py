@@ -24,10 +24,7 @@ class StateFilter(admin.SimpleListFilter):
 
     def queryset(self, request, queryset):
         if self.value():
-            return queryset.filter(
-                states__state_type=self.value(),
-                states__end_date__isnull=True
-            ).distinct()
+            return queryset.filter(current_state__state_type=self.value())
         return queryset
 
 
@@ -56,6 +53,9 @@ class PipeInline(admin.TabularInline):
     fields = ('diameter', 'start_point', 'end_point', 'current_state_display')
     readonly_fields = ('current_state_display',)
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('current_state')
+
     def current_state_display(self, obj):
         state = obj.current_state
         if state:
@@ -139,6 +139,7 @@ class PipeAdmin(admin.ModelAdmin):
         'start_point', 'end_point', 'current_state_display'
     )
     list_filter = ('pipeline', 'departments', StateFilter)
+    list_select_related = ('pipeline', 'current_state')
     search_fields = ('pipeline__title', 'departments__name')
     inlines = [PipeStateInline, PipeLimitInline, PipeDepartmentInline, PipeDocumentInline]
 
@@ -383,17 +384,15 @@ class TubeAdmin(admin.ModelAdmin):
     inlines = [TubeVersionInline]
     ordering = ("pipe", "tube_num")
     autocomplete_fields = ("pipe",)
-
-    def latest_version(self, obj):
-        return obj.versions.order_by("-date").first()
+    list_select_related = ("pipe__pipeline", "latest_version")
 
     def latest_version_date(self, obj):
-        version = self.latest_version(obj)
+        version = obj.latest_version
         return version.date if version else None
     latest_version_date.short_description = "Дата версии"
 
     def latest_version_length(self, obj):
-        version = self.latest_version(obj)
+        version = obj.latest_version
         return version.tube_length if version else None
     latest_version_length.short_description = "Длина (текущая)"
 
@@ -0,0 +1,273 @@
+"""
+Сопоставление двух прогонов ВТД и скорости роста аномалий.
+
+1. Кольцевые швы. Опорные пары — версии одной и той же трубы (Tube) в обоих
+   прогонах с совпадающей длиной, при их отсутствии — начала и концы прогонов.
+   Смещение одометра между опорами интерполируется, после чего каждый шов
+   последующего прогона сопоставляется с ближайшим швом предыдущего
+   (слияние отсортированных массивов через searchsorted) с проверкой длины
+   трубы. Пары, нарушающие порядок швов, отбрасываются по наибольшей
+   возрастающей подпоследовательности. Найденные пары служат опорами
+   следующего, более точного прохода; проходы повторяются, пока число пар
+   растёт, так учитывается и накопленная погрешность одометра.
+2. Аномалии. Внутри сопоставленных труб аномалии одного характера
+   сопоставляются по расстоянию от кольцевого шва и ориентации.
+3. Скорость роста — разница глубины и длины, делённая на интервал между ВТД.
+
+Все шаги выполняются над массивами NumPy, результаты сохраняются пакетной
+вставкой (pipelines.db.insert_rows).
+"""
+from bisect import bisect_left
+
+import numpy as np
+from django.db import transaction
+
+from pipelines.db import insert_rows
+from pipelines.models import (Anomaly, AnomalyMatch, RunAlignment, TubeMatch,
+                              TubeVersion)
+
+# Допуски сопоставления швов после учёта смещения, м: первый проход и уточняющие
+WELD_TOLERANCE = 2.0
+REFINE_TOLERANCE = 0.5
+# Уточняющие проходы повторяются, пока растёт число пар
+MAX_PASSES = 50
+# Допустимая разница длины трубы между прогонами, м
+LENGTH_TOLERANCE = 0.1
+# Допуски сопоставления аномалий: по оси, м, и по окружности, мин (12 ч = 720 мин)
+AXIAL_TOLERANCE = 0.3
+CLOCK_TOLERANCE = 60
+# Разнесение ключей поиска аномалий разных труб, м (больше длины любой трубы)
+TUBE_KEY_SPAN = 1e4
+
+
+def longest_increasing(values):
+    """Индексы наибольшей строго возрастающей подпоследовательности, O(n log n)"""
+    tails, tail_index = [], []
+    previous = np.full(len(values), -1)
+    for i, value in enumerate(values.tolist()):
+        position = bisect_left(tails, value)
+        if position == len(tails):
+            tails.append(value)
+            tail_index.append(i)
+        else:
+            tails[position] = value
+            tail_index[position] = i
+        previous[i] = tail_index[position - 1] if position else -1
+    result = []
+    i = tail_index[-1] if tail_index else -1
+    while i >= 0:
+        result.append(i)
+        i = previous[i]
+    return np.array(result[::-1], dtype=int)
+
+
+def nearest(sorted_values, values):
+    """Индексы двух ближайших соседей (слева и справа) в отсортированном массиве"""
+    right = np.clip(np.searchsorted(sorted_values, values), 0, len(sorted_values) - 1)
+    left = np.clip(right - 1, 0, len(sorted_values) - 1)
+    return left, right
+
+
+def unique_best(first, second, score):
+    """Оставляет пары, лучшие по score и для first, и для second"""
+    order = np.argsort(score, kind="stable")
+    keep = order[np.unique(first[order], return_index=True)[1]]
+    keep = keep[np.unique(second[keep], return_index=True)[1]]
+    return np.sort(keep)
+
+
+def match_welds(a_odometr, a_length, b_odometr, b_length, seeds):
+    """
+    Сопоставляет трубы последующего прогона b с трубами предыдущего a.
+    Массивы a и b отсортированы по одометру; seeds — пары индексов (ia, ib)
+    опорных труб. Возвращает индексы пар (ia, ib) в порядке одометра.
+    """
+    if len(a_odometr) == 0 or len(b_odometr) == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    seed_a, seed_b = seeds
+    if len(seed_a) == 0:
+        # без общих труб — совмещаются начала и концы прогонов (камеры запуска и приёма)
+        seed_a = np.array([0, len(a_odometr) - 1])
+        seed_b = np.array([0, len(b_odometr) - 1])
+    matched = np.empty(0, dtype=int), np.empty(0, dtype=int)
+    for iteration in range(MAX_PASSES):
+        tolerance = REFINE_TOLERANCE if iteration else WELD_TOLERANCE
+        # смещение одометра интерполируется между опорами, за их пределами постоянно
+        shift = np.interp(b_odometr, b_odometr[seed_b], a_odometr[seed_a] - b_odometr[seed_b])
+        mapped = b_odometr + shift
+        candidates_b = np.concatenate([np.arange(len(b_odometr))] * 2)
+        candidates_a = np.concatenate(nearest(a_odometr, mapped))
+        distance = np.abs(a_odometr[candidates_a] - mapped[candidates_b])
+        accepted = (distance <= tolerance) & (
+            np.abs(a_length[candidates_a] - b_length[candidates_b]) <= LENGTH_TOLERANCE
+        )
+        candidates_a, candidates_b, distance = (
+            candidates_a[accepted], candidates_b[accepted], distance[accepted]
+        )
+        keep = unique_best(candidates_b, candidates_a, distance)
+        keep = keep[np.argsort(candidates_b[keep], kind="stable")]
+        candidates_a, candidates_b = candidates_a[keep], candidates_b[keep]
+        ordered = longest_increasing(candidates_a)
+        if len(ordered) <= len(matched[0]):
+            break
+        matched = seed_a, seed_b = candidates_a[ordered], candidates_b[ordered]
+    return matched
+
+
+def clock_minutes(values):
+    """'03:24' -> 204 мин; пустые и некорректные значения -> nan"""
+    parsed = {}
+    for value in set(values):
+        try:
+            hours, minutes = str(value).split(":")[:2]
+            parsed[value] = (int(hours) % 12) * 60 + int(minutes)
+        except ValueError:
+            parsed[value] = np.nan
+    return np.array([parsed[value] for value in values], dtype=float)
+
+
+def anomaly_arrays(diagnostics):
+    rows = list(
+        Anomaly.objects.filter(tube__diagnostics=diagnostics).values_list(
+            "id", "tube_id", "odometr_data", "from_left_weld_to_max",
+            "max_point_orientation", "anomaly_nature", "anomaly_depth", "anomaly_length",
+            "tube__odometr_data", "tube__thickness",
+        )
+    )
+    columns = list(zip(*rows)) or [()] * 10
+    ids, versions, odometr, from_weld, clock, nature, depth, length, tube_odometr, thickness = columns
+    odometr = np.array(odometr, dtype=float)
+    # расстояние от левого кольцевого шва: из отчёта, иначе по одометру
+    position = np.array(from_weld, dtype=float)
+    position = np.where(
+        np.isnan(position), odometr - np.array(tube_odometr, dtype=float), position
+    )
+    return {
+        "id": np.array(ids, dtype=int),
+        "version": np.array(versions, dtype=int),
+        "position": position,
+        "clock": clock_minutes(clock),
+        "nature": np.array(nature, dtype=object),
+        "depth": np.array(depth, dtype=float),
+        "length": np.array(length, dtype=float),
+        "thickness": np.array(thickness, dtype=float),
+    }
+
+
+def match_anomalies(a, b, pair_of_a, pair_of_b, scale_of_b):
+    """
+    Сопоставляет аномалии внутри пар труб. pair_of_* — номер пары трубы
+    каждой аномалии (-1 для несопоставленных труб), scale_of_b — отношение
+    длин труб для приведения положения аномалии к предыдущему прогону.
+    Возвращает индексы аномалий (ia, ib), расхождение по оси и окружности.
+    """
+    empty = np.empty(0, dtype=int)
+    in_a = (pair_of_a >= 0) & ~np.isnan(a["position"])
+    in_b = (pair_of_b >= 0) & ~np.isnan(b["position"])
+    if not in_a.any() or not in_b.any():
+        return empty, empty, np.empty(0), np.empty(0)
+    _, nature_code = np.unique(
+        np.concatenate([a["nature"], b["nature"]]).astype(str), return_inverse=True
+    )
+    code_a, code_b = nature_code[:len(a["id"])], nature_code[len(a["id"]):]
+    pairs = max(pair_of_a.max(), pair_of_b.max()) + 1
+    # ключ поиска: характер, пара труб, положение от шва — ближайший сосед по оси
+    key_a = (code_a * pairs + pair_of_a) * TUBE_KEY_SPAN + np.nan_to_num(a["position"])
+    key_b = (code_b * pairs + pair_of_b) * TUBE_KEY_SPAN + np.nan_to_num(b["position"] * scale_of_b)
+    index_a = np.flatnonzero(in_a)
+    index_a = index_a[np.argsort(key_a[index_a], kind="stable")]
+    index_b = np.flatnonzero(in_b)
+    left, right = nearest(key_a[index_a], key_b[index_b])
+    candidates_b = np.concatenate([index_b, index_b])
+    candidates_a = index_a[np.concatenate([left, right])]
+    axial = np.abs(key_a[candidates_a] - key_b[candidates_b])
+    clock = np.abs(a["clock"][candidates_a] - b["clock"][candidates_b])
+    clock = np.minimum(clock, 720 - clock)
+    accepted = (axial <= AXIAL_TOLERANCE) & ~(clock > CLOCK_TOLERANCE)
+    score = axial / AXIAL_TOLERANCE + np.nan_to_num(clock) / CLOCK_TOLERANCE
+    candidates_a, candidates_b = candidates_a[accepted], candidates_b[accepted]
+    axial, clock, score = axial[accepted], clock[accepted], score[accepted]
+    keep = unique_best(candidates_b, candidates_a, score)
+    return candidates_a[keep], candidates_b[keep], axial[keep], clock[keep]
+
+
+def tube_arrays(diagnostics):
+    rows = list(
+        TubeVersion.objects.filter(
+            diagnostics=diagnostics, odometr_data__isnull=False
+        ).order_by("odometr_data", "id").values_list("id", "tube_id", "odometr_data", "tube_length")
+    )
+    ids, tubes, odometr, length = list(zip(*rows)) or [()] * 4
+    return (
+        np.array(ids, dtype=int), np.array(tubes, dtype=int),
+        np.array(odometr, dtype=float), np.array(length, dtype=float),
+    )
+
+
+def none_if_nan(values):
+    return [None if value != value else value for value in values.tolist()]
+
+
+@transaction.atomic
+def align_runs(earlier, later, batch_size=5000):
+    """
+    Сопоставляет прогоны earlier и later (Diagnostics), сохраняет пары труб
+    и аномалий с скоростями роста. Повторный расчёт заменяет предыдущий.
+    """
+    if not (earlier.start_date and later.start_date) or later.start_date <= earlier.start_date:
+        raise ValueError("Последующая ВТД должна быть проведена позже предыдущей")
+    years = (later.start_date - earlier.start_date).days / 365.25
+
+    a_ids, a_tubes, a_odometr, a_length = tube_arrays(earlier)
+    b_ids, b_tubes, b_odometr, b_length = tube_arrays(later)
+    # опоры: версии одной и той же трубы в обоих прогонах
+    _, seed_a, seed_b = np.intersect1d(a_tubes, b_tubes, return_indices=True)
+    same = np.abs(a_length[seed_a] - b_length[seed_b]) <= LENGTH_TOLERANCE
+    seed_a, seed_b = seed_a[same], seed_b[same]
+    order = np.argsort(seed_b)
+    seed_a, seed_b = seed_a[order], seed_b[order]
+    ordered = longest_increasing(seed_a)
+    ia, ib = match_welds(a_odometr, a_length, b_odometr, b_length, (seed_a[ordered], seed_b[ordered]))
+
+    a, b = anomaly_arrays(earlier), anomaly_arrays(later)
+    # номер пары труб для каждой аномалии
+    pair_of_version_a = dict(zip(a_ids[ia].tolist(), range(len(ia))))
+    pair_of_version_b = dict(zip(b_ids[ib].tolist(), range(len(ib))))
+    pair_of_a = np.array([pair_of_version_a.get(v, -1) for v in a["version"].tolist()], dtype=int)
+    pair_of_b = np.array([pair_of_version_b.get(v, -1) for v in b["version"].tolist()], dtype=int)
+    # отношение длин пары труб, последний элемент — для аномалий вне пар (индекс -1)
+    scale = np.append(a_length[ia] / np.where(b_length[ib] > 0, b_length[ib], 1.0), 1.0)
+    scale_of_b = scale[pair_of_b]
+    ma, mb, axial, clock = match_anomalies(a, b, pair_of_a, pair_of_b, scale_of_b)
+
+    depth_rate = (b["depth"][mb] - a["depth"][ma]) / years
+    depth_rate_mm = depth_rate * b["thickness"][mb] / 100
+    length_rate = (b["length"][mb] - a["length"][ma]) / years
+
+    alignment, _ = RunAlignment.objects.update_or_create(
+        earlier=earlier, later=later,
+        defaults={"years": years, "tube_count": len(ia), "anomaly_count": len(ma)},
+    )
+    alignment.tube_matches.all().delete()
+    alignment.anomaly_matches.all().delete()
+    insert_rows(
+        TubeMatch,
+        ("alignment_id", "earlier_id", "later_id", "odometr_shift"),
+        list(zip(
+            [alignment.id] * len(ia), a_ids[ia].tolist(), b_ids[ib].tolist(),
+            (a_odometr[ia] - b_odometr[ib]).tolist(),
+        )),
+        batch_size,
+    )
+    insert_rows(
+        AnomalyMatch,
+        ("alignment_id", "earlier_id", "later_id", "axial_distance", "clock_distance",
+         "depth_rate", "depth_rate_mm", "length_rate"),
+        list(zip(
+            [alignment.id] * len(ma), a["id"][ma].tolist(), b["id"][mb].tolist(),
+            axial.tolist(), none_if_nan(clock), none_if_nan(depth_rate),
+            none_if_nan(depth_rate_mm), none_if_nan(length_rate),
+        )),
+        batch_size,
+    )
+    return alignment
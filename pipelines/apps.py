@@ -5,3 +5,8 @@ class PipelinesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'pipelines'
     verbose_name = 'Модуль "Магистральные газопроводы"'
+
+    def ready(self):
+        import pipelines.intervals
+        import pipelines.labels
+        import pipelines.signals
@@ -0,0 +1,180 @@
+"""
+Оценка прочности труб с аномалиями потери металла по модифицированной
+методике B31G (0,85dL) сразу для всех аномалий ВТД.
+
+Исходные данные выбираются одним запросом, расчёт выполняется над массивами
+NumPy, результаты сохраняются в AnomalyAssessment пакетной вставкой
+(executemany, см. pipelines.db.insert_rows).
+Рабочее давление — действующее ограничение участка (PipeLimit), при его
+отсутствии — проектное DESIGN_PRESSURE.
+"""
+import math
+import re
+
+import numpy as np
+from django.db import connection, transaction
+from django.db.models import Case, F, OuterRef, Subquery, When
+from django.db.models.functions import Coalesce, NullIf
+from django.utils import timezone
+
+from pipelines.db import insert_rows
+from pipelines.models import Anomaly, AnomalyAssessment, PipeLimit
+
+# Характер аномалий, к которым применима методика (глубина в % толщины стенки)
+METAL_LOSS_NATURES = ("corr", "goug")
+# Проектное давление, кгс/см² (7,4 МПа)
+DESIGN_PRESSURE = 75.5
+# Коэффициент запаса: безопасное давление = разрушающее / SAFETY_FACTOR
+SAFETY_FACTOR = 1.39
+# Прибавка к пределу текучести для напряжения течения, МПа (10 ksi)
+FLOW_STRESS_ADDITION = 68.95
+# Наибольшая относительная глубина, для которой применима методика
+MAX_DEPTH_RATIO = 0.8
+MPA_TO_KGF = 10.1972
+
+# Столбцы AnomalyAssessment в порядке значений строки при вставке
+ASSESSMENT_COLUMNS = (
+    "anomaly_id", "diagnostics_id", "pipe_id", "method", "burst_pressure", "safe_pressure",
+    "remaining_strength", "operating_pressure", "erf", "exceeds_limit", "created_at",
+)
+
+NUMBER = re.compile(r"\d+(?:[.,]\d+)?")
+
+
+def parse_strength(value):
+    """
+    '461.000000', '461 МПа' -> 461.0; '-', пустые и нулевые значения -> nan
+    (импорт записывает отсутствующую прочность как 0)
+    """
+    match = NUMBER.search(value or "")
+    strength = float(match.group().replace(",", ".")) if match else np.nan
+    return strength if strength > 0 else np.nan
+
+
+def strengths(values):
+    """Разбор текстовых прочностей, каждое уникальное значение разбирается один раз"""
+    parsed = {value: parse_strength(value) for value in set(values)}
+    return np.array([parsed[value] for value in values], dtype=float)
+
+
+def folias_factor(length, diameter, thickness):
+    """Коэффициент выпучивания M модифицированной методики B31G"""
+    z = length ** 2 / (diameter * thickness)
+    return np.where(
+        z <= 50,
+        np.sqrt(1 + 0.6275 * z - 0.003375 * z ** 2),
+        0.032 * z + 3.3,
+    )
+
+
+def modified_b31g(depth, length, diameter, thickness, yield_strength, tensile_strength):
+    """
+    Разрушающее давление (МПа) и коэффициент остаточной прочности.
+    depth — глубина в долях толщины стенки, размеры в мм, прочность в МПа.
+    При глубине свыше MAX_DEPTH_RATIO разрушающее давление принимается равным 0.
+    """
+    flow_stress = yield_strength + FLOW_STRESS_ADDITION
+    flow_stress = np.where(
+        np.isnan(tensile_strength), flow_stress, np.fmin(flow_stress, tensile_strength)
+    )
+    loss = 0.85 * depth
+    remaining = (1 - loss) / (1 - loss / folias_factor(length, diameter, thickness))
+    remaining = np.where(depth > MAX_DEPTH_RATIO, 0.0, np.clip(remaining, 0.0, 1.0))
+    burst = 2 * flow_stress * remaining * thickness / diameter
+    return burst, remaining
+
+
+@transaction.atomic
+def assess_diagnostics(diagnostics, batch_size=2000):
+    """
+    Пересчитывает оценки всех аномалий потери металла ВТД.
+    Аномалии группы взаимодействующих оцениваются по её длине и наибольшей
+    глубине, поэтому группы пересобираются до оценки (cluster_diagnostics).
+    Аномалии без толщины стенки или предела текучести пропускаются.
+    Возвращает число сохранённых оценок.
+    """
+    rows = list(
+        Anomaly.objects.filter(
+            tube__diagnostics=diagnostics,
+            anomaly_nature__in=METAL_LOSS_NATURES,
+            anomaly_depth__isnull=False,
+        ).values_list(
+            "id",
+            "anomaly_depth",
+            "anomaly_length",
+            "tube__thickness",
+            "tube__diameter",
+            "tube__yield_strength",
+            "tube__tear_strength",
+            "tube__tube__pipe_id",
+            "tube__tube__pipe__current_limit__pressure_limit",
+            "cluster__length",
+            "cluster__max_depth",
+        )
+    )
+    AnomalyAssessment.objects.filter(diagnostics=diagnostics).delete()
+    if not rows:
+        return 0
+    (ids, depth, length, thickness, diameter, yield_text, tensile_text, pipe_ids, limits,
+     cluster_length, cluster_depth) = zip(*rows)
+    # взаимодействующие аномалии оцениваются по размерам группы (pipelines.clustering)
+    depth = np.array(depth, dtype=float)
+    depth = np.fmax(depth, np.array(cluster_depth, dtype=float))
+    length = np.array([value or 0 for value in length], dtype=float)
+    length = np.fmax(length, np.array(cluster_length, dtype=float))
+    thickness = np.array(thickness, dtype=float)
+    yield_strength = strengths(yield_text)
+    valid = (thickness > 0) & ~np.isnan(yield_strength)
+
+    burst, remaining = modified_b31g(
+        depth / 100,
+        length,
+        np.array(diameter, dtype=float),
+        np.where(valid, thickness, 1.0),
+        yield_strength,
+        strengths(tensile_text),
+    )
+    burst *= MPA_TO_KGF
+    safe = burst / SAFETY_FACTOR
+    operating = np.array(
+        [DESIGN_PRESSURE if limit is None else limit for limit in limits], dtype=float
+    )
+    with np.errstate(divide="ignore"):
+        erf = np.where(safe > 0, operating / np.where(safe > 0, safe, 1.0), np.nan)
+    exceeds = (safe <= 0) | (erf > 1)
+
+    # .tolist() — значения Python вместо скаляров NumPy для драйвера БД
+    burst, safe, remaining, operating, erf, exceeds = (
+        array.tolist() for array in (burst, safe, remaining, operating, erf, exceeds)
+    )
+    created_at = AnomalyAssessment._meta.get_field("created_at").get_db_prep_save(
+        timezone.now(), connection
+    )
+    rows = [
+        (
+            ids[i], diagnostics.id, pipe_ids[i], "b31g_mod", burst[i], safe[i], remaining[i],
+            operating[i], None if math.isnan(erf[i]) else erf[i], exceeds[i], created_at,
+        )
+        for i in np.flatnonzero(valid).tolist()
+    ]
+    insert_rows(AnomalyAssessment, ASSESSMENT_COLUMNS, rows, batch_size)
+    return len(rows)
+
+
+def update_operating_pressure(pipe_ids):
+    """
+    После изменения ограничения давления пересчитывает ERF оценок участков.
+    Действующее ограничение берётся из PipeLimit, а не из Pipe.current_limit:
+    сигнал post_save приходит до обновления указателя в PipeLimit.save.
+    """
+    open_limit = PipeLimit.objects.filter(
+        pipe_id=OuterRef("pipe_id"), end_date__isnull=True
+    ).order_by("-start_date").values("pressure_limit")[:1]
+    assessments = AnomalyAssessment.objects.filter(pipe_id__in=pipe_ids)
+    assessments.update(operating_pressure=Coalesce(Subquery(open_limit), DESIGN_PRESSURE))
+    assessments.update(erf=F("operating_pressure") / NullIf(F("safe_pressure"), 0.0))
+    assessments.update(exceeds_limit=Case(
+        When(safe_pressure__lte=0, then=True),
+        When(erf__gt=1, then=True),
+        default=False,
+    ))
@@ -0,0 +1,185 @@
+"""
+Привязка данных ВТД (одометр, м) к километражу газопровода.
+
+Опорные точки — краны и маркеры прогона (TubeUnit с типами REFERENCE_UNITS),
+сопоставленные с крановыми узлами газопровода (Node.location_point): маркеры
+ставятся на крановых площадках.
+
+1. Первое приближение — линейное растяжение одометра прогона на отрезок
+   участков ВТД, в прямом и в обратном направлении; выбирается направление,
+   при котором сопоставлено больше опор.
+2. Каждая опора сопоставляется с ближайшим узлом в пределах допуска, пары,
+   нарушающие порядок узлов, отбрасываются по наибольшей возрастающей
+   подпоследовательности (pipelines.alignment). По парам строится
+   кусочно-линейное преобразование, и проход повторяется с меньшим допуском,
+   пока растёт число пар.
+3. За крайними опорами преобразование продолжается по наклону крайних
+   отрезков; при одной опоре первое приближение сдвигается на неё.
+
+Преобразование сохраняется в OdometerCalibration с версией, прочитанной до
+расчёта. Сигналы при изменении труб и элементов обустройства ВТД, её участков
+и узлов газопровода сбрасывают его и пересчитывают после коммита, import_ili
+и rebuild_ili_aggregates строят его для новых и загруженных ранее ВТД; запрос
+без сохранённого преобразования строит его без записи. В памяти процесса
+держатся последние MEMO_SIZE преобразований под версией, прочитанной до расчёта.
+Целые столбцы пересчитываются одним вызовом np.interp.
+"""
+import numpy as np
+from django.db.models import Max, Min
+
+from equipments import versions
+from pipelines.alignment import longest_increasing, nearest
+from pipelines.models import (Anomaly, Node, OdometerCalibration, Pipe,
+                              TubeUnit, TubeVersion)
+
+# Элементы обустройства, служащие опорами
+REFERENCE_UNITS = ('valv', 'mark')
+# Допуски сопоставления опоры с узлом, км: первый проход и уточняющие
+MATCH_TOLERANCE = 0.5
+REFINE_TOLERANCE = 0.05
+# Уточняющие проходы повторяются, пока растёт число пар
+MAX_PASSES = 20
+# Преобразований в памяти процесса
+MEMO_SIZE = 32
+
+
+def interpolate(x, xp, fp):
+    """Кусочно-линейная функция по точкам (xp возрастает) с продолжением за крайние точки"""
+    x = np.asarray(x, dtype=float)
+    xp, fp = np.asarray(xp, dtype=float), np.asarray(fp, dtype=float)
+    y = np.interp(x, xp, fp)
+    for outside, first, second in ((x < xp[0], 0, 1), (x > xp[-1], -1, -2)):
+        slope = (fp[second] - fp[first]) / (xp[second] - xp[first])
+        y[outside] = fp[first] + (x[outside] - xp[first]) * slope
+    return y
+
+
+def match_references(odometer, nodes, xp, fp, tolerance, reverse):
+    """Пары (одометр опоры, км узла) в пределах допуска с сохранением порядка узлов"""
+    if not len(odometer) or not len(nodes):
+        return np.array([]), np.array([])
+    km = interpolate(odometer, xp, fp)
+    left, right = nearest(nodes, km)
+    node = np.where(np.abs(nodes[left] - km) <= np.abs(nodes[right] - km), left, right)
+    close = np.flatnonzero(np.abs(nodes[node] - km) <= tolerance)
+    # опоры упорядочены по одометру, узлы должны идти в том же (или обратном) порядке
+    ordered = close[longest_increasing(-node[close] if reverse else node[close])]
+    return odometer[ordered], nodes[node[ordered]]
+
+
+def transform(pairs, guess):
+    """Узлы преобразования по парам; при нехватке пар — первое приближение"""
+    odometer, km = pairs
+    if len(odometer) >= 2:
+        return odometer, km
+    xp, fp = guess
+    if len(odometer) == 1:
+        return xp, fp + (km[0] - interpolate(odometer, xp, fp)[0])
+    return xp, fp
+
+
+def fit(odometer, nodes, guess, reverse):
+    pairs = match_references(odometer, nodes, *guess, MATCH_TOLERANCE, reverse)
+    for _ in range(MAX_PASSES):
+        refined = match_references(
+            odometer, nodes, *transform(pairs, guess), REFINE_TOLERANCE, reverse
+        )
+        if len(refined[0]) <= len(pairs[0]):
+            break
+        pairs = refined
+    return pairs, transform(pairs, guess)
+
+
+def calibrate(diagnostics_id):
+    """Строит преобразование одометра ВТД в километраж: значения полей OdometerCalibration"""
+    pipes = list(
+        Pipe.objects.filter(pipe_diagnostics=diagnostics_id)
+        .values_list('pipeline_id', 'start_point', 'end_point')
+    )
+    if not pipes:
+        raise ValueError('ВТД не привязана к участкам газопровода')
+    pipeline_ids = {pipeline_id for pipeline_id, _, _ in pipes}
+    if len(pipeline_ids) > 1:
+        raise ValueError('Участки ВТД относятся к разным газопроводам')
+    span = (min(start for _, start, _ in pipes), max(end for _, _, end in pipes))
+    run = TubeVersion.objects.filter(diagnostics_id=diagnostics_id).aggregate(
+        start=Min('odometr_data'), end=Max('odometr_data')
+    )
+    if run['start'] is None or run['start'] == run['end']:
+        raise ValueError('Нет данных одометра ВТД')
+
+    odometer = np.unique(np.array(
+        TubeUnit.objects.filter(
+            tube__diagnostics_id=diagnostics_id,
+            unit_type__in=REFERENCE_UNITS,
+            odometr_data__isnull=False,
+        ).values_list('odometr_data', flat=True),
+        dtype=float,
+    ))
+    nodes = np.unique(np.array(
+        Node.objects.filter(
+            pipeline_id=pipeline_ids.pop(),
+            location_point__gte=span[0] - MATCH_TOLERANCE,
+            location_point__lte=span[1] + MATCH_TOLERANCE,
+        ).values_list('location_point', flat=True),
+        dtype=float,
+    ))
+    xp = np.array([run['start'], run['end']], dtype=float)
+    best = None
+    for reverse in (False, True):
+        guess = (xp, np.array(span[::-1] if reverse else span, dtype=float))
+        pairs, points = fit(odometer, nodes, guess, reverse)
+        if best is None or len(pairs[0]) > best[0]:
+            best = (len(pairs[0]), points)
+    reference_count, (xp, fp) = best
+    return {
+        'odometer': xp.tolist(),
+        'kilometres': fp.tolist(),
+        'reference_count': reference_count,
+    }
+
+
+# Последние преобразования в памяти процесса: {diagnostics_id: (версия, преобразование)}
+_local = {}
+
+
+def get_calibration(diagnostics_id):
+    """Сохранённое преобразование, при отсутствии строится без записи"""
+    key = OdometerCalibration.version_key(diagnostics_id)
+    memo = _local.get(diagnostics_id)
+    if memo is not None and memo[0] == versions.read(key):
+        return memo[1]
+    calibration = OdometerCalibration.get_or_build(
+        key, lambda: calibrate(diagnostics_id), save=False, diagnostics_id=diagnostics_id
+    )
+    _local.pop(diagnostics_id, None)
+    _local[diagnostics_id] = (calibration.version, calibration)
+    while len(_local) > MEMO_SIZE:
+        _local.pop(next(iter(_local)))
+    return calibration
+
+
+def to_km(calibration, odometer):
+    """Километраж для массива значений одометра (NaN сохраняются)"""
+    return interpolate(odometer, calibration.odometer, calibration.kilometres)
+
+
+def to_odometer(calibration, km):
+    """Одометр для массива значений километража"""
+    order = np.argsort(calibration.kilometres)
+    return interpolate(
+        km,
+        np.asarray(calibration.kilometres, dtype=float)[order],
+        np.asarray(calibration.odometer, dtype=float)[order],
+    )
+
+
+def anomaly_kilometres(calibration):
+    """id аномалий ВТД и их километраж одним проходом: (ids, km)"""
+    rows = list(
+        Anomaly.objects.filter(tube__diagnostics_id=calibration.diagnostics_id)
+        .order_by('odometr_data', 'id').values_list('id', 'odometr_data')
+    )
+    ids, odometer = list(zip(*rows)) or [(), ()]
+    odometer = np.array([np.nan if value is None else value for value in odometer], dtype=float)
+    return np.array(ids, dtype=int), to_km(calibration, odometer)
@@ -0,0 +1,155 @@
+"""
+Группировка взаимодействующих аномалий потери металла.
+
+Аномалии одной трубы взаимодействуют, если расстояние между ними вдоль оси
+и по окружности не больше INTERACTION_FACTOR толщин стенки. Аномалии каждой
+трубы обходятся в порядке начала (линия развёртки): сравниваются только
+с активными аномалиями, конец которых вместе с допуском ещё не пройден,
+поэтому время расчёта почти линейно по числу аномалий ВТД. Группы
+собираются объединением множеств; в AnomalyCluster сохраняются только
+группы из двух и более аномалий вместе с суммарными размерами, которые
+затем использует оценка прочности (pipelines.assessment).
+"""
+import math
+
+import numpy as np
+from django.db import connection, transaction
+
+from pipelines.alignment import clock_minutes
+from pipelines.assessment import METAL_LOSS_NATURES
+from pipelines.models import Anomaly, AnomalyCluster
+
+# Наибольшее расстояние между взаимодействующими аномалиями, толщин стенки
+INTERACTION_FACTOR = 6
+
+
+def find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def sweep(tube, start, end, center, half_width, circumference, gap):
+    """
+    Объединяет взаимодействующие аномалии. Массивы отсортированы по (tube, start);
+    center и half_width — по окружности, мм (nan — ориентация неизвестна,
+    такая аномалия считается взаимодействующей по окружности).
+    Возвращает корень группы для каждой аномалии.
+    """
+    parent = list(range(len(start)))
+    active = []
+    tube, start, end, center, half_width, circumference, gap = (
+        array.tolist() for array in (tube, start, end, center, half_width, circumference, gap)
+    )
+    for i in range(len(start)):
+        # из активных удаляются аномалии другой трубы и уже пройденные по оси
+        active = [j for j in active if tube[j] == tube[i] and end[j] + gap[i] >= start[i]]
+        for j in active:
+            distance = abs(center[i] - center[j])
+            distance = min(distance, circumference[i] - distance) - half_width[i] - half_width[j]
+            if not distance > gap[i]:
+                root_i, root_j = find(parent, i), find(parent, j)
+                if root_i != root_j:
+                    parent[root_j] = root_i
+        active.append(i)
+    return np.array([find(parent, i) for i in range(len(parent))], dtype=int)
+
+
+def combined_arc(center, half_width, circumference):
+    """Ширина и середина дуги, покрывающей аномалии группы, мм (nan — ориентация неизвестна)"""
+    if np.isnan(center).any():
+        return circumference, math.nan
+    reference = center[0]
+    # положение относительно первой аномалии в пределах полуокружности
+    offset = (center - reference + circumference / 2) % circumference - circumference / 2
+    low, high = (offset - half_width).min(), (offset + half_width).max()
+    if high - low >= circumference:
+        return circumference, math.nan
+    return high - low, (reference + (low + high) / 2) % circumference
+
+
+def clock_text(minutes):
+    if math.isnan(minutes):
+        return ""
+    minutes = int(round(minutes)) % 720
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+@transaction.atomic
+def cluster_diagnostics(diagnostics, batch_size=5000):
+    """Пересобирает группы аномалий ВТД, возвращает число групп"""
+    anomalies = Anomaly.objects.filter(tube__diagnostics=diagnostics)
+    anomalies.filter(cluster__isnull=False).update(cluster=None)
+    AnomalyCluster.objects.filter(diagnostics=diagnostics).delete()
+    rows = list(
+        anomalies.filter(anomaly_nature__in=METAL_LOSS_NATURES).values_list(
+            "id", "tube_id", "from_left_weld_to_start", "from_left_weld_to_max",
+            "odometr_data", "tube__odometr_data", "anomaly_length", "anomaly_width",
+            "center_orientation", "max_point_orientation", "anomaly_depth",
+            "tube__thickness", "tube__diameter",
+        )
+    )
+    if not rows:
+        return 0
+    (ids, tubes, from_start, from_max, odometr, tube_odometr, length, width,
+     center_clock, max_clock, depth, thickness, diameter) = zip(*rows)
+    length = np.array([value or 0 for value in length], dtype=float)
+    width = np.array([value or 0 for value in width], dtype=float)
+    # начало аномалии от левого шва, мм: из отчёта, иначе от точки максимума или по одометру
+    start = np.array(from_start, dtype=float)
+    start = np.where(np.isnan(start), np.array(from_max, dtype=float) - length / 2000, start)
+    start = np.where(
+        np.isnan(start),
+        np.array(odometr, dtype=float) - np.array(tube_odometr, dtype=float),
+        start,
+    ) * 1000
+    known = ~np.isnan(start)
+    clock = clock_minutes(center_clock)
+    clock = np.where(np.isnan(clock), clock_minutes(max_clock), clock)
+    circumference = math.pi * np.array(diameter, dtype=float)
+    center = clock / 720 * circumference
+
+    ids, tubes = np.array(ids)[known], np.array(tubes)[known]
+    start, length, width, center, circumference = (
+        start[known], length[known], width[known], center[known], circumference[known]
+    )
+    depth = np.array(depth, dtype=float)[known]
+    gap = INTERACTION_FACTOR * np.array(thickness, dtype=float)[known]
+    order = np.lexsort((start, tubes))
+    ids, tubes, start, length, width, center, circumference, depth, gap = (
+        array[order] for array in (ids, tubes, start, length, width, center, circumference, depth, gap)
+    )
+    roots = sweep(tubes, start, start + length, center, width / 2, circumference, gap)
+
+    _, inverse, counts = np.unique(roots, return_inverse=True, return_counts=True)
+    groups = np.split(np.argsort(inverse, kind="stable"), np.cumsum(counts)[:-1])
+    clusters, members = [], []
+    for index in groups:
+        if len(index) < 2:
+            continue
+        axial_start = start[index].min()
+        circumference_mm = circumference[index[0]]
+        arc_width, arc_center = combined_arc(center[index], width[index] / 2, circumference_mm)
+        clusters.append(AnomalyCluster(
+            diagnostics=diagnostics,
+            tube_id=int(tubes[index[0]]),
+            axial_start=float(axial_start) / 1000,
+            length=float((start[index] + length[index]).max() - axial_start),
+            width=float(arc_width),
+            center_orientation=clock_text(arc_center / circumference_mm * 720),
+            max_depth=None if np.isnan(depth[index]).all() else float(np.nanmax(depth[index])),
+            anomaly_count=len(index),
+        ))
+        members.append(ids[index].tolist())
+    if not clusters:
+        return 0
+    AnomalyCluster.objects.bulk_create(clusters, batch_size=batch_size)
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            "UPDATE {} SET {} = %s WHERE {} = %s".format(
+                *map(connection.ops.quote_name, (Anomaly._meta.db_table, "cluster_id", "id"))
+            ),
+            [(cluster.pk, anomaly_id) for cluster, group in zip(clusters, members) for anomaly_id in group],
+        )
+    return len(clusters)
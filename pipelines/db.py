@@ -0,0 +1,57 @@
+"""
+Пакетные вставка и удаление строк в обход ORM: импорт отчётов ВТД и
+сохранение расчётов по ним. Модуль не зависит от разбора xlsx
+(pipelines.utils) и загружается вместе с сигналами.
+"""
+from django.db import connection, models
+
+
+def insert_rows(model, columns, rows, batch_size):
+    """
+    Вставка готовых значений столбцов через executemany.
+    bulk_create готовит каждое значение через поле модели и на SQLite делит
+    вставку на пакеты по 999 параметров, для десятков тысяч строк расчётов
+    это основное время. Значения должны быть уже в формате БД.
+    """
+    sql = "INSERT INTO {} ({}) VALUES ({})".format(
+        connection.ops.quote_name(model._meta.db_table),
+        ", ".join(connection.ops.quote_name(column) for column in columns),
+        ", ".join(["%s"] * len(columns)),
+    )
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), batch_size):
+            cursor.executemany(sql, rows[start:start + batch_size])
+
+
+def delete_rows(queryset):
+    """
+    Удаляет строки queryset и зависящие от них по CASCADE без загрузки
+    объектов и сигналов: по одному DELETE на таблицу, ссылки SET_NULL
+    обнуляются одним UPDATE. Обратные связи берутся вместе со скрытыми
+    (related_name='+', промежуточные таблицы ManyToMany). Кэши,
+    поддерживаемые сигналами удаления, вызывающий сбрасывает сам.
+    """
+    model = queryset.model
+    pks = queryset.order_by().values('pk')
+    for relation in model._meta.get_fields(include_hidden=True):
+        if relation.concrete or not (relation.one_to_many or relation.one_to_one):
+            continue
+        related = relation.related_model._base_manager.filter(
+            **{f'{relation.field.name}__in': pks}
+        )
+        if relation.on_delete is models.CASCADE:
+            delete_rows(related)
+        elif relation.on_delete is models.SET_NULL:
+            related.update(**{relation.field.name: None})
+        elif relation.on_delete is not models.DO_NOTHING:
+            raise ValueError(f'Удаление без сигналов не поддерживает связь {relation}')
+    sql, params = pks.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'DELETE FROM {} WHERE {} IN ({})'.format(
+                connection.ops.quote_name(model._meta.db_table),
+                connection.ops.quote_name(model._meta.pk.column),
+                sql,
+            ),
+            params,
+        )
@@ -1,15 +1,51 @@
 import django_filters as df
 from django import forms
-from django.db.models import Exists, OuterRef, Q, Subquery
+from django.db.models import Count, Exists, OuterRef, Q, Subquery
 
+from equipments import versions
 from equipments.models import Department
 from pipelines.models import (
-    Anomaly, Bend, Diagnostics, Node, Pipe, PipeDepartment, Pipeline, Repair,
-    Tube, TubeUnit, TubeVersion)
+    Anomaly, Bend, Diagnostics, FilterFacets, Node, Pipe, PipeDepartment,
+    Pipeline, Repair, Tube, TubeUnit, TubeVersion)
+
+
+def build_facets(queryset, fields):
+    """
+    Значения полей с количеством записей: {поле: [[значение, количество], ...]}.
+    Один запрос с группировкой по всем полям сразу.
+    """
+    facets = {field: {} for field in fields}
+    rows = queryset.order_by().values_list(*fields).annotate(count=Count('pk'))
+    for *values, count in rows:
+        for field, value in zip(fields, values):
+            if value is not None and value != '':
+                facets[field][value] = facets[field].get(value, 0) + count
+    return {
+        field: [[value, counts[value]] for value in sorted(counts)]
+        for field, counts in facets.items()
+    }
+
+
+# Значения списков текущей версии в памяти процесса: {(список, id): значения}
+_local = {'version': None, 'facets': {}}
+
+
+def get_facets(scope, object_id, build):
+    """
+    Значения выпадающих списков участка или ВТД из памяти процесса; после
+    сброса FilterFacets — из сохранённых значений, при их отсутствии build()
+    """
+    version = versions.current(FilterFacets.VERSION_KEY)
+    if _local['version'] != version:
+        _local['version'], _local['facets'] = version, {}
+    facets = _local['facets'].get((scope, object_id))
+    if facets is None:
+        facets = _local['facets'][scope, object_id] = FilterFacets.get(scope, object_id, build)
+    return facets
 
 
 def unit_exists(unit_type=None):
-    qs = TubeUnit.objects.filter(tube=OuterRef('last_version_id'))
+    qs = TubeUnit.objects.filter(tube=OuterRef('latest_version_id'))
     if unit_type:
         qs = qs.filter(unit_type=unit_type)
     return Exists(qs)
@@ -65,27 +101,18 @@ class TubeVersionFilter(df.FilterSet):
             'tear_strength',
         ]
 
-    def __init__(self, *args, **kwargs):
+    FACET_FIELDS = ('thickness', 'steel_grade')
+
+    def __init__(self, *args, facets=None, **kwargs):
         super().__init__(*args, **kwargs)
-        qs = self.queryset
-        thickness_values = (
-            qs.exclude(thickness__isnull=True)
-              .values_list('thickness', flat=True)
-              .distinct()
-              .order_by('thickness')
-        )
+        # facets — готовые значения из FilterFacets, без них собираем по queryset
+        if facets is None:
+            facets = build_facets(self.queryset, self.FACET_FIELDS)
         self.filters['thickness'].extra['choices'] = [
-            (v, f'{v} мм') for v in thickness_values
+            (v, f'{v} мм ({count})') for v, count in facets['thickness']
         ]
-        steel_grades = (
-            qs.exclude(steel_grade__isnull=True)
-              .exclude(steel_grade='')
-              .values_list('steel_grade', flat=True)
-              .distinct()
-              .order_by('steel_grade')
-        )
         self.filters['steel_grade'].extra['choices'] = [
-            (v, v) for v in steel_grades
+            (v, f'{v} ({count})') for v, count in facets['steel_grade']
         ]
 
 
@@ -168,54 +195,27 @@ class TubeFilter(df.FilterSet):
             'unit_type',
         ]
 
-    def __init__(self, *args, **kwargs):
+    FACET_FIELDS = ('last_length', 'last_thickness', 'last_type', 'last_steel_grade')
+
+    def __init__(self, *args, facets=None, **kwargs):
         super().__init__(*args, **kwargs)
-        qs = self.queryset
-        steel_grades = (
-            qs
-            .exclude(last_steel_grade__isnull=True)
-            .exclude(last_steel_grade='')
-            .values_list('last_steel_grade', flat=True)
-            .order_by()
-            .distinct()
-            .order_by('last_steel_grade')
-        )
+        # facets — готовые значения из FilterFacets, без них собираем по queryset
+        if facets is None:
+            facets = build_facets(self.queryset, self.FACET_FIELDS)
         self.filters['last_steel_grade'].extra['choices'] = [
-            (val, val) for val in steel_grades
+            (v, f'{v} ({count})') for v, count in facets['last_steel_grade']
         ]
-        lengths = (
-            qs.exclude(last_length__isnull=True)
-            .values_list('last_length', flat=True)
-            .order_by()
-            .distinct()
-            .order_by('last_length')
-        )
         self.filters['last_length'].extra['choices'] = [
-            (v, f'{v} м') for v in lengths
+            (v, f'{v} м ({count})') for v, count in facets['last_length']
         ]
-        thicknesses = (
-            qs.exclude(last_thickness__isnull=True)
-            .values_list('last_thickness', flat=True)
-            .order_by()
-            .distinct()
-            .order_by('last_thickness')
-        )
         self.filters['last_thickness'].extra['choices'] = [
-            (v, f'{v} мм') for v in thicknesses
+            (v, f'{v} мм ({count})') for v, count in facets['last_thickness']
         ]
-        types = (
-            qs
-            .exclude(last_type__isnull=True)
-            .exclude(last_type='')
-            .order_by()  # <-- КЛЮЧЕВОЕ
-            .values_list('last_type', flat=True)
-            .distinct()
-        )
+        tube_types = dict(TubeVersion.TUBE_TYPE)
         self.filters['last_type'].extra['choices'] = [
-            (v, dict(TubeVersion.TUBE_TYPE).get(v, v)) for v in types
+            (v, f'{tube_types.get(v, v)} ({count})') for v, count in facets['last_type']
         ]
 
-
     def filter_unit_type(self, queryset, name, value):
         if value == 'all_units':
             return queryset.filter(unit_exists())
@@ -0,0 +1,207 @@
+"""
+Поиск отводов ВТД по координатам: ближайшие к точке и попавшие в прямоугольник.
+
+Широта и долгота отводов прогона переводятся в метры на плоскости
+(равнопромежуточная проекция относительно средней широты прогона, погрешность
+на протяжении газопровода пренебрежимо мала) и раскладываются по квадратной
+сетке. Точки хранятся отсортированными по номеру ячейки, номер ячейки —
+столбец * число строк + строка, поэтому ячейки одного столбца сетки занимают
+непрерывный отрезок массива и находятся двумя searchsorted.
+
+Размер ячейки подбирается так, чтобы на ячейку вдоль трассы приходилось около
+POINTS_PER_CELL отводов. Ближайшие точки ищутся в расширяющемся квадрате ячеек,
+пока k-я найденная точка не окажется ближе его границы.
+
+Сетка собирается одним запросом и сохраняется в BendSpatialIndex после
+коммита изменений отводов, при импорте (import_ili) и для загруженных ранее
+ВТД командой rebuild_ili_aggregates (запрос без сохранённого индекса собирает
+его без записи); в памяти процесса держатся последние MEMO_SIZE индексов под версией,
+прочитанной до их сборки. Сохранённый индекс отдаётся, пока она не сменилась.
+"""
+import io
+import math
+
+import numpy as np
+
+from equipments import versions
+from pipelines.alignment import none_if_nan
+from pipelines.models import Bend, BendSpatialIndex
+
+# Метров в градусе широты (и долготы на экваторе)
+METRES_PER_DEGREE = 111320.0
+# Среднее число отводов на ячейку вдоль трассы и наименьший размер ячейки, м
+POINTS_PER_CELL = 16
+MIN_CELL_SIZE = 10.0
+# Ограничения ответа
+MAX_NEAREST = 1000
+MAX_BBOX_RESULTS = 5000
+MEMO_SIZE = 8
+
+COLUMNS = ('id', 'start_point', 'latitude', 'longitude', 'altitude')
+
+
+class GridIndex:
+    def __init__(self, points, origin, cell_size, shape):
+        # points: столбцы COLUMNS и x, y, key, отсортированные по key
+        self.points = points
+        self.origin = origin  # (широта, долгота, метров в градусе долготы)
+        self.cell_size = cell_size
+        self.columns, self.rows = shape
+
+    @classmethod
+    def build(cls, rows):
+        values = list(zip(*rows)) or [()] * len(COLUMNS)
+        points = {
+            name: np.array(column, dtype=int if name == 'id' else float)
+            for name, column in zip(COLUMNS, values)
+        }
+        if not len(points['id']):
+            points.update(x=np.array([]), y=np.array([]), key=np.array([], dtype=np.int64))
+            return cls(points, (0.0, 0.0, METRES_PER_DEGREE), MIN_CELL_SIZE, (1, 1))
+        latitude, longitude = points['latitude'], points['longitude']
+        origin = (
+            latitude.min(),
+            longitude.min(),
+            METRES_PER_DEGREE * math.cos(math.radians((latitude.min() + latitude.max()) / 2)),
+        )
+        x = (longitude - origin[1]) * origin[2]
+        y = (latitude - origin[0]) * METRES_PER_DEGREE
+        # трасса почти линейна: длина по одометру / число точек * точек на ячейку
+        span = np.ptp(points['start_point']) or max(np.ptp(x), np.ptp(y))
+        cell_size = max(MIN_CELL_SIZE, span / len(x) * POINTS_PER_CELL)
+        shape = (int(x.max() // cell_size) + 1, int(y.max() // cell_size) + 1)
+        key = (x // cell_size).astype(np.int64) * shape[1] + (y // cell_size).astype(np.int64)
+        order = np.argsort(key, kind='stable')
+        points.update(x=x, y=y, key=key)
+        points = {name: column[order] for name, column in points.items()}
+        return cls(points, origin, cell_size, shape)
+
+    def dump(self):
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            meta=np.array([*self.origin, self.cell_size, self.columns, self.rows]),
+            **self.points,
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def load(cls, content):
+        data = np.load(io.BytesIO(bytes(content)), allow_pickle=False)
+        meta = data['meta']
+        points = {name: data[name] for name in data.files if name != 'meta'}
+        return cls(points, tuple(meta[:3]), float(meta[3]), (int(meta[4]), int(meta[5])))
+
+    def __len__(self):
+        return len(self.points['id'])
+
+    def project(self, latitude, longitude):
+        latitude0, longitude0, lon_scale = self.origin
+        return (longitude - longitude0) * lon_scale, (latitude - latitude0) * METRES_PER_DEGREE
+
+    def cells(self, x0, y0, x1, y1):
+        """Индексы точек в ячейках, покрывающих прямоугольник [x0, x1] x [y0, y1] (м)"""
+        width, height = self.columns * self.cell_size, self.rows * self.cell_size
+        if (
+            not len(self) or np.isnan([x0, y0, x1, y1]).any()
+            or x1 < 0 or y1 < 0 or x0 > width or y0 > height
+        ):
+            return np.array([], dtype=int)
+        # окно обрезается по сетке до перевода в номера ячеек (бесконечные границы)
+        first_column = int(max(x0, 0.0) // self.cell_size)
+        last_column = min(self.columns - 1, int(min(x1, width) // self.cell_size))
+        first_row = int(max(y0, 0.0) // self.cell_size)
+        last_row = min(self.rows - 1, int(min(y1, height) // self.cell_size))
+        if first_column > last_column or first_row > last_row:
+            return np.array([], dtype=int)
+        columns = np.arange(first_column, last_column + 1) * self.rows
+        starts = np.searchsorted(self.points['key'], columns + first_row)
+        ends = np.searchsorted(self.points['key'], columns + last_row, side='right')
+        return np.concatenate(
+            [np.arange(start, end) for start, end in zip(starts, ends)]
+        ).astype(int)
+
+    def covers_grid(self, x0, y0, x1, y1):
+        return (
+            x0 <= 0 and y0 <= 0
+            and x1 >= self.columns * self.cell_size and y1 >= self.rows * self.cell_size
+        )
+
+    def nearest(self, latitude, longitude, k):
+        """Индексы k ближайших точек по возрастанию расстояния и расстояния, м"""
+        x, y = self.project(latitude, longitude)
+        k = min(k, len(self)) if math.isfinite(x) and math.isfinite(y) else 0
+        radius = self.cell_size
+        while k:
+            window = (x - radius, y - radius, x + radius, y + radius)
+            found = self.cells(*window)
+            if len(found) >= k:
+                distance = np.hypot(self.points['x'][found] - x, self.points['y'][found] - y)
+                nearest = np.argpartition(distance, k - 1)[:k]
+                # точки вне квадрата дальше radius, k-я найденная должна быть не дальше
+                if distance[nearest].max() <= radius or self.covers_grid(*window):
+                    nearest = nearest[np.argsort(distance[nearest], kind='stable')]
+                    return found[nearest], distance[nearest]
+            radius *= 2
+        return np.array([], dtype=int), np.array([])
+
+    def within(self, south, west, north, east):
+        """Индексы точек в прямоугольнике координат, по порядку одометра"""
+        x0, y0 = self.project(south, west)
+        x1, y1 = self.project(north, east)
+        found = self.cells(x0, y0, x1, y1)
+        latitude, longitude = self.points['latitude'][found], self.points['longitude'][found]
+        found = found[
+            (latitude >= south) & (latitude <= north) & (longitude >= west) & (longitude <= east)
+        ]
+        return found[np.argsort(self.points['start_point'][found], kind='stable')]
+
+    def rows_at(self, indices, distances=None):
+        """Отводы по индексам для ответа API"""
+        columns = zip(
+            self.points['id'][indices].tolist(),
+            self.points['start_point'][indices].tolist(),
+            self.points['latitude'][indices].tolist(),
+            self.points['longitude'][indices].tolist(),
+            none_if_nan(self.points['altitude'][indices]),
+        )
+        result = [dict(zip(COLUMNS, values)) for values in columns]
+        if distances is not None:
+            for item, distance in zip(result, distances.tolist()):
+                item['distance'] = round(distance, 2)
+        return result
+
+
+def build_index(diagnostics_id):
+    """Собирает индекс отводов ВТД: значения полей BendSpatialIndex"""
+    rows = Bend.objects.filter(
+        tube__diagnostics_id=diagnostics_id,
+        latitude__isnull=False,
+        longitude__isnull=False,
+    ).values_list(*COLUMNS)
+    index = GridIndex.build(list(rows))
+    return {
+        'point_count': len(index),
+        'cell_size': index.cell_size,
+        'content': index.dump(),
+    }
+
+
+# Последние индексы в памяти процесса: {diagnostics_id: (версия, индекс)}
+_local = {}
+
+
+def get_index(diagnostics_id):
+    key = BendSpatialIndex.version_key(diagnostics_id)
+    memo = _local.get(diagnostics_id)
+    if memo is not None and memo[0] == versions.read(key):
+        return memo[1]
+    stored = BendSpatialIndex.get_or_build(
+        key, lambda: build_index(diagnostics_id), save=False, diagnostics_id=diagnostics_id
+    )
+    index = GridIndex.load(stored.content)
+    _local.pop(diagnostics_id, None)
+    _local[diagnostics_id] = (stored.version, index)
+    while len(_local) > MEMO_SIZE:
+        _local.pop(next(iter(_local)))
+    return index
@@ -0,0 +1,96 @@
+"""
+Запросы к интервальным таблицам состояний (PipeState, PipeLimit, NodeState)
+на произвольную дату.
+
+Запись действует в полуинтервале [start_date, end_date): при открытии новой
+записи предыдущая закрывается датой её начала, открытая запись не имеет
+end_date. Длительности состояний по месяцам считаются в БД одним
+сгруппированным запросом: для каждого месяца суммируется пересечение
+интервала записи с месяцем.
+"""
+import datetime as dt
+
+from django.db.models import (DateField, DurationField, ExpressionWrapper, F,
+                              Q, Sum, Value)
+from django.db.models.functions import Coalesce, Greatest, Least
+
+from pipelines.models import NodeState, PipeLimit, PipeState
+
+
+def active_on(queryset, date):
+    """Записи, действовавшие на дату"""
+    return queryset.filter(
+        Q(end_date__isnull=True) | Q(end_date__gt=date),
+        start_date__lte=date,
+    )
+
+
+def overlapping(queryset, start, end):
+    """Записи, пересекающиеся с полуинтервалом [start, end)"""
+    return queryset.filter(
+        Q(end_date__isnull=True) | Q(end_date__gt=start),
+        start_date__lt=end,
+    )
+
+
+def network_state(date, pipe_ids, node_ids):
+    """Состояния и ограничения участков и состояния узлов (и пограничных узлов) на дату"""
+    return {
+        "pipe_states": active_on(PipeState.objects.filter(pipe_id__in=pipe_ids), date),
+        "pipe_limits": active_on(PipeLimit.objects.filter(pipe_id__in=pipe_ids), date),
+        "node_states": active_on(
+            NodeState.objects.filter(
+                Q(node_id__in=node_ids) | Q(node__is_shared=True)
+            ),
+            date,
+        ),
+    }
+
+
+def month_starts(start, end):
+    """Первые числа месяцев, пересекающихся с [start, end), и дата end"""
+    months = []
+    month = start.replace(day=1)
+    while month < end:
+        months.append(month)
+        month = (month + dt.timedelta(days=32)).replace(day=1)
+    return months + [end]
+
+
+def state_durations(pipe_ids, start, end, today=None):
+    """
+    Число дней в каждом состоянии по участкам и месяцам периода [start, end).
+    Открытые состояния учитываются по сегодняшний день включительно.
+    Возвращает (месяцы, {pipe_id: {state_type: [дни по месяцам]}}).
+    """
+    today = today or dt.date.today()
+    bounds = month_starts(start, end)
+    months = bounds[:-1]
+    # Открытое состояние действует до завтрашнего дня (не включая), но не дольше периода
+    until = min(end, today + dt.timedelta(days=1))
+    state_end = Coalesce("end_date", Value(until, output_field=DateField()))
+    sums = {}
+    for i, (month_start, month_end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        month_start, month_end = max(month_start, start), min(month_end, end)
+        overlap = ExpressionWrapper(
+            Least(state_end, Value(month_end, output_field=DateField()))
+            - Greatest(F("start_date"), Value(month_start, output_field=DateField())),
+            output_field=DurationField(),
+        )
+        current = Q(end_date__gt=month_start)
+        if month_start < until:
+            # открытые состояния учитываются только до сегодняшнего дня
+            current |= Q(end_date__isnull=True, start_date__lt=until)
+        sums[f"month_{i}"] = Sum(overlap, filter=current & Q(start_date__lt=month_end))
+    rows = (
+        overlapping(PipeState.objects.filter(pipe_id__in=pipe_ids), start, end)
+        .order_by()
+        .values("pipe_id", "state_type")
+        .annotate(**sums)
+    )
+    durations = {}
+    for row in rows:
+        durations.setdefault(row["pipe_id"], {})[row["state_type"]] = [
+            row[f"month_{i}"].days if row[f"month_{i}"] else 0 for i in range(len(months))
+        ]
+    return months, durations
@@ -0,0 +1,159 @@
+"""
+Индекс объектов газопровода по километражу: «что находится на км X»
+и «что пересекается с отрезком [от, до]».
+
+Участки, зоны эксплуатирующих филиалов, крановые узлы, технологические
+отверстия, ремонты и запланированные работы газопровода собираются в одно
+статическое дерево интервалов: отрезки, отсортированные по началу, и дерево
+максимумов их концов. Запрос отбирает отрезки с началом не дальше конца
+запроса и спускается только в поддеревья, где есть концы не ближе его
+начала, так что время ответа растёт с числом найденных объектов, а не
+с размером газопровода. Точечные объекты (узлы, отверстия) — отрезки
+нулевой длины; ремонты и работы берут отрезок своего участка или точку узла.
+
+Индексы строятся по одному на газопровод при первом обращении и хранятся
+в памяти процесса под общей версией в БД (equipments.versions); версия
+меняется сигналами ниже при изменении любого из этих объектов, в том числе
+в других процессах.
+"""
+from bisect import bisect_right
+
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from equipments import versions
+from equipments.models import Department, Equipment
+
+from .models import Hole, Node, Pipe, PipeDepartment, PlannedWork, Repair
+
+VERSION_KEY = 'interval_index'
+
+# Группы объектов в ответе
+KINDS = ('pipes', 'departments', 'nodes', 'holes', 'repairs', 'planned_works')
+
+
+class IntervalIndex:
+    """Статическое дерево интервалов над отрезками (начало, конец, вид, данные)"""
+
+    def __init__(self, intervals):
+        self.intervals = sorted(intervals, key=lambda item: (item[0], item[1]))
+        self.starts = [item[0] for item in self.intervals]
+        self.size = 1
+        while self.size < len(self.intervals):
+            self.size *= 2
+        # max_end[узел] — наибольший конец отрезков поддерева, листья с позиции size
+        self.max_end = [float('-inf')] * (2 * self.size)
+        for i, item in enumerate(self.intervals):
+            self.max_end[self.size + i] = item[1]
+        for node in range(self.size - 1, 0, -1):
+            self.max_end[node] = max(self.max_end[2 * node], self.max_end[2 * node + 1])
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def overlap(self, start, end):
+        """Отрезки, пересекающиеся с [start, end] (концы включаются), в порядке начала"""
+        count = bisect_right(self.starts, end)
+        found = []
+        stack = [(1, 0, self.size)]
+        while stack:
+            node, lo, hi = stack.pop()
+            if lo >= count or self.max_end[node] < start:
+                continue
+            if node >= self.size:
+                found.append(self.intervals[lo])
+                continue
+            mid = (lo + hi) // 2
+            stack.append((2 * node + 1, mid, hi))
+            stack.append((2 * node, lo, mid))
+        return found
+
+
+def work_intervals(queryset, kind, fields):
+    """Ремонты и работы: отрезок участка или точка узла"""
+    intervals = []
+    for row in queryset.values(
+        'id', 'pipe_id', 'node_id', 'pipe__start_point', 'pipe__end_point',
+        'node__location_point', *fields,
+    ):
+        pipe_start, pipe_end = row.pop('pipe__start_point'), row.pop('pipe__end_point')
+        node_point = row.pop('node__location_point')
+        if row['pipe_id']:
+            intervals.append((pipe_start, pipe_end, kind, row))
+        else:
+            intervals.append((node_point, node_point, kind, row))
+    return intervals
+
+
+def build_index(pipeline_id):
+    intervals = []
+    pipe_points = {}
+    for row in Pipe.objects.filter(pipeline_id=pipeline_id).values(
+        'id', 'start_point', 'end_point', 'diameter', 'exploit_year'
+    ):
+        pipe_points[row['id']] = (row['start_point'], row['end_point'])
+        intervals.append((row['start_point'], row['end_point'], 'pipes', row))
+    for row in PipeDepartment.objects.filter(pipe__pipeline_id=pipeline_id).values(
+        'pipe_id', 'department_id', 'department__name', 'start_point', 'end_point'
+    ):
+        # зона без границ совпадает с участком
+        pipe_start, pipe_end = pipe_points[row['pipe_id']]
+        start = pipe_start if row['start_point'] is None else row['start_point']
+        end = pipe_end if row['end_point'] is None else row['end_point']
+        intervals.append((start, end, 'departments', {
+            'id': row['department_id'],
+            'name': row['department__name'],
+            'pipe_id': row['pipe_id'],
+            'start_point': start,
+            'end_point': end,
+        }))
+    for row in Node.objects.filter(pipeline_id=pipeline_id).values(
+        'id', 'node_type', 'location_point', 'is_shared', 'equipment_id', 'root_department_name'
+    ):
+        intervals.append((row['location_point'], row['location_point'], 'nodes', row))
+    for row in Hole.objects.filter(pipe__pipeline_id=pipeline_id).values(
+        'id', 'pipe_id', 'location_point', 'cutting_date', 'welding_date'
+    ):
+        intervals.append((row['location_point'], row['location_point'], 'holes', row))
+    for lookup in ({'pipe__pipeline_id': pipeline_id}, {'node__pipeline_id': pipeline_id}):
+        intervals += work_intervals(
+            Repair.objects.filter(**lookup), 'repairs', ('start_date', 'end_date')
+        )
+        intervals += work_intervals(
+            PlannedWork.objects.filter(**lookup), 'planned_works',
+            ('work_type', 'start_date', 'end_date', 'complex_plan_id'),
+        )
+    return IntervalIndex(intervals)
+
+
+# Индексы текущей версии в памяти процесса
+_local = {'version': None, 'indexes': {}}
+
+
+def invalidate(**kwargs):
+    """Меняет версию индексов; сигнатура позволяет подключать функцию к сигналам"""
+    versions.bump(VERSION_KEY)
+
+
+def get_index(pipeline_id):
+    version = versions.current(VERSION_KEY)
+    if _local['version'] != version:
+        _local['version'], _local['indexes'] = version, {}
+    index = _local['indexes'].get(pipeline_id)
+    if index is None:
+        index = _local['indexes'][pipeline_id] = build_index(pipeline_id)
+    return index
+
+
+def objects_at(pipeline_id, start, end=None):
+    """Объекты газопровода на км start или на отрезке [start, end], сгруппированные по виду"""
+    found = {kind: [] for kind in KINDS}
+    for _, _, kind, data in get_index(pipeline_id).overlap(start, start if end is None else end):
+        found[kind].append(data)
+    return found
+
+
+for model in (Pipe, PipeDepartment, Node, Hole, Repair, PlannedWork, Department):
+    post_save.connect(invalidate, sender=model, weak=False)
+    post_delete.connect(invalidate, sender=model, weak=False)
+# филиал узла (Node.root_department_name) следует за подразделениями оборудования
+m2m_changed.connect(invalidate, sender=Equipment.departments.through, weak=False)
@@ -0,0 +1,120 @@
+"""
+Подписи объектов в списках ремонтов и ВТД: корневые филиалы и газопровод
+участков, крановых узлов, ремонтов и ВТД.
+
+Подписи всех объектов сети собираются пятью запросами, корни подразделений
+берутся из дерева в памяти (equipments.trees) без get_root() на каждую
+строку. Подписи хранятся в памяти процесса под версией в БД
+(equipments.versions); версия меняется сигналами ниже при изменении
+газопроводов, участков, узлов, закрепления участков и оборудования за
+подразделениями, дерева подразделений и состава участков ВТД, в том числе
+в других процессах (import_ili). Ремонт подписывается по своему участку
+или узлу, поэтому отдельно не хранится.
+"""
+from dataclasses import dataclass
+
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from mptt.signals import node_moved
+
+from equipments import versions
+from equipments.models import Department, Equipment
+from equipments.trees import department_tree
+
+from .models import Diagnostics, Node, Pipe, PipeDepartment, Pipeline
+
+VERSION_KEY = 'object_labels'
+
+
+@dataclass(frozen=True)
+class ObjectLabel:
+    # названия корневых филиалов по алфавиту
+    roots: tuple
+    pipeline: str
+
+    def root_names(self, separator=' / '):
+        return separator.join(self.roots) if self.roots else '-'
+
+
+EMPTY_LABEL = ObjectLabel((), '-')
+
+# Подписи текущей версии в памяти процесса
+_local = {'version': None, 'labels': None}
+
+
+def invalidate(**kwargs):
+    """Меняет версию подписей; сигнатура позволяет подключать функцию к сигналам"""
+    versions.bump(VERSION_KEY)
+
+
+def root_names(department_ids):
+    return tuple(sorted({department_tree.root(pk).name for pk in department_ids}))
+
+
+def build_labels():
+    """Подписи всех участков, узлов и ВТД: {'pipe'|'node'|'diagnostics': {id: ObjectLabel}}"""
+    pipe_departments, equipment_departments, diagnostics_pipes = {}, {}, {}
+    for pipe_id, department_id in PipeDepartment.objects.values_list('pipe_id', 'department_id'):
+        pipe_departments.setdefault(pipe_id, set()).add(department_id)
+    for equipment_id, department_id in Equipment.departments.through.objects.values_list(
+        'equipment_id', 'department_id'
+    ):
+        equipment_departments.setdefault(equipment_id, set()).add(department_id)
+    for diagnostics_id, pipe_id in Diagnostics.pipes.through.objects.values_list(
+        'diagnostics_id', 'pipe_id'
+    ):
+        diagnostics_pipes.setdefault(diagnostics_id, []).append(pipe_id)
+
+    pipes = {
+        pk: ObjectLabel(root_names(pipe_departments.get(pk, ())), title)
+        for pk, title in Pipe.objects.values_list('id', 'pipeline__title')
+    }
+    nodes = {}
+    for pk, node_type, title, sub_title, equipment_id in Node.objects.values_list(
+        'id', 'node_type', 'pipeline__title', 'sub_pipeline__title', 'equipment_id'
+    ):
+        if node_type == 'bridge' and sub_title:
+            title = f'{title}  /  {sub_title}'
+        nodes[pk] = ObjectLabel(root_names(equipment_departments.get(equipment_id, ())), title)
+    diagnostics = {}
+    for pk, pipe_ids in diagnostics_pipes.items():
+        titles = {pipes[pipe_id].pipeline for pipe_id in pipe_ids}
+        diagnostics[pk] = ObjectLabel(
+            tuple(sorted({root for pipe_id in pipe_ids for root in pipes[pipe_id].roots})),
+            titles.pop() if len(titles) == 1 else f'Несколько ({len(titles)})',
+        )
+    return {'pipe': pipes, 'node': nodes, 'diagnostics': diagnostics}
+
+
+def get_labels():
+    version = versions.current(VERSION_KEY)
+    if _local['version'] != version:
+        _local['version'], _local['labels'] = version, build_labels()
+    return _local['labels']
+
+
+def pipe_label(pipe_id):
+    return get_labels()['pipe'].get(pipe_id, EMPTY_LABEL)
+
+
+def node_label(node_id):
+    return get_labels()['node'].get(node_id, EMPTY_LABEL)
+
+
+def diagnostics_label(diagnostics_id):
+    return get_labels()['diagnostics'].get(diagnostics_id, EMPTY_LABEL)
+
+
+def repair_label(repair):
+    if repair.pipe_id:
+        return pipe_label(repair.pipe_id)
+    if repair.node_id:
+        return node_label(repair.node_id)
+    return EMPTY_LABEL
+
+
+for model in (Pipeline, Pipe, PipeDepartment, Node, Department):
+    post_save.connect(invalidate, sender=model, weak=False)
+    post_delete.connect(invalidate, sender=model, weak=False)
+node_moved.connect(invalidate, sender=Department, weak=False)
+for through in (Equipment.departments.through, Diagnostics.pipes.through):
+    m2m_changed.connect(invalidate, sender=through, weak=False)
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pipelines.alignment import align_runs
+from pipelines.models import Diagnostics
+
+
+class Command(BaseCommand):
+    help = "Сопоставляет трубы и аномалии двух ВТД и рассчитывает скорость роста аномалий"
+
+    def add_arguments(self, parser):
+        parser.add_argument("earlier", type=int, help="ID предыдущей ВТД")
+        parser.add_argument("later", type=int, help="ID последующей ВТД")
+
+    def handle(self, *args, **options):
+        diagnostics = Diagnostics.objects.in_bulk([options["earlier"], options["later"]])
+        missing = {options["earlier"], options["later"]} - set(diagnostics)
+        if missing:
+            raise CommandError(f"ВТД не найдены: {', '.join(map(str, sorted(missing)))}")
+        started = time.monotonic()
+        try:
+            alignment = align_runs(diagnostics[options["earlier"]], diagnostics[options["later"]])
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            f"Сопоставлено труб {alignment.tube_count}, аномалий {alignment.anomaly_count} "
+            f"за {time.monotonic() - started:.1f} с (интервал {alignment.years:.1f} лет)"
+        ))
@@ -0,0 +1,60 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pipelines.assessment import assess_diagnostics
+from pipelines.clustering import cluster_diagnostics
+from pipelines.models import AnomalyAssessment, Diagnostics
+
+
+class Command(BaseCommand):
+    help = "Рассчитывает разрушающее давление и ERF аномалий потери металла ВТД"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "ids",
+            nargs="*",
+            type=int,
+            help="ID диагностик",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Пересчитать все диагностики",
+        )
+        parser.add_argument(
+            "--top",
+            type=int,
+            default=10,
+            help="Сколько аномалий с наибольшим ERF вывести",
+        )
+
+    def handle(self, *args, **options):
+        if options["all"]:
+            diagnostics = Diagnostics.objects.all()
+        elif options["ids"]:
+            diagnostics = Diagnostics.objects.filter(id__in=options["ids"])
+        else:
+            raise CommandError("Укажите ID диагностик или --all")
+        for item in diagnostics:
+            self.assess(item, options["top"])
+
+    def assess(self, diagnostics, top):
+        started = time.monotonic()
+        clusters = cluster_diagnostics(diagnostics)
+        count = assess_diagnostics(diagnostics)
+        assessments = AnomalyAssessment.objects.filter(diagnostics=diagnostics)
+        self.stdout.write(
+            f"ВТД id={diagnostics.id}: оценено аномалий {count}, групп взаимодействующих {clusters}, "
+            f"безопасное давление ниже рабочего {assessments.filter(exceeds_limit=True).count()} "
+            f"({time.monotonic() - started:.1f} с)"
+        )
+        ranked = assessments.select_related("anomaly__tube__tube").order_by("-exceeds_limit", "-erf")
+        for assessment in ranked[:top]:
+            anomaly = assessment.anomaly
+            erf = "-" if assessment.erf is None else f"{assessment.erf:.2f}"
+            self.stdout.write(
+                f"  {anomaly.odometr_data} м, труба {anomaly.tube.tube.tube_num}: "
+                f"глубина {anomaly.anomaly_depth}%, длина {anomaly.anomaly_length} мм, "
+                f"Pбез {assessment.safe_pressure:.1f} кгс/см², ERF {erf}"
+            )
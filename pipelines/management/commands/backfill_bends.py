@@ -0,0 +1,57 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from pipelines.models import Bend
+
+# Поля, вычисляемые из радиуса и комментария (Bend.fill_derived)
+DERIVED_FIELDS = (
+    "radius_in_diameters",
+    "max_stress_coordinate",
+    "max_stress_orientation",
+    "deflection",
+)
+
+
+class Command(BaseCommand):
+    help = "Заполняет радиус в диаметрах и данные из комментария для загруженных отводов"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--diagnostics",
+            nargs="*",
+            type=int,
+            help="ID диагностик (по умолчанию все отводы)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=2000,
+            help="Размер пакета обновления",
+        )
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        bends = Bend.objects.select_related("tube").only(
+            "radius", "comment", "tube__diameter", *DERIVED_FIELDS
+        ).order_by("pk")
+        if options["diagnostics"]:
+            bends = bends.filter(tube__diagnostics_id__in=options["diagnostics"])
+        batch_size = options["batch_size"]
+        total, changed = 0, []
+        updated = 0
+        for bend in bends.iterator(chunk_size=batch_size):
+            total += 1
+            before = [getattr(bend, field) for field in DERIVED_FIELDS]
+            bend.fill_derived()
+            if [getattr(bend, field) for field in DERIVED_FIELDS] != before:
+                changed.append(bend)
+            if len(changed) >= batch_size:
+                updated += Bend.objects.bulk_update(changed, DERIVED_FIELDS)
+                changed = []
+        if changed:
+            updated += Bend.objects.bulk_update(changed, DERIVED_FIELDS)
+        self.stdout.write(self.style.SUCCESS(
+            f"Проверено отводов {total}, обновлено {updated} "
+            f"за {time.monotonic() - started:.1f} с"
+        ))
@@ -0,0 +1,113 @@
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pipelines.assessment import assess_diagnostics
+from pipelines.calibration import calibrate
+from pipelines.clustering import cluster_diagnostics
+from pipelines.geo import build_index
+from pipelines.models import BendSpatialIndex, OdometerCalibration
+from pipelines.utils import DATA, DATA_DIR, IliImporter, survey_files
+
+
+class Command(BaseCommand):
+    help = "Импортирует отчёты ВТД (трубы, элементы обустройства, аномалии, отводы) из xlsx"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "names",
+            nargs="*",
+            help="Имена отчётов из pipelines.utils.DATA, например nord_uu",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Импортировать все отчёты из DATA",
+        )
+        parser.add_argument(
+            "--data-dir",
+            default=str(DATA_DIR),
+            help="Каталог с папками отчётов",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=2000,
+            help="Размер пакета bulk_create",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="Число процессов для разбора файлов (1 — без пула процессов)",
+        )
+        parser.add_argument(
+            "--replace",
+            action="store_true",
+            help="Заменить ранее импортированные версии труб этой диагностики",
+        )
+
+    def handle(self, *args, **options):
+        surveys = {survey['name']: survey for survey in DATA}
+        names = list(surveys) if options["all"] else options["names"]
+        if not names:
+            raise CommandError("Укажите имена отчётов или --all")
+        unknown = [name for name in names if name not in surveys]
+        if unknown:
+            raise CommandError(f"Неизвестные отчёты: {', '.join(unknown)}")
+        for name in names:
+            self.import_survey(surveys[name], options)
+
+    def import_survey(self, survey, options):
+        files = {
+            kind: path if path.exists() else None
+            for kind, path in survey_files(survey['name'], Path(options["data_dir"])).items()
+        }
+        if files['tubes'] is None:
+            raise CommandError(f"Нет файла труб для отчёта {survey['name']}")
+        importer = IliImporter(
+            survey['pipe_ranges'],
+            survey['diagnostics_start'],
+            survey['diagnostics_end'],
+            batch_size=options["batch_size"],
+            replace=options["replace"],
+            workers=options["workers"],
+        )
+        self.stdout.write(f"Импорт отчёта {survey['name']}...")
+        started = time.monotonic()
+        try:
+            diagnostics = importer.run(files)
+        except ValueError as e:
+            raise CommandError(str(e))
+        for warning in importer.warnings:
+            self.stdout.write(self.style.WARNING(warning))
+        for stat in importer.stats:
+            seconds = stat['parse_seconds'] + stat['write_seconds']
+            rate = stat['rows'] / seconds if seconds else 0
+            self.stdout.write(
+                f"  {stat['file']}: строк {stat['rows']}, создано {stat['created']}, "
+                f"ошибок {len(stat['errors'])}, разбор {stat['parse_seconds']:.1f} с, "
+                f"запись {stat['write_seconds']:.1f} с ({rate:.0f} строк/с)"
+            )
+            for line, error in stat['errors'][:10]:
+                self.stdout.write(self.style.WARNING(f"    строка {line}: {error}"))
+        self.stdout.write(self.style.SUCCESS(
+            f"Отчёт {survey['name']} импортирован за {time.monotonic() - started:.1f} с, "
+            f"диагностика id={diagnostics.id}"
+        ))
+        started = time.monotonic()
+        clusters = cluster_diagnostics(diagnostics)
+        count = assess_diagnostics(diagnostics)
+        self.stdout.write(
+            f"  оценка аномалий потери металла: {count}, групп взаимодействующих {clusters}, "
+            f"за {time.monotonic() - started:.1f} с"
+        )
+        # привязка к километражу и индекс координат отводов строятся здесь,
+        # а не первым запросом
+        started = time.monotonic()
+        OdometerCalibration.rebuild([diagnostics.id], calibrate)
+        BendSpatialIndex.rebuild([diagnostics.id], build_index)
+        self.stdout.write(
+            f"  привязка к километражу и индекс отводов за {time.monotonic() - started:.1f} с"
+        )
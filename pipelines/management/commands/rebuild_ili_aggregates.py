@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pipelines.calibration import calibrate
+from pipelines.geo import build_index
+from pipelines.models import BendSpatialIndex, Diagnostics, OdometerCalibration
+
+
+class Command(BaseCommand):
+    help = (
+        "Строит и сохраняет привязку к километражу и индекс координат отводов ВТД, "
+        "загруженных до их появления или не собранных с действующей версией"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "ids",
+            nargs="*",
+            type=int,
+            help="ID диагностик",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Все диагностики",
+        )
+
+    def handle(self, *args, **options):
+        if options["all"]:
+            diagnostics = Diagnostics.objects.all()
+        elif options["ids"]:
+            diagnostics = Diagnostics.objects.filter(id__in=options["ids"])
+        else:
+            raise CommandError("Укажите ID диагностик или --all")
+        ids = list(diagnostics.order_by("id").values_list("id", flat=True))
+        started = time.monotonic()
+        # собранные с действующей версией не пересчитываются
+        OdometerCalibration.rebuild(ids, calibrate)
+        BendSpatialIndex.rebuild(ids, build_index)
+        self.stdout.write(self.style.SUCCESS(
+            f"ВТД: {len(ids)}, привязок к километражу: "
+            f"{OdometerCalibration.objects.filter(diagnostics_id__in=ids).count()}, "
+            f"индексов отводов: {BendSpatialIndex.objects.filter(diagnostics_id__in=ids).count()} "
+            f"за {time.monotonic() - started:.1f} с"
+        ))
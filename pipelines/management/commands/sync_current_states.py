@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from pipelines.models import (Diagnostics, DiagnosticStats, Node, NodeState,
+                              Pipe, PipeLimit, PipeState, Tube)
+
+
+class Command(BaseCommand):
+    help = (
+        "Заполняет указатели текущих состояний участков и крановых узлов, "
+        "последних версий труб, филиалы крановых узлов и статистику ВТД"
+    )
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        # открытые записи по объекту; при нескольких открытых берётся последняя по start_date
+        pipe_states = dict(
+            PipeState.objects.filter(end_date__isnull=True)
+            .order_by('pipe_id', 'start_date', 'id')
+            .values_list('pipe_id', 'id')
+        )
+        pipe_limits = dict(
+            PipeLimit.objects.filter(end_date__isnull=True)
+            .order_by('pipe_id', 'start_date', 'id')
+            .values_list('pipe_id', 'id')
+        )
+        node_states = dict(
+            NodeState.objects.filter(end_date__isnull=True)
+            .order_by('node_id', 'start_date', 'id')
+            .values_list('node_id', 'id')
+        )
+        pipes = list(Pipe.objects.only('id'))
+        for pipe in pipes:
+            pipe.current_state_id = pipe_states.get(pipe.id)
+            pipe.current_limit_id = pipe_limits.get(pipe.id)
+        Pipe.objects.bulk_update(pipes, ['current_state', 'current_limit'], batch_size=500)
+        nodes = list(Node.objects.only('id'))
+        for node in nodes:
+            node.current_state_id = node_states.get(node.id)
+        Node.objects.bulk_update(nodes, ['current_state'], batch_size=500)
+        tubes = Tube.refresh_latest_versions()
+        node_roots = Node.refresh_root_departments()
+        # списки ВТД статистику не записывают, она пересчитывается после изменений
+        stats = DiagnosticStats.refresh(Diagnostics.objects.values_list('id', flat=True))
+        self.stdout.write(self.style.SUCCESS(
+            f'Обновлено участков: {len(pipes)}, крановых узлов: {len(nodes)}, труб: {tubes}, '
+            f'филиалов узлов: {node_roots}, статистики ВТД: {len(stats)}'
+        ))
@@ -1,13 +1,19 @@
 import datetime as dt
+import re
+import uuid
 from datetime import datetime, timedelta
+from functools import partial
 
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, F, OuterRef, Subquery, Value, When
+from django.db.models.functions import Cast, Concat
 from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
 from django.utils.timezone import now
 
-from equipments.models import Department, Equipment
+from equipments import versions
+from equipments.models import CacheVersion, Department, Equipment
 from users.models import ModuleUser
 
 
@@ -47,6 +53,25 @@ class Pipe(models.Model):
     exploit_year = models.PositiveIntegerField(
         "Год ввода в эксплуатацию", blank=True, null=True
     )
+    # Указатели на открытые записи, поддерживаются в PipeState.save / PipeLimit.save
+    current_state = models.ForeignKey(
+        "PipeState",
+        on_delete=models.SET_NULL,
+        related_name="+",
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name="Текущее состояние",
+    )
+    current_limit = models.ForeignKey(
+        "PipeLimit",
+        on_delete=models.SET_NULL,
+        related_name="+",
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name="Текущее ограничение",
+    )
 
     class Meta:
         verbose_name = "Участок газопровода"
@@ -58,10 +83,6 @@ class Pipe(models.Model):
             models.Index(fields=["diameter"]),
         ]
 
-    @property
-    def current_state(self):
-        return self.states.filter(end_date__isnull=True).first()
-
     def __str__(self):
         return f'{self.start_point}-{self.end_point} км г-да "{self.pipeline}"'
 
@@ -98,6 +119,23 @@ class PipeDepartment(models.Model):
         return f"{self.pipe} - {self.department}"
 
 
+def root_departments(equipment_ids):
+    """
+    Филиалы оборудования двумя запросами: корень дерева первого по порядку
+    деревьев подразделения оборудования. Возвращает {equipment_id: Department}.
+    """
+    tree_ids = {}
+    for equipment_id, tree_id in Equipment.departments.through.objects.filter(
+        equipment_id__in=equipment_ids
+    ).values_list("equipment_id", "department__tree_id"):
+        tree_ids[equipment_id] = min(tree_id, tree_ids.get(equipment_id, tree_id))
+    roots = {
+        root.tree_id: root
+        for root in Department.objects.filter(tree_id__in=set(tree_ids.values()), level=0)
+    }
+    return {equipment_id: roots[tree_id] for equipment_id, tree_id in tree_ids.items()}
+
+
 class Node(models.Model):
     TYPE_CHOICES = [
         ("valve", "Линейный кран"),
@@ -149,6 +187,30 @@ class Node(models.Model):
         null=False,
         help_text="Расположен на участке совместной эксплуатации",
     )
+    # Указатель на открытое состояние, поддерживается в NodeState.save
+    current_state = models.ForeignKey(
+        "NodeState",
+        on_delete=models.SET_NULL,
+        related_name="+",
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name="Текущее состояние",
+    )
+    # Филиал оборудования узла, поддерживается в save и сигналами изменения
+    # подразделений оборудования и дерева подразделений
+    root_department = models.ForeignKey(
+        Department,
+        on_delete=models.SET_NULL,
+        related_name="+",
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name="Филиал",
+    )
+    root_department_name = models.CharField(
+        max_length=50, blank=True, editable=False, verbose_name="Название филиала"
+    )
 
     class Meta:
         verbose_name = "Крановый узел"
@@ -173,16 +235,33 @@ class Node(models.Model):
 
     def save(self, *args, **kwargs):
         self.full_clean()
+        self.root_department = root_departments([self.equipment_id]).get(self.equipment_id)
+        self.root_department_name = self.root_department.name if self.root_department else ""
         super().save(*args, **kwargs)
 
+    @classmethod
+    def refresh_root_departments(cls, queryset=None):
+        """
+        Пересчитывает филиалы узлов queryset, сохраняет только изменившиеся.
+        Возвращает число обновлённых узлов.
+        """
+        if queryset is None:
+            queryset = cls.objects.all()
+        nodes = list(
+            queryset.only("id", "equipment_id", "root_department_id", "root_department_name")
+        )
+        roots = root_departments({node.equipment_id for node in nodes})
+        changed = []
+        for node in nodes:
+            root = roots.get(node.equipment_id)
+            values = (root.pk, root.name) if root else (None, "")
+            if (node.root_department_id, node.root_department_name) != values:
+                node.root_department_id, node.root_department_name = values
+                changed.append(node)
+        cls.objects.bulk_update(changed, ["root_department", "root_department_name"], batch_size=500)
+        return len(changed)
+
     def __str__(self):
-        departments = self.equipment.departments.all()
-        root_department = None
-        if departments.exists():
-            root_department = (
-                departments.order_by("tree_id", "level").first().get_root()
-            )
-        department_name = root_department.name if root_department else "-"
         if self.node_type == "bridge":
             return f'Перемычка {self.location_point} км между "{self.pipeline}" и "{self.sub_pipeline}"'
         else:
@@ -191,10 +270,6 @@ class Node(models.Model):
                 f'{node_type_display} {self.location_point} км г-да "{self.pipeline}"'
             )
 
-    # @property
-    # def current_state(self):
-    #     return self.states.filter('timestamp').first()
-
 
 class Repair(models.Model):
     pipe = models.ForeignKey(
@@ -292,6 +367,16 @@ class Tube(models.Model):
     active = models.BooleanField(default=True, verbose_name="Актуальная труба")
     installed_date = models.DateField("Дата установки", null=True, blank=True)
     removed_date = models.DateField("Дата удаления", null=True, blank=True)
+    # Последняя по дате версия, поддерживается в TubeVersion.save и сигналом удаления
+    latest_version = models.ForeignKey(
+        "TubeVersion",
+        on_delete=models.SET_NULL,
+        related_name="+",
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name="Последняя версия",
+    )
 
     class Meta:
         verbose_name = "Труба (физическая)"
@@ -301,6 +386,21 @@ class Tube(models.Model):
     def __str__(self):
         return f"Труба №{self.tube_num} ({'активна' if self.active else 'удалена'})"
 
+    @classmethod
+    def refresh_latest_versions(cls, queryset=None):
+        """
+        Пересчитывает latest_version одним UPDATE для всех труб queryset.
+        Нужен после bulk_create версий, которые не вызывают save().
+        """
+        if queryset is None:
+            queryset = cls.objects.all()
+        latest = (
+            TubeVersion.objects.filter(tube=OuterRef("pk"))
+            .order_by("-date", "-id")
+            .values("id")[:1]
+        )
+        return queryset.update(latest_version=Subquery(latest))
+
 
 class TubeVersion(models.Model):
     TUBE_TYPE = [
@@ -463,10 +563,18 @@ class TubeVersion(models.Model):
         verbose_name = "Труба (элемент ВТД)"
         verbose_name_plural = "Трубы (элементы ВТД)"
         ordering = ["tube"]
+        indexes = [
+            # постраничный вывод труб ВТД по курсору одометра
+            models.Index(fields=["diagnostics", "odometr_data", "id"]),
+        ]
 
     def __str__(self):
         return f"Элемент ВТД №{self.tube.tube_num}, участок {self.tube.pipe}"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        Tube.refresh_latest_versions(Tube.objects.filter(pk=self.tube_id))
+
 
 class TubeUnit(models.Model):
     UNIT_TYPE = [
@@ -513,6 +621,9 @@ class TubeUnit(models.Model):
     class Meta:
         verbose_name = "Элемент обустройства"
         verbose_name_plural = "Элементы обустройства"
+        indexes = [
+            models.Index(fields=["odometr_data", "id"]),
+        ]
 
     def __str__(self):
         return f"{self.unit_type}, {self.tube}"
@@ -689,6 +800,16 @@ class Anomaly(models.Model):
         blank=True,
         null=True,
     )
+    # Группа взаимодействующих аномалий (pipelines.clustering), пусто для одиночных
+    cluster = models.ForeignKey(
+        "AnomalyCluster",
+        on_delete=models.SET_NULL,
+        related_name="anomalies",
+        verbose_name="Группа аномалий",
+        blank=True,
+        null=True,
+        editable=False,
+    )
 
     class Meta:
         verbose_name = "Аномалия"
@@ -703,6 +824,28 @@ class Anomaly(models.Model):
         return f'Аномалия на трубе №{self.tube.tube.tube_num if self.tube else "N/A"}'
 
 
+# Данные отвода в комментарии отчёта ВТД, например:
+# "Радиус изгиба=383 D, координата=6562.31, максимальное растяжение на 0.1 час. Прогиб 155.24 мм."
+# "Отвод выпуклый вправо. Радиус отвода равен 45.7 Дн."
+BEND_COMMENT = re.compile(
+    r"радиус (?:изгиба\s*=|отвода равен)\s*(?P<radius_in_diameters>\d+(?:\.\d+)?)\s*(?:d|дн)"
+    r"|координата\s*=\s*(?P<max_stress_coordinate>\d+(?:\.\d+)?)"
+    r"|растяжение на\s*(?P<max_stress_orientation>\d+(?:\.\d+)?)\s*час"
+    r"|прогиб\s*(?P<deflection>\d+(?:\.\d+)?)\s*мм",
+    re.IGNORECASE,
+)
+
+
+def parse_bend_comment(comment):
+    """Значения полей отвода, найденные в комментарии, за один проход"""
+    values = {}
+    for match in BEND_COMMENT.finditer(comment or ""):
+        field = match.lastgroup
+        value = match.group(field)
+        values[field] = value if field == "max_stress_orientation" else float(value)
+    return values
+
+
 class Bend(models.Model):
     BEND_TYPE_CHOICES = [
         ("elastic_plastic", "Упруго-пластический изгиб"),
@@ -844,71 +987,20 @@ class Bend(models.Model):
         return f"Отвод трубы №{self.tube_num or self.tube.tube.tube_num} ({self.start_point}-{self.end_point} м)"
 
     def save(self, *args, **kwargs):
-        # Автоматическое вычисление радиуса в диаметрах
-        if self.radius and self.tube and self.tube.diameter:
-            self.radius_in_diameters = self.radius / (
-                self.tube.diameter / 1000
-            )  # переводим мм в метры
-
-        # Парсинг комментария для извлечения дополнительных данных
-        if self.comment:
-            self._parse_comment()
-
+        self.fill_derived()
         super().save(*args, **kwargs)
 
     def _parse_comment(self):
         """Парсинг комментария для автоматического извлечения данных"""
-        comment = self.comment.lower()
+        for field, value in parse_bend_comment(self.comment).items():
+            setattr(self, field, value)
 
-        # Извлечение радиуса в диаметрах
-        if "радиус изгиба=" in comment and "d" in comment:
-            try:
-                start = comment.find("радиус изгиба=") + len("радиус изгиба=")
-                end = comment.find("d", start)
-                radius_d = comment[start:end].strip()
-                if radius_d.replace(".", "").isdigit():
-                    self.radius_in_diameters = float(radius_d)
-            except (ValueError, IndexError):
-                pass
-
-        # Извлечение координаты максимального растяжения
-        if "координата=" in comment:
-            try:
-                start = comment.find("координата=") + len("координата=")
-                end = comment.find(",", start)
-                coord = comment[start:end].strip()
-                if coord.replace(".", "").isdigit():
-                    self.max_stress_coordinate = float(coord)
-            except (ValueError, IndexError):
-                pass
-
-        # Извлечение ориентации максимального растяжения
-        if "растяжение на" in comment and "час" in comment:
-            try:
-                start = comment.find("растяжение на") + len("растяжение на")
-                end = comment.find("час", start)
-                orientation = comment[start:end].strip()
-                if orientation.replace(".", "").isdigit():
-                    self.max_stress_orientation = orientation
-            except (ValueError, IndexError):
-                pass
-
-        # Извлечение прогиба
-        if "прогиб" in comment and "мм" in comment:
-            try:
-                start = comment.find("прогиб") + len("прогиб")
-                end = comment.find("мм", start)
-                deflection_str = comment[start:end].strip().split()[-1]
-                if deflection_str.replace(".", "").isdigit():
-                    self.deflection = float(deflection_str)
-            except (ValueError, IndexError):
-                pass
-
-        # Определение направления выпуклости
-        if "выпуклый вправо" in comment:
-            self.convex_direction = "вправо"
-        elif "выпуклый влево" in comment:
-            self.convex_direction = "влево"
+    def fill_derived(self):
+        """Радиус в диаметрах и данные из комментария (без сохранения)"""
+        if self.radius and self.tube and self.tube.diameter:
+            self.radius_in_diameters = self.radius / (self.tube.diameter / 1000)
+        if self.comment:
+            self._parse_comment()
 
     # @property
     # def length(self):
@@ -1114,6 +1206,60 @@ class RepairDocument(models.Model):
         verbose_name_plural = "Документация по ремонтам участков МГ"
 
 
+def set_current_pointer(model, field, pk, record):
+    """
+    Указатель model.field объекта pk на открытую запись; закрытие записи
+    сбрасывает указатель, только если он вёл на неё (правка старой закрытой
+    записи не трогает текущую).
+    """
+    if record.end_date is None:
+        model.objects.filter(pk=pk).update(**{field: record})
+    else:
+        model.objects.filter(pk=pk, **{field: record}).update(**{field: None})
+
+
+def set_current_pointers(model, field, records):
+    """
+    Одним запросом ставит указатели на открытые записи (model.field) по парам
+    (id объекта, запись); для закрытых записей указатель сбрасывается.
+    """
+    if not records:
+        return
+    model.objects.filter(pk__in=[pk for pk, _ in records]).update(**{
+        field: Case(
+            *[
+                When(pk=pk, then=Value(record.pk if record.end_date is None else None))
+                for pk, record in records
+            ],
+            output_field=models.BigIntegerField(),
+        )
+    })
+
+
+class SchemeRevision(models.Model):
+    """Сквозной счётчик изменений состояний схемы (курсор для ленты изменений)"""
+    value = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Ревизия схемы"
+        verbose_name_plural = "Ревизии схемы"
+
+    @classmethod
+    def next_value(cls):
+        """
+        Увеличивает счётчик и возвращает новое значение.
+        Вызывать внутри транзакции: блокировка строки держится до коммита,
+        поэтому ревизии фиксируются в порядке возрастания.
+        """
+        cls.objects.get_or_create(pk=1)
+        cls.objects.filter(pk=1).update(value=F("value") + 1)
+        return cls.objects.values_list("value", flat=True).get(pk=1)
+
+    @classmethod
+    def current_value(cls):
+        return cls.objects.filter(pk=1).values_list("value", flat=True).first() or 0
+
+
 class PipeState(models.Model):
     STATE_CHOICES = [
         ("repair", "В ремонте"),
@@ -1152,6 +1298,9 @@ class PipeState(models.Model):
     current_pressure = models.FloatField(
         verbose_name="Давление, кгс/см²", null=True, blank=True
     )
+    revision = models.PositiveBigIntegerField(
+        verbose_name="Ревизия", default=0, db_index=True, editable=False
+    )
 
     class Meta:
         ordering = ["-start_date"]
@@ -1162,6 +1311,8 @@ class PipeState(models.Model):
             models.Index(fields=["state_type"]),
             models.Index(fields=["start_date", "end_date"]),
             models.Index(fields=["created_by"]),
+            # запросы на дату и за период (pipelines.history)
+            models.Index(fields=["pipe", "start_date", "end_date"]),
         ]
 
     def __str__(self):
@@ -1175,11 +1326,36 @@ class PipeState(models.Model):
     #     if self.end_date and self.end_date < self.start_date:
     #         raise ValidationError('Дата окончания не может быть раньше даты начала')
 
+    @transaction.atomic
     def save(self, *args, **kwargs):
+        self.revision = SchemeRevision.next_value()
         PipeState.objects.filter(pipe=self.pipe, end_date__isnull=True).exclude(
             pk=self.pk
-        ).update(end_date=self.start_date)
+        ).update(end_date=self.start_date, revision=self.revision)
         super().save(*args, **kwargs)
+        set_current_pointer(Pipe, "current_state", self.pipe_id, self)
+
+    @classmethod
+    @transaction.atomic
+    def bulk_change(cls, states):
+        """
+        Сохраняет новые состояния нескольких участков (по одному на участок)
+        под одной ревизией. Как save(), но предыдущие состояния закрываются,
+        а указатели Pipe.current_state обновляются общими запросами.
+        bulk_create не отправляет сигналы, вызывающий сбрасывает кэши сам.
+        """
+        revision = SchemeRevision.next_value()
+        pipes_by_date = {}
+        for state in states:
+            state.revision = revision
+            pipes_by_date.setdefault(state.start_date, []).append(state.pipe_id)
+        for start_date, pipe_ids in pipes_by_date.items():
+            cls.objects.filter(pipe_id__in=pipe_ids, end_date__isnull=True).update(
+                end_date=start_date, revision=revision
+            )
+        cls.objects.bulk_create(states)
+        set_current_pointers(Pipe, "current_state", [(state.pipe_id, state) for state in states])
+        return states
 
 
 class PipeLimit(models.Model):
@@ -1201,23 +1377,32 @@ class PipeLimit(models.Model):
         blank=True,
         help_text="Указывается когда ограничение фактически будет снято",
     )
+    revision = models.PositiveBigIntegerField(
+        verbose_name="Ревизия", default=0, db_index=True, editable=False
+    )
 
     class Meta:
         ordering = ["-start_date"]
         verbose_name = "Ограничение давления"
         verbose_name_plural = "Ограничения давления"
+        indexes = [
+            models.Index(fields=["pipe", "start_date", "end_date"]),
+        ]
 
     def __str__(self):
         return f"Ограничение {self.pressure_limit} кгс/см² ({self.pipe}) с {self.start_date}"
 
+    @transaction.atomic
     def save(self, *args, **kwargs):
+        self.revision = SchemeRevision.next_value()
         # Закрываем предыдущие активные ограничения
         if self.start_date and self.pipe:
             PipeLimit.objects.filter(pipe=self.pipe, end_date__isnull=True).exclude(
                 pk=self.pk
-            ).update(end_date=self.start_date)
+            ).update(end_date=self.start_date, revision=self.revision)
         self.full_clean()
         super().save(*args, **kwargs)
+        set_current_pointer(Pipe, "current_limit", self.pipe_id, self)
 
 
 class NodeState(models.Model):
@@ -1240,6 +1425,9 @@ class NodeState(models.Model):
     description = models.TextField(
         verbose_name="Комментарий", max_length=500, blank=True
     )
+    revision = models.PositiveBigIntegerField(
+        verbose_name="Ревизия", default=0, db_index=True, editable=False
+    )
 
     class Meta:
         ordering = ["-start_date"]
@@ -1250,17 +1438,596 @@ class NodeState(models.Model):
             models.Index(fields=["state_type"]),
             models.Index(fields=["start_date"]),
             models.Index(fields=["changed_by"]),
+            models.Index(fields=["node", "start_date", "end_date"]),
         ]
 
     def __str__(self):
         return f"{self.node} - {self.get_state_type_display()}"
 
+    @transaction.atomic
     def save(self, *args, **kwargs):
+        self.revision = SchemeRevision.next_value()
         NodeState.objects.filter(node=self.node, end_date__isnull=True).exclude(
             pk=self.pk
-        ).update(end_date=now().date())
+        ).update(end_date=now().date(), revision=self.revision)
 
         super().save(*args, **kwargs)
+        set_current_pointer(Node, "current_state", self.node_id, self)
+
+    @classmethod
+    @transaction.atomic
+    def bulk_change(cls, states):
+        """Сохраняет новые состояния нескольких узлов, см. PipeState.bulk_change"""
+        revision = SchemeRevision.next_value()
+        for state in states:
+            state.revision = revision
+        cls.objects.filter(
+            node_id__in=[state.node_id for state in states], end_date__isnull=True
+        ).update(end_date=now().date(), revision=revision)
+        cls.objects.bulk_create(states)
+        set_current_pointers(Node, "current_state", [(state.node_id, state) for state in states])
+        return states
+
+
+class VersionedCache(models.Model):
+    """
+    Данные, собранные по другим таблицам и сохранённые с версией ключа
+    (equipments.versions), прочитанной до сборки: запись отдаётся, пока
+    версия не сменилась. Подклассы задают VERSION_KEY.
+    """
+    version = models.CharField(max_length=32, blank=True, verbose_name="Версия")
+    created_at = models.DateTimeField(auto_now=True, verbose_name="Дата формирования")
+
+    VERSION_KEY = None
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def version_key(cls, diagnostics_id):
+        return versions.object_key(cls.VERSION_KEY, diagnostics_id)
+
+    @classmethod
+    def fresh(cls, key, **filters):
+        """Записи, сохранённые с действующей версией ключа key"""
+        return cls.objects.filter(version=versions.stored(key), **filters)
+
+    @classmethod
+    def get_or_build(cls, key, build, save=True, **lookup):
+        """
+        Запись lookup с действующей версией ключа key; при отсутствии
+        build() возвращает значения полей, и запись сохраняется с версией,
+        прочитанной до сборки. save=False — собранная запись не сохраняется
+        (чтение, данные записываются после коммита изменений).
+        """
+        stored = cls.fresh(key, **lookup).first()
+        if stored is None:
+            version = versions.read(key)
+            if not save:
+                return cls(**lookup, **build(), version=version)
+            stored, _ = cls.objects.update_or_create(
+                defaults={**build(), "version": version}, **lookup
+            )
+        return stored
+
+    @classmethod
+    def invalidate(cls, diagnostics_ids=(), build=None):
+        """
+        Сбрасывает данные ВТД. Версия меняется после коммита: данные, собранные
+        до изменения и записанные после сброса, не отдаются. build(diagnostics_id) —
+        сборка значений полей: данные пересобираются после коммита, а не при чтении.
+
+        Сброшенные в транзакции ВТД копятся на соединении: после коммита версия
+        каждого ключа меняется и данные пересобираются один раз, сколько бы
+        записей транзакция ни изменила.
+        """
+        diagnostics_ids = list(diagnostics_ids)
+        if not diagnostics_ids:
+            return
+        cls.objects.filter(diagnostics_id__in=diagnostics_ids).delete()
+        connection = transaction.get_connection()
+        pending = connection.__dict__.setdefault("versioned_cache_pending", {})
+        pending.setdefault((cls, build), set()).update(diagnostics_ids)
+        # обработчики откаченных точек сохранения отбрасываются, поэтому
+        # регистрируется каждый вызов; первый после коммита забирает всё
+        transaction.on_commit(partial(VersionedCache.flush, connection))
+
+    @staticmethod
+    def flush(connection):
+        """Меняет версии сброшенных в транзакции ключей одной записью и пересобирает данные"""
+        pending = connection.__dict__.pop("versioned_cache_pending", {})
+        keys = [cls.version_key(pk) for (cls, _), ids in pending.items() for pk in ids]
+        if keys:
+            versions.write(keys)
+        for (cls, build), ids in pending.items():
+            cls.rebuild(ids, build)
+
+    @classmethod
+    def rebuild(cls, diagnostics_ids, build):
+        """
+        Собирает и сохраняет данные существующих ВТД, не собранных с действующей
+        версией; без build данные собираются при чтении
+        """
+        if build is None:
+            return
+        for pk in Diagnostics.objects.filter(pk__in=diagnostics_ids).values_list("pk", flat=True):
+            try:
+                cls.get_or_build(cls.version_key(pk), partial(build, pk), diagnostics_id=pk)
+            except ValueError:
+                # данные ВТД не собираются (нет участков, одометра), запрос вернёт ошибку
+                continue
+
+
+class SchemeSnapshot(VersionedCache):
+    """Готовый JSON схемы газопроводов для корневого филиала"""
+    department = models.OneToOneField(
+        Department,
+        on_delete=models.CASCADE,
+        related_name="scheme_snapshot",
+        verbose_name="Филиал",
+    )
+    content = models.BinaryField(verbose_name="Сериализованная схема")
+
+    VERSION_KEY = "scheme_snapshot"
+
+    class Meta:
+        verbose_name = "Снимок схемы"
+        verbose_name_plural = "Снимки схемы"
+
+    def __str__(self):
+        return f"Схема {self.department} ({self.created_at})"
+
+    @classmethod
+    def invalidate(cls):
+        """
+        Сбрасывает все снимки, они пересоберутся при следующем запросе схемы.
+        Версия схемы общая для всех филиалов и меняется после коммита.
+        """
+        versions.bump(cls.VERSION_KEY)
+        cls.objects.all().delete()
+
+    @classmethod
+    def current(cls, tree_id):
+        """Содержимое действительного снимка корневого филиала дерева или None"""
+        return cls.fresh(
+            cls.VERSION_KEY, department__tree_id=tree_id, department__level=0
+        ).values_list("content", flat=True).first()
+
+    @classmethod
+    def get(cls, root_id, build):
+        """Содержимое снимка филиала, при отсутствии собирается через build()"""
+        return cls.get_or_build(
+            cls.VERSION_KEY, lambda: {"content": build()}, department_id=root_id
+        ).content
+
+
+class FilterFacets(VersionedCache):
+    """Значения и количества для выпадающих списков фильтров труб участка или ВТД"""
+    SCOPE_CHOICES = [
+        ("pipe", "Трубы участка"),
+        ("diagnostics", "Трубы ВТД"),
+    ]
+    scope = models.CharField(max_length=20, choices=SCOPE_CHOICES, verbose_name="Список")
+    object_id = models.PositiveIntegerField(verbose_name="ID участка или ВТД")
+    content = models.JSONField(verbose_name="Значения фильтров")
+
+    VERSION_KEY = "filter_facets"
+
+    class Meta:
+        verbose_name = "Значения фильтров"
+        verbose_name_plural = "Значения фильтров"
+        constraints = [
+            models.UniqueConstraint(fields=["scope", "object_id"], name="unique_filter_facets")
+        ]
+
+    def __str__(self):
+        return f"{self.get_scope_display()} id={self.object_id}"
+
+    @classmethod
+    def version_key(cls, scope, object_id):
+        return versions.object_key(cls.VERSION_KEY, scope, object_id)
+
+    @classmethod
+    def get(cls, scope, object_id, build):
+        """Возвращает сохранённые значения, при отсутствии собирает их через build()"""
+        return cls.get_or_build(
+            cls.version_key(scope, object_id),
+            lambda: {"content": build()},
+            scope=scope,
+            object_id=object_id,
+        ).content
+
+    @classmethod
+    def invalidate(cls, pipe_ids=(), diagnostics_ids=()):
+        """
+        Сбрасывает значения списков участков и ВТД; общая версия VERSION_KEY
+        сбрасывает значения в памяти процессов (pipelines.filters.get_facets)
+        """
+        pipe_ids, diagnostics_ids = list(pipe_ids), list(diagnostics_ids)
+        if pipe_ids or diagnostics_ids:
+            versions.bump(cls.VERSION_KEY)
+        versions.bump_stored(
+            [cls.version_key("pipe", pk) for pk in pipe_ids]
+            + [cls.version_key("diagnostics", pk) for pk in diagnostics_ids]
+        )
+        cls.objects.filter(
+            models.Q(scope="pipe", object_id__in=pipe_ids)
+            | models.Q(scope="diagnostics", object_id__in=diagnostics_ids)
+        ).delete()
+
+
+class DiagnosticStats(VersionedCache):
+    """
+    Количество элементов и распределение аномалий по ВТД, собирается при импорте
+    и после коммита изменений элементов ВТД
+    """
+    diagnostics = models.OneToOneField(
+        Diagnostics,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="stats",
+        verbose_name="ВТД",
+    )
+    tube_count = models.PositiveIntegerField(default=0, verbose_name="Труб")
+    unit_count = models.PositiveIntegerField(default=0, verbose_name="Элементов обустройства")
+    bend_count = models.PositiveIntegerField(default=0, verbose_name="Отводов")
+    anomaly_count = models.PositiveIntegerField(default=0, verbose_name="Аномалий")
+    defects_count = models.PositiveIntegerField(default=0, verbose_name="Дефектов")
+    danger_levels = models.JSONField(default=dict, verbose_name="Аномалии по опасности")
+    anomaly_natures = models.JSONField(default=dict, verbose_name="Аномалии по характеру")
+    defect_types = models.JSONField(default=dict, verbose_name="Дефекты по типу")
+
+    VERSION_KEY = "diagnostic_stats"
+
+    class Meta:
+        verbose_name = "Статистика ВТД"
+        verbose_name_plural = "Статистика ВТД"
+
+    def __str__(self):
+        return f"Статистика ВТД id={self.diagnostics_id}"
+
+    @classmethod
+    def with_version(cls, queryset):
+        """Добавляет к ВТД действующую версию статистики (stats_version) тем же запросом"""
+        return queryset.annotate(stats_version=versions.stored(Concat(
+            Value(cls.version_key("")), Cast(OuterRef("pk"), models.CharField())
+        )))
+
+    @classmethod
+    def refresh(cls, diagnostics_ids, renew=False, save=True):
+        """
+        Пересчитывает статистику указанных ВТД: по одному сгруппированному
+        запросу на тип элементов независимо от числа ВТД. При импорте (renew)
+        статистика записывается с новой версией, она вступает в силу после коммита.
+        save=False — статистика только считается.
+        """
+        diagnostics_ids = list(diagnostics_ids)
+        keys = {pk: cls.version_key(pk) for pk in diagnostics_ids}
+        if renew:
+            token = uuid.uuid4().hex
+            versions.bump_stored(keys.values(), token)
+            tokens = dict.fromkeys(keys.values(), token)
+        else:
+            tokens = dict(CacheVersion.objects.filter(
+                key__in=keys.values()
+            ).values_list("key", "token"))
+        stats = {
+            pk: cls(diagnostics_id=pk, version=tokens.get(key, ""))
+            for pk, key in keys.items()
+        }
+        for row in TubeVersion.objects.filter(
+            diagnostics_id__in=diagnostics_ids
+        ).values("diagnostics_id").annotate(count=models.Count("id")):
+            stats[row["diagnostics_id"]].tube_count = row["count"]
+        for model, attr in ((TubeUnit, "unit_count"), (Bend, "bend_count")):
+            for row in model.objects.filter(
+                tube__diagnostics_id__in=diagnostics_ids
+            ).values("tube__diagnostics_id").annotate(count=models.Count("id")):
+                setattr(stats[row["tube__diagnostics_id"]], attr, row["count"])
+        for row in Anomaly.objects.filter(
+            tube__diagnostics_id__in=diagnostics_ids
+        ).values("tube__diagnostics_id", "danger_level", "anomaly_nature").annotate(
+            count=models.Count("id")
+        ):
+            item = stats[row["tube__diagnostics_id"]]
+            item.anomaly_count += row["count"]
+            for histogram, key in (
+                (item.danger_levels, row["danger_level"]),
+                (item.anomaly_natures, row["anomaly_nature"]),
+            ):
+                key = key or ""
+                histogram[key] = histogram.get(key, 0) + row["count"]
+        for row in Defect.objects.filter(
+            tube__diagnostics_id__in=diagnostics_ids
+        ).values("tube__diagnostics_id", "defect_type").annotate(count=models.Count("id")):
+            item = stats[row["tube__diagnostics_id"]]
+            item.defects_count += row["count"]
+            item.defect_types[row["defect_type"]] = row["count"]
+        if not save:
+            return stats
+        # одним INSERT ... ON CONFLICT: параллельные пересчёты (после коммитов
+        # изменений, импорт) не сталкиваются на первичном ключе
+        cls.objects.bulk_create(
+            stats.values(),
+            update_conflicts=True,
+            unique_fields=["diagnostics"],
+            update_fields=[
+                "tube_count", "unit_count", "bend_count", "anomaly_count", "defects_count",
+                "danger_levels", "anomaly_natures", "defect_types", "version", "created_at",
+            ],
+        )
+        return stats
+
+    @classmethod
+    def of(cls, diagnostics):
+        """
+        Статистика ВТД (select_related('stats') и with_version()), при отсутствии
+        или смене версии считается без записи: её пересчитывает invalidate()
+        после коммита, а не чтение списка
+        """
+        version = getattr(diagnostics, "stats_version", None)
+        if version is None:
+            version = diagnostics.stats_version = versions.read(cls.version_key(diagnostics.pk))
+        try:
+            stats = diagnostics.stats
+        except cls.DoesNotExist:
+            stats = None
+        if stats is None or stats.version != version:
+            stats = cls.refresh([diagnostics.pk], save=False)[diagnostics.pk]
+            diagnostics.stats = stats
+            diagnostics.stats_version = stats.version
+        return stats
+
+    @classmethod
+    def rebuild(cls, diagnostics_ids, build=None):
+        """Пересчитывает статистику существующих ВТД после коммита одним проходом"""
+        cls.refresh(
+            Diagnostics.objects.filter(pk__in=diagnostics_ids).values_list("pk", flat=True)
+        )
+
+
+class AnomalyCluster(models.Model):
+    """Взаимодействующие аномалии трубы, оцениваемые как одна (pipelines.clustering)"""
+    diagnostics = models.ForeignKey(
+        Diagnostics,
+        on_delete=models.CASCADE,
+        related_name="+",
+        verbose_name="ВТД",
+    )
+    tube = models.ForeignKey(
+        TubeVersion,
+        on_delete=models.CASCADE,
+        related_name="anomaly_clusters",
+        verbose_name="Труба",
+    )
+    axial_start = models.FloatField(verbose_name="От левого шва до начала, м")
+    length = models.FloatField(verbose_name="Длина группы, мм")
+    width = models.FloatField(verbose_name="Ширина группы, мм")
+    center_orientation = models.CharField(
+        max_length=10, verbose_name="Ориентация центра, ч:мин", blank=True
+    )
+    max_depth = models.FloatField(verbose_name="Наибольшая глубина, %", null=True, blank=True)
+    anomaly_count = models.PositiveIntegerField(verbose_name="Аномалий в группе")
+
+    class Meta:
+        verbose_name = "Группа аномалий"
+        verbose_name_plural = "Группы аномалий"
+
+    def __str__(self):
+        return f"Группа из {self.anomaly_count} аномалий ({self.tube})"
+
+
+class AnomalyAssessment(models.Model):
+    """Расчёт прочности трубы с аномалией потери металла (pipelines.assessment)"""
+    METHOD_CHOICES = [
+        ("b31g_mod", "Модифицированный B31G (0,85dL)"),
+    ]
+    anomaly = models.OneToOneField(
+        Anomaly,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="assessment",
+        verbose_name="Аномалия",
+    )
+    # ВТД и участок дублируются из версии трубы для пакетной замены и пересчёта ERF
+    diagnostics = models.ForeignKey(
+        Diagnostics,
+        on_delete=models.CASCADE,
+        related_name="+",
+        verbose_name="ВТД",
+    )
+    pipe = models.ForeignKey(
+        Pipe,
+        on_delete=models.CASCADE,
+        related_name="+",
+        verbose_name="Участок газопровода",
+    )
+    method = models.CharField(
+        max_length=20, choices=METHOD_CHOICES, default="b31g_mod", verbose_name="Методика"
+    )
+    burst_pressure = models.FloatField(verbose_name="Разрушающее давление, кгс/см²")
+    safe_pressure = models.FloatField(verbose_name="Безопасное давление, кгс/см²")
+    remaining_strength = models.FloatField(verbose_name="Коэффициент остаточной прочности")
+    operating_pressure = models.FloatField(verbose_name="Рабочее давление, кгс/см²")
+    erf = models.FloatField(
+        verbose_name="ERF", null=True, blank=True,
+        help_text="Отношение рабочего давления к безопасному, пусто при глубине за пределами методики",
+    )
+    exceeds_limit = models.BooleanField(
+        default=False, verbose_name="Безопасное давление ниже рабочего"
+    )
+    created_at = models.DateTimeField(auto_now=True, verbose_name="Дата расчёта")
+
+    class Meta:
+        verbose_name = "Оценка аномалии"
+        verbose_name_plural = "Оценки аномалий"
+        indexes = [
+            models.Index(fields=["diagnostics", "-erf"]),
+            models.Index(fields=["pipe"]),
+        ]
+
+    def __str__(self):
+        return f"Оценка аномалии id={self.anomaly_id}: ERF {self.erf}"
+
+
+class RunAlignment(models.Model):
+    """Сопоставление двух прогонов ВТД (pipelines.alignment)"""
+    earlier = models.ForeignKey(
+        Diagnostics,
+        on_delete=models.CASCADE,
+        related_name="later_alignments",
+        verbose_name="Предыдущая ВТД",
+    )
+    later = models.ForeignKey(
+        Diagnostics,
+        on_delete=models.CASCADE,
+        related_name="earlier_alignments",
+        verbose_name="Последующая ВТД",
+    )
+    years = models.FloatField(verbose_name="Интервал между ВТД, лет")
+    tube_count = models.PositiveIntegerField(default=0, verbose_name="Сопоставлено труб")
+    anomaly_count = models.PositiveIntegerField(default=0, verbose_name="Сопоставлено аномалий")
+    created_at = models.DateTimeField(auto_now=True, verbose_name="Дата расчёта")
+
+    class Meta:
+        verbose_name = "Сопоставление ВТД"
+        verbose_name_plural = "Сопоставления ВТД"
+        constraints = [
+            models.UniqueConstraint(fields=["earlier", "later"], name="unique_run_alignment")
+        ]
+
+    def __str__(self):
+        return f"ВТД id={self.earlier_id} -> id={self.later_id}"
+
+
+class TubeMatch(models.Model):
+    """Одна и та же труба (кольцевые швы) в двух прогонах"""
+    alignment = models.ForeignKey(
+        RunAlignment, on_delete=models.CASCADE, related_name="tube_matches"
+    )
+    earlier = models.ForeignKey(
+        TubeVersion, on_delete=models.CASCADE, related_name="later_matches",
+        verbose_name="Труба в предыдущей ВТД"
+    )
+    later = models.ForeignKey(
+        TubeVersion, on_delete=models.CASCADE, related_name="earlier_matches",
+        verbose_name="Труба в последующей ВТД",
+    )
+    odometr_shift = models.FloatField(verbose_name="Смещение одометра, м")
+
+    class Meta:
+        verbose_name = "Сопоставление трубы"
+        verbose_name_plural = "Сопоставления труб"
+
+
+class AnomalyMatch(models.Model):
+    """Одна и та же аномалия в двух прогонах и скорость её роста"""
+    alignment = models.ForeignKey(
+        RunAlignment, on_delete=models.CASCADE, related_name="anomaly_matches"
+    )
+    earlier = models.ForeignKey(
+        Anomaly, on_delete=models.CASCADE, related_name="later_matches",
+        verbose_name="Аномалия в предыдущей ВТД"
+    )
+    later = models.ForeignKey(
+        Anomaly, on_delete=models.CASCADE, related_name="growth",
+        verbose_name="Аномалия в последующей ВТД",
+    )
+    axial_distance = models.FloatField(verbose_name="Расхождение по оси, м")
+    clock_distance = models.FloatField(
+        verbose_name="Расхождение по окружности, мин", null=True, blank=True
+    )
+    depth_rate = models.FloatField(verbose_name="Скорость роста глубины, %/год", null=True, blank=True)
+    depth_rate_mm = models.FloatField(verbose_name="Скорость роста глубины, мм/год", null=True, blank=True)
+    length_rate = models.FloatField(verbose_name="Скорость роста длины, мм/год", null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Сопоставление аномалии"
+        verbose_name_plural = "Сопоставления аномалий"
+
+
+class DiagnosticTile(VersionedCache):
+    """Агрегаты всего прогона ВТД по интервалам одометра для уровня детализации (pipelines.tiles)"""
+    diagnostics = models.ForeignKey(
+        Diagnostics,
+        on_delete=models.CASCADE,
+        related_name="tiles",
+        verbose_name="ВТД",
+    )
+    lod = models.PositiveSmallIntegerField(verbose_name="Уровень детализации")
+    content = models.JSONField(verbose_name="Упакованные столбцы")
+
+    VERSION_KEY = "diagnostic_tiles"
+
+    class Meta:
+        verbose_name = "Агрегаты ВТД"
+        verbose_name_plural = "Агрегаты ВТД"
+        constraints = [
+            models.UniqueConstraint(fields=["diagnostics", "lod"], name="unique_diagnostic_tile")
+        ]
+
+    def __str__(self):
+        return f"ВТД id={self.diagnostics_id}, уровень {self.lod}"
+
+    @classmethod
+    def get(cls, diagnostics_id, lod, build):
+        """Возвращает сохранённые агрегаты, при отсутствии собирает их через build()"""
+        return cls.get_or_build(
+            cls.version_key(diagnostics_id),
+            lambda: {"content": build()},
+            diagnostics_id=diagnostics_id,
+            lod=lod,
+        ).content
+
+
+class OdometerCalibration(VersionedCache):
+    """Переход от одометра прогона ВТД к километражу газопровода (pipelines.calibration)"""
+    diagnostics = models.OneToOneField(
+        Diagnostics,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="calibration",
+        verbose_name="ВТД",
+    )
+    # узлы кусочно-линейного преобразования: одометр возрастает, километраж
+    # убывает, если прогон шёл против километража газопровода
+    odometer = models.JSONField(verbose_name="Опорные точки по одометру, м")
+    kilometres = models.JSONField(verbose_name="Опорные точки, км")
+    reference_count = models.PositiveIntegerField(
+        default=0, verbose_name="Сопоставлено опорных элементов"
+    )
+
+    VERSION_KEY = "odometer_calibration"
+
+    class Meta:
+        verbose_name = "Привязка ВТД к километражу"
+        verbose_name_plural = "Привязки ВТД к километражу"
+
+    def __str__(self):
+        return f"Привязка ВТД id={self.diagnostics_id} ({self.reference_count} опор)"
+
+
+class BendSpatialIndex(VersionedCache):
+    """Сеточный индекс координат отводов ВТД (pipelines.geo)"""
+    diagnostics = models.OneToOneField(
+        Diagnostics,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="bend_index",
+        verbose_name="ВТД",
+    )
+    point_count = models.PositiveIntegerField(default=0, verbose_name="Отводов с координатами")
+    cell_size = models.FloatField(verbose_name="Размер ячейки, м")
+    content = models.BinaryField(verbose_name="Упакованные точки и сетка")
+
+    VERSION_KEY = "bend_index"
+
+    class Meta:
+        verbose_name = "Индекс координат отводов"
+        verbose_name_plural = "Индексы координат отводов"
+
+    def __str__(self):
+        return f"Индекс отводов ВТД id={self.diagnostics_id} ({self.point_count})"
 
 
 class ComplexPlan(models.Model):
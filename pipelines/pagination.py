@@ -0,0 +1,131 @@
+from django.db.models import F, Q
+
+
+def encode_cursor(value, pk):
+    """Курсор — значение одометра и id последней строки: '1234.5:678'"""
+    return f"{'' if value is None else repr(value)}:{pk}"
+
+
+def decode_cursor(cursor):
+    value, pk = cursor.rsplit(':', 1)
+    return (float(value) if value else None), int(pk)
+
+
+def after_key(field, value, pk):
+    """Строки после (value, pk) в порядке: сначала без одометра, затем по возрастанию"""
+    if value is None:
+        return Q(**{f'{field}__isnull': True, 'pk__gt': pk}) | Q(**{f'{field}__isnull': False})
+    return Q(**{f'{field}__gt': value}) | Q(**{field: value, 'pk__gt': pk})
+
+
+def before_key(field, value, pk):
+    if value is None:
+        return Q(**{f'{field}__isnull': True, 'pk__lt': pk})
+    return (
+        Q(**{f'{field}__lt': value})
+        | Q(**{field: value, 'pk__lt': pk})
+        | Q(**{f'{field}__isnull': True})
+    )
+
+
+class OdometerPage:
+    """Страница строк, упорядоченных по одометру, с курсорами соседних страниц"""
+
+    def __init__(self, rows, field, previous_cursor=None, next_cursor=None):
+        self.rows = rows
+        self.field = field
+        self.previous_cursor = previous_cursor
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def start(self):
+        """Одометр первой строки страницы (для поля «перейти к расстоянию»)"""
+        return self.cursor_value(self.rows[0]) if self.rows else None
+
+    def cursor_value(self, row):
+        value = row
+        for part in self.field.split('__'):
+            value = getattr(value, part, None) if value is not None else None
+        return value
+
+
+def paginate_by_odometer(queryset, field, params, page_size):
+    """
+    Постраничный вывод по ключу (одометр, id) без OFFSET и COUNT.
+    params: after=<курсор> — следующая страница, before=<курсор> — предыдущая,
+    distance=<м> — страница, начинающаяся с указанного расстояния.
+    Стоимость страницы не зависит от её положения вдоль трубы:
+    выборка page_size + 1 строк и проверка наличия строк с другой стороны.
+    """
+    page = OdometerPage([], field)
+    ascending = (F(field).asc(nulls_first=True), 'pk')
+    descending = (F(field).desc(nulls_last=True), '-pk')
+    queryset = queryset.order_by()
+    try:
+        if params.get('before'):
+            value, pk = decode_cursor(params['before'])
+            rows = list(queryset.filter(before_key(field, value, pk)).order_by(*descending)[:page_size + 1])
+            has_previous, rows = len(rows) > page_size, rows[:page_size][::-1]
+            has_next = True
+        elif params.get('after'):
+            value, pk = decode_cursor(params['after'])
+            rows = list(queryset.filter(after_key(field, value, pk)).order_by(*ascending)[:page_size + 1])
+            has_next, rows = len(rows) > page_size, rows[:page_size]
+            has_previous = True
+        elif params.get('distance'):
+            distance = float(str(params['distance']).replace(',', '.'))
+            rows = list(queryset.filter(**{f'{field}__gte': distance}).order_by(*ascending)[:page_size + 1])
+            has_next, rows = len(rows) > page_size, rows[:page_size]
+            has_previous = None
+        else:
+            rows = list(queryset.order_by(*ascending)[:page_size + 1])
+            has_next, rows = len(rows) > page_size, rows[:page_size]
+            has_previous = False
+    except ValueError:
+        # повреждённый курсор или расстояние — первая страница
+        return paginate_by_odometer(queryset, field, {}, page_size)
+    page.rows = rows
+    if rows:
+        first = (page.cursor_value(rows[0]), rows[0].pk)
+        last = (page.cursor_value(rows[-1]), rows[-1].pk)
+        if has_previous is None:
+            has_previous = queryset.filter(before_key(field, *first)).exists()
+        if has_previous:
+            page.previous_cursor = encode_cursor(*first)
+        if has_next:
+            page.next_cursor = encode_cursor(*last)
+    return page
+
+
+class OdometerPaginationMixin:
+    """
+    Для SingleTableMixin: таблица выводится постранично по курсору одометра
+    вместо пагинации django_tables2 (OFFSET и полный COUNT).
+    """
+    odometer_field = 'odometr_data'
+    odometer_page_size = 50
+    # ListView и django_tables2 не должны пагинировать сами
+    paginate_by = None
+    table_pagination = False
+    cursor_template_name = 'module_app/table/cursor_table.html'
+
+    def get_table_data(self):
+        self.odometer_page = paginate_by_odometer(
+            super().get_table_data(), self.odometer_field, self.request.GET, self.odometer_page_size
+        )
+        return self.odometer_page.rows
+
+    def get_table(self, **kwargs):
+        # строки упорядочены по одометру, сортировка по столбцу меняла бы порядок
+        # только внутри страницы
+        table = super().get_table(
+            template_name=self.cursor_template_name, orderable=False, **kwargs
+        )
+        table.odometer_page = self.odometer_page
+        return table
@@ -0,0 +1,190 @@
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from mptt.signals import node_moved
+
+from equipments.models import Department, Equipment
+
+from .assessment import update_operating_pressure
+from .calibration import calibrate
+from .geo import build_index
+from .models import (Anomaly, Bend, BendSpatialIndex, Defect, Diagnostics,
+                     DiagnosticStats, DiagnosticTile, FilterFacets, Node,
+                     NodeState, OdometerCalibration, Pipe, PipeDepartment,
+                     PipeDocument, PipeLimit, Pipeline, PipeState, Repair,
+                     SchemeSnapshot, Tube, TubeUnit, TubeVersion)
+
+# Модели, изменение которых меняет содержимое схемы (PipelineSerializer)
+SCHEME_MODELS = (
+    Pipeline, Pipe, PipeDepartment, PipeState, PipeLimit, Node, NodeState,
+    Repair, Diagnostics, PipeDocument, Tube, TubeUnit,
+)
+
+
+def invalidate_scheme_snapshots(sender, **kwargs):
+    SchemeSnapshot.invalidate()
+
+
+for model in SCHEME_MODELS:
+    post_save.connect(invalidate_scheme_snapshots, sender=model)
+    post_delete.connect(invalidate_scheme_snapshots, sender=model)
+
+
+@receiver(m2m_changed, sender=Diagnostics.pipes.through)
+@receiver(m2m_changed, sender=Equipment.departments.through)
+def invalidate_scheme_on_relations_change(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        SchemeSnapshot.invalidate()
+
+
+@receiver(post_delete, sender=TubeVersion)
+def refresh_tube_latest_version(sender, instance, **kwargs):
+    Tube.refresh_latest_versions(Tube.objects.filter(pk=instance.tube_id))
+
+
+@receiver(post_save, sender=Tube)
+@receiver(post_delete, sender=Tube)
+def invalidate_tube_facets(sender, instance, **kwargs):
+    FilterFacets.invalidate(pipe_ids=[instance.pipe_id])
+
+
+@receiver(post_save, sender=TubeVersion)
+@receiver(post_delete, sender=TubeVersion)
+def invalidate_tube_version_facets(sender, instance, **kwargs):
+    # новая версия (ремонт, ВТД) меняет значения в списках участка и своей ВТД
+    FilterFacets.invalidate(
+        pipe_ids=Tube.objects.filter(pk=instance.tube_id).values_list('pipe_id', flat=True),
+        diagnostics_ids=[instance.diagnostics_id] if instance.diagnostics_id else [],
+    )
+
+
+@receiver(post_save, sender=TubeVersion)
+@receiver(post_delete, sender=TubeVersion)
+def invalidate_tube_version_stats(sender, instance, **kwargs):
+    if instance.diagnostics_id:
+        DiagnosticStats.invalidate(diagnostics_ids=[instance.diagnostics_id])
+        DiagnosticTile.invalidate(diagnostics_ids=[instance.diagnostics_id])
+        OdometerCalibration.invalidate(
+            diagnostics_ids=[instance.diagnostics_id], build=calibrate
+        )
+
+
+@receiver(post_save, sender=Diagnostics)
+def create_diagnostic_stats(sender, instance, created, **kwargs):
+    # статистика новой ВТД записывается после коммита, если её не записал импорт
+    if created:
+        transaction.on_commit(lambda: DiagnosticStats.refresh(
+            Diagnostics.objects.filter(
+                pk=instance.pk, stats__isnull=True
+            ).values_list('pk', flat=True)
+        ))
+
+
+@receiver(post_save, sender=TubeUnit)
+@receiver(post_delete, sender=TubeUnit)
+@receiver(post_save, sender=Bend)
+@receiver(post_delete, sender=Bend)
+@receiver(post_save, sender=Anomaly)
+@receiver(post_delete, sender=Anomaly)
+@receiver(post_save, sender=Defect)
+@receiver(post_delete, sender=Defect)
+def invalidate_tube_element_stats(sender, instance, **kwargs):
+    # элементы привязаны к версии трубы, статистика и агрегаты — к её ВТД
+    if instance.tube_id:
+        diagnostics_ids = list(TubeVersion.objects.filter(
+            pk=instance.tube_id, diagnostics__isnull=False
+        ).values_list('diagnostics_id', flat=True))
+        DiagnosticStats.invalidate(diagnostics_ids=diagnostics_ids)
+        DiagnosticTile.invalidate(diagnostics_ids=diagnostics_ids)
+
+
+@receiver(post_save, sender=TubeUnit)
+@receiver(post_delete, sender=TubeUnit)
+def invalidate_unit_calibration(sender, instance, **kwargs):
+    # краны и маркеры прогона — опоры привязки к километражу
+    if instance.tube_id:
+        OdometerCalibration.invalidate(
+            diagnostics_ids=TubeVersion.objects.filter(
+                pk=instance.tube_id, diagnostics__isnull=False
+            ).values_list('diagnostics_id', flat=True),
+            build=calibrate,
+        )
+
+
+@receiver(post_save, sender=Bend)
+@receiver(post_delete, sender=Bend)
+def invalidate_bend_index(sender, instance, **kwargs):
+    BendSpatialIndex.invalidate(
+        diagnostics_ids=TubeVersion.objects.filter(
+            pk=instance.tube_id, diagnostics__isnull=False
+        ).values_list('diagnostics_id', flat=True),
+        build=build_index,
+    )
+
+
+@receiver(post_save, sender=Pipe)
+@receiver(post_delete, sender=Pipe)
+@receiver(post_save, sender=Node)
+@receiver(post_delete, sender=Node)
+def invalidate_pipeline_calibrations(sender, instance, **kwargs):
+    # границы участков и положение узлов газопровода задают километраж опор
+    OdometerCalibration.invalidate(
+        diagnostics_ids=Diagnostics.pipes.through.objects.filter(
+            pipe__pipeline_id=instance.pipeline_id
+        ).values_list('diagnostics_id', flat=True),
+        build=calibrate,
+    )
+
+
+@receiver(m2m_changed, sender=Diagnostics.pipes.through)
+def invalidate_diagnostics_calibration(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        diagnostics_ids = [instance.pk]
+    elif pk_set is not None:
+        diagnostics_ids = pk_set
+    else:
+        diagnostics_ids = Diagnostics.objects.values_list('pk', flat=True)
+    OdometerCalibration.invalidate(diagnostics_ids=diagnostics_ids, build=calibrate)
+
+
+@receiver(post_save, sender=PipeLimit)
+@receiver(post_delete, sender=PipeLimit)
+def update_assessment_pressure(sender, instance, **kwargs):
+    # ERF считается от действующего ограничения давления участка
+    update_operating_pressure([instance.pipe_id])
+
+
+@receiver(m2m_changed, sender=Equipment.departments.through)
+def refresh_node_root_departments(sender, instance, action, reverse, pk_set, **kwargs):
+    # филиал узла берётся из подразделений его оборудования
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    nodes = Node.objects.all()
+    if not reverse:
+        nodes = nodes.filter(equipment_id=instance.pk)
+    elif pk_set is not None:
+        nodes = nodes.filter(equipment_id__in=pk_set)
+    Node.refresh_root_departments(nodes)
+
+
+@receiver(post_save, sender=Department)
+@receiver(post_delete, sender=Department)
+@receiver(node_moved, sender=Department)
+def refresh_node_root_departments_on_tree_change(sender, instance, signal, created=False, **kwargs):
+    # новое подразделение ещё не связано с оборудованием и филиалов не меняет;
+    # переименование, перенос и удаление затрагивают только узлы с оборудованием
+    # в дереве подразделения и узлы, чей филиал из этого дерева
+    if not created:
+        nodes = (
+            Q(equipment__departments__tree_id=instance.tree_id)
+            | Q(root_department__tree_id=instance.tree_id)
+        )
+        if signal is post_delete:
+            # ссылка на удалённый филиал уже обнулена, название осталось
+            nodes |= Q(root_department__isnull=True)
+        Node.refresh_root_departments(Node.objects.filter(nodes).distinct())
+    # схема содержит названия подразделений участков и собирается по веткам дерева
+    SchemeSnapshot.invalidate()
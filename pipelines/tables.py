@@ -2,8 +2,9 @@ import django_tables2 as tables
 
 from users.models import Role
 
-from .models import (Anomaly, Bend, Diagnostics, PipeDepartment, Repair, Tube,
-                     TubeUnit, TubeVersion)
+from .labels import diagnostics_label, repair_label
+from .models import (Anomaly, Bend, Diagnostics, DiagnosticStats, Repair,
+                     Tube, TubeUnit, TubeVersion)
 
 
 class TubeVersionTable(tables.Table):
@@ -136,12 +137,8 @@ class TubeTable(tables.Table):
         return dict(TubeVersion.TUBE_TYPE).get(value, value)
 
     def render_source(self, record):
-        # Получаем последнюю версию трубы с предзагрузкой диагностики и ремонта
-        latest_version = TubeVersion.objects.filter(
-            tube=record
-        ).select_related(
-            'diagnostics', 'repair'
-        ).order_by('-date').first()
+        # Последняя версия трубы с диагностикой и ремонтом загружена в queryset
+        latest_version = record.latest_version
         if not latest_version:
             return '-'
         # Проверяем, связана ли версия с диагностикой
@@ -159,20 +156,19 @@ class TubeTable(tables.Table):
         return '-'
 
     def render_unit_types(self, record):
-        # Получаем последнюю версию
-        latest_version = TubeVersion.objects.filter(tube=record).order_by('-date').first()
+        latest_version = record.latest_version
         if not latest_version:
             return '-'
-        # Получаем все элементы обустройства для последней версии
-        tube_units = latest_version.tube_units.all()
-        if not tube_units.exists():
+        # Элементы обустройства последней версии (предзагружены в unit_list)
+        if hasattr(latest_version, 'unit_list'):
+            tube_units = latest_version.unit_list
+        else:
+            tube_units = latest_version.tube_units.all()
+        if not tube_units:
             return '-'
-        # Формируем список типов элементов с переносом строки
-        unit_types = []
-        for unit in tube_units:
-            display_name = dict(TubeUnit.UNIT_TYPE).get(unit.unit_type, unit.unit_type)
-            unit_types.append(display_name)
-        return ', '.join(unit_types)
+        # Формируем список типов элементов
+        unit_names = dict(TubeUnit.UNIT_TYPE)
+        return ', '.join(unit_names.get(unit.unit_type, unit.unit_type) for unit in tube_units)
 
 
 class RepairTable(tables.Table):
@@ -198,27 +194,12 @@ class RepairTable(tables.Table):
         orderable = False
         template_name = 'module_app/table/new_table.html'
 
+    # Филиал и газопровод из готовых подписей (pipelines.labels)
     def render_pipeline(self, record):
-        if record.pipe:
-            return record.pipe.pipeline.title
-        if record.node:
-            if record.node.node_type == 'bridge' and record.node.sub_pipeline:
-                return f'{record.node.pipeline.title}  /  {record.node.sub_pipeline.title}'
-            return record.node.pipeline.title
-        return '-'
+        return repair_label(record).pipeline
 
     def render_department_root(self, record):
-        if record.pipe:
-            pd_list = PipeDepartment.objects.filter(pipe=record.pipe).select_related('department')
-            roots = [pd.department.get_root().name for pd in pd_list if pd.department]
-            return ' / '.join(sorted(set(roots))) if roots else '-'
-
-        if record.node:
-            departments = record.node.equipment.departments.all()
-            if departments.exists():
-                roots = [d.get_root().name for d in departments]
-                return ' / '.join(sorted(set(roots)))
-        return '-'
+        return repair_label(record).root_names()
 
     def render_object_type(self, record):
         if record.pipe:
@@ -241,6 +222,9 @@ class DiagnosticsTable(tables.Table):
     pipes_distance = tables.Column(verbose_name='Участок газопровода', accessor='pk')
     start_date = tables.DateColumn(verbose_name='Начало ВТД')
     end_date = tables.DateColumn(verbose_name='Окончание ВТД')
+    tube_count = tables.Column(verbose_name='Труб', accessor='pk')
+    anomaly_count = tables.Column(verbose_name='Аномалий', accessor='pk')
+    defects_count = tables.Column(verbose_name='Дефектов', accessor='pk')
 
     class Meta:
         model = Diagnostics
@@ -249,37 +233,22 @@ class DiagnosticsTable(tables.Table):
             'pipeline',
             'pipes_distance',
             'start_date',
-            'end_date'
+            'end_date',
+            'tube_count',
+            'anomaly_count',
+            'defects_count',
         ]
         attrs = {'class': 'table table_pipelines'}
         row_attrs = {'id': lambda record: record.id}
         orderable = False
         template_name = 'module_app/table/new_table.html'
 
+    # Филиалы и газопровод из готовых подписей (pipelines.labels)
     def render_pipeline(self, record):
-        pipelines = set()
-        for pipe in record.pipes.all():
-            if pipe.pipeline:
-                pipelines.add(pipe.pipeline.title)
-
-        if pipelines:
-            if len(pipelines) == 1:
-                return list(pipelines)[0]
-            else:
-                return f"Несколько ({len(pipelines)})"
-        return '-'
+        return diagnostics_label(record.pk).pipeline
 
     def render_department_root(self, record):
-        all_roots = set()
-        for pipe in record.pipes.all():
-            for pd in pipe.pipedepartment_set.all():
-                if pd.department:
-                    root = pd.department.get_root()
-                    all_roots.add(root.name)
-
-        if all_roots:
-            return '  -  '.join(sorted(all_roots))
-        return '-'
+        return diagnostics_label(record.pk).root_names('  -  ')
 
     def render_pipes_distance(self, record):
         pipes = list(record.pipes.all())
@@ -293,3 +262,13 @@ class DiagnosticsTable(tables.Table):
                 max_end = max(end_points)
                 return f"от {min_start} до {max_end} км"
         return '-'
+
+    # Количества из DiagnosticStats (select_related('stats') во view)
+    def render_tube_count(self, record):
+        return DiagnosticStats.of(record).tube_count
+
+    def render_anomaly_count(self, record):
+        return DiagnosticStats.of(record).anomaly_count
+
+    def render_defects_count(self, record):
+        return DiagnosticStats.of(record).defects_count
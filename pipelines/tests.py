@@ -1,3 +1,1807 @@
-from django.test import TestCase
+import datetime as dt
+import tempfile
+from io import StringIO
+from pathlib import Path
+from urllib.parse import quote
 
-# Create your tests here.
+import numpy as np
+from django.core.management import call_command
+from django.db import connection
+from django.db.models.signals import post_delete
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+from django_tables2 import RequestConfig
+from openpyxl import Workbook
+
+from api.serializers.pipelines_serializers import NodeSerializer
+from equipments import versions
+from equipments.models import CacheVersion, Department, Equipment
+from pipelines.models import (Anomaly, AnomalyAssessment, AnomalyCluster,
+                              AnomalyMatch, Bend, BendSpatialIndex, ComplexPlan,
+                              Defect, Diagnostics,
+                              DiagnosticStats, DiagnosticTile, FilterFacets,
+                              Hole, Node, NodeState, OdometerCalibration,
+                              parse_bend_comment,
+                              Pipe, PipeDepartment, PipeDocument, PipeLimit,
+                              Pipeline, PipeState, PlannedWork, Repair,
+                              SchemeSnapshot,
+                              RunAlignment, Tube, TubeMatch, TubeUnit,
+                              TubeVersion)
+from pipelines.filters import TubeFilter
+from pipelines.alignment import align_runs
+from pipelines.assessment import assess_diagnostics, modified_b31g
+from pipelines import calibration as ili_calibration
+from pipelines.calibration import (anomaly_kilometres, get_calibration,
+                                   to_km, to_odometer)
+from pipelines.clustering import cluster_diagnostics
+from pipelines import geo
+from pipelines.geo import GridIndex, get_index
+from pipelines.history import state_durations
+from pipelines.intervals import IntervalIndex, objects_at
+from pipelines.labels import VERSION_KEY as labels_version_key
+from pipelines.labels import (EMPTY_LABEL, ObjectLabel, diagnostics_label,
+                              get_labels, node_label, pipe_label)
+from pipelines.pagination import paginate_by_odometer
+from pipelines.tiles import unpack
+from pipelines.tables import TubeTable
+from pipelines.utils import IliImporter, parse_workbook
+from pipelines.views import (DiagnosticsView, DiagnosticTubesView, RepairsView,
+                             TubesView)
+from users.models import ModuleUser, Role
+
+
+class PipelineSchemeQueriesTest(TestCase):
+    """Количество запросов схемы не зависит от числа участков и узлов"""
+
+    url = '/api/pipelines/'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.root = Department.objects.create(name='ЛПУМГ')
+        cls.department = Department.objects.create(name='Служба ЛЭС', parent=cls.root)
+        cls.user = ModuleUser.objects.create_user(
+            username='dispatcher', password='password', department=cls.department
+        )
+        cls.pipeline = Pipeline.objects.create(title='Надым-Пунга 1')
+
+    def add_pipe(self, num):
+        pipe = Pipe.objects.create(
+            pipeline=self.pipeline, start_point=num * 10, end_point=num * 10 + 10
+        )
+        PipeDepartment.objects.create(pipe=pipe, department=self.department)
+        PipeState.objects.create(
+            pipe=pipe, state_type='operation',
+            start_date=dt.date(2025, 1, 1), created_by=self.user
+        )
+        PipeLimit.objects.create(
+            pipe=pipe, pressure_limit=50, start_date=dt.date(2025, 1, 1)
+        )
+        Repair.objects.create(pipe=pipe, start_date=dt.date(2024, 6, 1))
+        diagnostics = Diagnostics.objects.create(start_date=dt.date(2024, 8, 1))
+        diagnostics.pipes.add(pipe)
+        PipeDocument.objects.create(pipe=pipe, doc='pipelines/docs/pipes/act.pdf', name='Акт')
+        tube = Tube.objects.create(pipe=pipe, tube_num=str(num))
+        version = TubeVersion.objects.create(
+            tube=tube, diagnostics=diagnostics, date=dt.date(2024, 8, 1),
+            version_type='diagnostic', tube_length=11.5, thickness=18.7
+        )
+        TubeUnit.objects.create(tube=version, unit_type='mark')
+        equipment = Equipment.objects.create(name=f'Крановый узел {num}')
+        equipment.departments.add(self.department)
+        node = Node.objects.create(
+            node_type='valve', pipeline=self.pipeline,
+            equipment=equipment, location_point=num * 10
+        )
+        NodeState.objects.create(node=node, state_type='open', changed_by=self.user)
+
+    def warm_up(self):
+        """Загружает дерево подразделений и область видимости, сбрасывает снимок схемы"""
+        self.client.get(self.url)
+        SchemeSnapshot.invalidate()
+
+    def test_query_count_is_constant(self):
+        self.client.force_login(self.user)
+        self.add_pipe(1)
+        self.warm_up()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        # captured_queries читает журнал запросов, который следующий запрос очищает
+        query_count = len(queries)
+        for num in range(2, 6):
+            self.add_pipe(num)
+        self.warm_up()
+        with self.assertNumQueries(query_count):
+            response = self.client.get(self.url)
+        pipeline = response.json()[0]
+        self.assertEqual(len(pipeline['pipes']), 5)
+        self.assertEqual(len(pipeline['nodes']), 5)
+        pipe = pipeline['pipes'][0]
+        self.assertEqual(pipe['tube_count'], 1)
+        self.assertEqual(pipe['unit_count'], 1)
+        self.assertEqual(pipe['state']['state_type'], 'operation')
+        self.assertEqual(pipe['limit']['pressure_limit'], 50)
+        self.assertEqual(pipeline['nodes'][0]['department']['name'], 'ЛПУМГ')
+
+    def test_snapshot_is_served_and_invalidated(self):
+        self.client.force_login(self.user)
+        self.add_pipe(1)
+        self.client.get(self.url)
+        self.assertTrue(SchemeSnapshot.objects.filter(department=self.root).exists())
+        with self.assertNumQueries(4):  # сессия, пользователь, подразделение, снимок
+            response = self.client.get(self.url)
+        self.assertEqual(response.json()[0]['pipes'][0]['state']['state_type'], 'operation')
+        pipe = Pipe.objects.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            PipeState.objects.create(
+                pipe=pipe, state_type='repair', start_date=dt.date(2025, 2, 1)
+            )
+            self.assertFalse(SchemeSnapshot.objects.exists())
+            # чтение, начатое до изменения, записывает снимок после сброса
+            SchemeSnapshot.objects.create(department=self.root, content=b'[]')
+        response = self.client.get(self.url)
+        self.assertEqual(response.json()[0]['pipes'][0]['state']['state_type'], 'repair')
+        self.assertTrue(SchemeSnapshot.objects.get().version)
+
+    def test_snapshot_is_rebuilt_after_department_rename(self):
+        self.client.force_login(self.user)
+        self.add_pipe(1)
+        self.client.get(self.url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.department.name = 'Служба ЛЭС и ЭХЗ'
+            self.department.save()
+        self.assertFalse(SchemeSnapshot.objects.exists())
+        response = self.client.get(self.url)
+        pipe = response.json()[0]['pipes'][0]
+        self.assertEqual(pipe['departments'][0]['name'], 'Служба ЛЭС и ЭХЗ')
+        self.assertTrue(SchemeSnapshot.objects.filter(department=self.root).exists())
+
+
+class SchemeChangesTest(TestCase):
+    """Лента изменений схемы по курсору ревизий"""
+
+    url = '/api/pipelines/changes/'
+
+    def setUp(self):
+        department = Department.objects.create(name='ЛПУМГ')
+        self.user = ModuleUser.objects.create_user(
+            username='dispatcher', password='password', department=department
+        )
+        pipeline = Pipeline.objects.create(title='Надым-Пунга 1')
+        self.pipe = Pipe.objects.create(pipeline=pipeline, start_point=0, end_point=10)
+        PipeDepartment.objects.create(pipe=self.pipe, department=department)
+        self.client.force_login(self.user)
+
+    def test_changes_since_cursor(self):
+        first = PipeState.objects.create(
+            pipe=self.pipe, state_type='operation', start_date=dt.date(2025, 1, 1)
+        )
+        cursor = self.client.get(self.url).json()['cursor']
+        self.assertEqual(cursor, first.revision)
+        second = PipeState.objects.create(
+            pipe=self.pipe, state_type='repair', start_date=dt.date(2025, 2, 1)
+        )
+        changes = self.client.get(self.url, {'since': cursor}).json()
+        self.assertEqual(changes['cursor'], second.revision)
+        # новое состояние и закрытое им предыдущее
+        self.assertEqual(
+            {state['id']: state['end_date'] for state in changes['pipe_states']},
+            {first.id: '01.02.2025', second.id: None}
+        )
+        self.assertEqual(changes['pipe_limits'], [])
+        self.assertEqual(changes['node_states'], [])
+        changes = self.client.get(self.url, {'since': changes['cursor']}).json()
+        self.assertEqual(changes['pipe_states'], [])
+
+
+class NetworkHistoryTest(TestCase):
+    """Состояния схемы на дату и длительность состояний по месяцам"""
+
+    def setUp(self):
+        department = Department.objects.create(name='ЛПУМГ')
+        self.user = ModuleUser.objects.create_user(
+            username='dispatcher', password='password', department=department
+        )
+        pipeline = Pipeline.objects.create(title='Надым-Пунга 1')
+        self.pipe = Pipe.objects.create(pipeline=pipeline, start_point=0, end_point=10)
+        PipeDepartment.objects.create(pipe=self.pipe, department=department)
+        for state_type, start_date in [
+            ('operation', dt.date(2023, 12, 1)),
+            ('repair', dt.date(2024, 2, 10)),
+            ('operation', dt.date(2024, 3, 5)),
+        ]:
+            PipeState.objects.create(pipe=self.pipe, state_type=state_type, start_date=start_date)
+        PipeLimit.objects.create(pipe=self.pipe, pressure_limit=50, start_date=dt.date(2024, 2, 10))
+        self.client.force_login(self.user)
+
+    def test_as_of(self):
+        url = '/api/pipelines/as-of/'
+        response = self.client.get(url, {'date': '2024-03-04'}).json()
+        self.assertEqual([state['state_type'] for state in response['pipe_states']], ['repair'])
+        self.assertEqual([limit['pressure_limit'] for limit in response['pipe_limits']], [50])
+        # состояние закрывается датой начала следующего
+        response = self.client.get(url, {'date': '2024-03-05'}).json()
+        self.assertEqual([state['state_type'] for state in response['pipe_states']], ['operation'])
+        response = self.client.get(url, {'date': '2024-01-01'}).json()
+        self.assertEqual(response['pipe_limits'], [])
+        self.assertEqual(self.client.get(url, {'date': '01.03.2024'}).status_code, 400)
+
+    def test_as_of_node_states_are_scoped(self):
+        pipeline = self.pipe.pipeline
+        equipment = Equipment.objects.create(name='Крановый узел 5')
+        equipment.departments.add(self.user.department)
+        # чужой узел с тем же id, что у оборудования ЛПУМГ: отбор идёт по id узлов
+        other = Node.objects.create(
+            id=equipment.id, node_type='valve', pipeline=pipeline, location_point=2,
+            equipment=Equipment.objects.create(name='Крановый узел другого филиала')
+        )
+        own = Node.objects.create(
+            node_type='valve', pipeline=pipeline, location_point=5, equipment=equipment
+        )
+        shared = Node.objects.create(
+            node_type='valve', pipeline=pipeline, location_point=8, is_shared=True,
+            equipment=Equipment.objects.create(name='Пограничный крановый узел')
+        )
+        states = {
+            node.pk: NodeState.objects.create(node=node, state_type='open').pk
+            for node in (other, own, shared)
+        }
+        response = self.client.get(
+            '/api/pipelines/as-of/', {'date': dt.date.today().isoformat()}
+        ).json()
+        self.assertEqual(
+            {state['id'] for state in response['node_states']}, {states[own.pk], states[shared.pk]}
+        )
+
+    def test_state_durations(self):
+        months, durations = state_durations(
+            [self.pipe.id], dt.date(2024, 1, 1), dt.date(2025, 1, 1), today=dt.date(2024, 5, 15)
+        )
+        self.assertEqual(len(months), 12)
+        self.assertEqual(durations[self.pipe.id], {
+            'operation': [31, 9, 27, 30, 15, 0, 0, 0, 0, 0, 0, 0],
+            'repair': [0, 20, 4, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+        })
+        with self.assertNumQueries(1):
+            state_durations([self.pipe.id], dt.date(2024, 1, 1), dt.date(2025, 1, 1))
+
+        response = self.client.get(
+            '/api/pipelines/state-durations/', {'from': '2024-02-01', 'to': '2024-04-01'}
+        ).json()
+        self.assertEqual(response['months'], ['2024-02', '2024-03'])
+        self.assertEqual(response['pipes'], [
+            {'pipe': self.pipe.id, 'states': {'operation': [9, 27], 'repair': [20, 4]}}
+        ])
+        response = self.client.get(
+            '/api/pipelines/state-durations/', {'from': '2024-02-01', 'to': '2024-01-01'}
+        )
+        self.assertEqual(response.status_code, 400)
+        # период не длиннее пяти лет
+        for start, end, code in (
+            ('2024-03-15', '2029-03-15', 200),
+            ('2024-03-15', '2029-03-16', 400),
+            ('2024-01-01', '2029-12-31', 400),
+            ('2024-02-29', '2029-03-01', 200),
+        ):
+            response = self.client.get(
+                '/api/pipelines/state-durations/', {'from': start, 'to': end}
+            )
+            self.assertEqual(response.status_code, code, (start, end))
+
+
+class IntervalIndexTest(TestCase):
+    """Объекты газопровода на километре и на отрезке"""
+
+    def setUp(self):
+        self.department = Department.objects.create(name='ЛПУМГ')
+        other = Department.objects.create(name='Другой филиал')
+        self.user = ModuleUser.objects.create_user(
+            username='dispatcher', password='password', department=self.department
+        )
+        self.pipeline = Pipeline.objects.create(title='Надым-Пунга 1')
+        self.pipes = []
+        for start, department in [(0, self.department), (10, self.department), (20, other)]:
+            pipe = Pipe.objects.create(
+                pipeline=self.pipeline, start_point=start, end_point=start + 10
+            )
+            PipeDepartment.objects.create(pipe=pipe, department=department)
+            self.pipes.append(pipe)
+        equipment = Equipment.objects.create(name='Крановый узел 10')
+        equipment.departments.add(self.department)
+        self.node = Node.objects.create(
+            node_type='valve', pipeline=self.pipeline, equipment=equipment, location_point=10
+        )
+        self.repair = Repair.objects.create(pipe=self.pipes[0], start_date=dt.date(2024, 6, 1))
+        plan = ComplexPlan.objects.create(department=self.department, year=dt.date.today().year)
+        self.work = PlannedWork.objects.create(
+            complex_plan=plan, work_type='repair', node=self.node,
+            start_date=dt.date(2025, 6, 1), end_date=dt.date(2025, 7, 1)
+        )
+        self.client.force_login(self.user)
+
+    def test_overlap_matches_brute_force(self):
+        rng = np.random.default_rng(7)
+        starts = rng.uniform(0, 1000, 500)
+        intervals = [
+            (start, start + length, 'pipes', i)
+            for i, (start, length) in enumerate(zip(starts, rng.exponential(5, 500)))
+        ] + [(start, start, 'nodes', i) for i, start in enumerate(rng.uniform(0, 1000, 100))]
+        index = IntervalIndex(intervals)
+        for start, end in [(-5, -1), (0, 0), (100, 100), (250.5, 270), (990, 2000)]:
+            expected = sorted(item for item in intervals if item[0] <= end and item[1] >= start)
+            self.assertEqual(sorted(index.overlap(start, end)), expected)
+        self.assertEqual(IntervalIndex([]).overlap(0, 10), [])
+
+    def test_at_km(self):
+        url = f'/api/pipelines/{self.pipeline.pk}/at/'
+        data = self.client.get(url, {'km': 10}).json()
+        self.assertEqual(
+            [pipe['id'] for pipe in data['pipes']], [self.pipes[0].pk, self.pipes[1].pk]
+        )
+        self.assertEqual([node['id'] for node in data['nodes']], [self.node.pk])
+        self.assertEqual(data['nodes'][0]['root_department_name'], 'ЛПУМГ')
+        self.assertEqual(len(data['departments']), 2)
+        self.assertEqual([repair['id'] for repair in data['repairs']], [self.repair.pk])
+        self.assertEqual([work['id'] for work in data['planned_works']], [self.work.pk])
+        # участок другого филиала не виден
+        data = self.client.get(url, {'from': 19, 'to': 25}).json()
+        self.assertEqual([pipe['id'] for pipe in data['pipes']], [self.pipes[1].pk])
+        self.assertEqual((data['nodes'], data['repairs']), ([], []))
+        self.assertEqual(self.client.get(url, {'from': 5}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'from': 5, 'to': 1}).status_code, 400)
+        for params in ({'km': 'nan'}, {'km': 'inf'}, {'from': '-inf', 'to': 5}):
+            self.assertEqual(self.client.get(url, params).status_code, 400)
+        self.assertEqual(self.client.get('/api/pipelines/0/at/', {'km': 1}).status_code, 404)
+
+    def test_rebuilt_on_change(self):
+        self.assertEqual(objects_at(self.pipeline.pk, 12)['holes'], [])
+        with self.assertNumQueries(0):
+            objects_at(self.pipeline.pk, 15)
+        hole = Hole.objects.create(
+            pipe=self.pipes[1], location_point=12, cutting_date=dt.date(2024, 5, 1)
+        )
+        holes = objects_at(self.pipeline.pk, 11, 13)['holes']
+        self.assertEqual([item['id'] for item in holes], [hole.pk])
+        self.node.location_point = 12
+        self.node.save()
+        self.assertEqual(objects_at(self.pipeline.pk, 10)['nodes'], [])
+        self.assertEqual(objects_at(self.pipeline.pk, 12)['planned_works'][0]['id'], self.work.pk)
+
+
+class StateChangesTest(TestCase):
+    """Пакетное изменение состояний участков и узлов"""
+
+    url = '/api/pipelines/state-changes/'
+
+    def setUp(self):
+        department = Department.objects.create(name='ЛПУМГ')
+        self.user = ModuleUser.objects.create_user(
+            username='dispatcher', password='password', department=department
+        )
+        self.pipeline = Pipeline.objects.create(title='Надым-Пунга 1')
+        self.client.force_login(self.user)
+
+    def add_objects(self, count):
+        pipes, nodes = [], []
+        for num in range(count):
+            pipe = Pipe.objects.create(pipeline=self.pipeline, start_point=num, end_point=num + 1)
+            PipeState.objects.create(pipe=pipe, state_type='operation', start_date=dt.date(2025, 1, 1))
+            node = Node.objects.create(
+                node_type='valve', pipeline=self.pipeline,
+                equipment=Equipment.objects.create(name=f'Кран {num}'), location_point=num
+            )
+            NodeState.objects.create(node=node, state_type='open')
+            pipes.append(pipe)
+            nodes.append(node)
+        return pipes, nodes
+
+    def post(self, pipes, nodes):
+        return self.client.post(self.url, {
+            'pipe_states': [
+                {'id': pipe.id, 'state_type': 'repair', 'start_date': '2025-03-01'} for pipe in pipes
+            ],
+            'node_states': [{'id': node.id, 'state_type': 'closed'} for node in nodes],
+        }, content_type='application/json')
+
+    def test_batch(self):
+        pipes, nodes = self.add_objects(3)
+        SchemeSnapshot.objects.create(department=Department.objects.get(), content=b'[]')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post(pipes, nodes)
+        self.assertEqual(response.status_code, 201)
+        data = response.json()
+        self.assertEqual([state['pipe'] for state in data['pipe_states']], [pipe.id for pipe in pipes])
+        self.assertEqual({state['state_type'] for state in data['node_states']}, {'closed'})
+        for pipe in Pipe.objects.select_related('current_state'):
+            self.assertEqual(pipe.current_state.state_type, 'repair')
+        self.assertEqual(
+            set(PipeState.objects.filter(state_type='operation').values_list('end_date', flat=True)),
+            {dt.date(2025, 3, 1)}
+        )
+        self.assertEqual({node.current_state.state_type for node in Node.objects.all()}, {'closed'})
+        self.assertEqual(NodeState.objects.filter(end_date__isnull=True).count(), 3)
+        # одна ревизия на пакет
+        self.assertEqual(len(set(PipeState.objects.filter(state_type='repair').values_list('revision'))), 1)
+        self.assertFalse(SchemeSnapshot.objects.exists())
+
+        pipes, nodes = self.add_objects(6)
+        with self.assertNumQueries(len(queries)):
+            self.assertEqual(self.post(pipes, nodes).status_code, 201)
+
+    def test_invalid_batch_changes_nothing(self):
+        pipes, nodes = self.add_objects(2)
+        response = self.client.post(self.url, {
+            'pipe_states': [{'id': pipes[0].id, 'state_type': 'unknown', 'start_date': '2025-03-01'}],
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.post(pipes + pipes[:1], [])
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(self.url, {
+            'node_states': [{'id': 0, 'state_type': 'closed'}],
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(PipeState.objects.count(), 2)
+        self.assertEqual(NodeState.objects.count(), 2)
+
+
+class TubeLatestVersionTest(TestCase):
+    """Указатель последней версии трубы и список труб участка"""
+
+    def setUp(self):
+        pipe = Pipe.objects.create(
+            pipeline=Pipeline.objects.create(title='Надым-Пунга 1'),
+            start_point=0, end_point=10
+        )
+        self.tube = Tube.objects.create(pipe=pipe, tube_num='1')
+        self.old = self.add_version(dt.date(2020, 1, 1), steel_grade='17Г1С')
+
+    def add_version(self, date, **fields):
+        fields = {
+            'tube_length': 11.5, 'thickness': 18.7, 'tube_type': 'one',
+            'diameter': 1420, **fields
+        }
+        fields.setdefault('version_type', 'diagnostic')
+        return TubeVersion.objects.create(tube=self.tube, date=date, **fields)
+
+    def test_pointer_follows_versions(self):
+        self.tube.refresh_from_db()
+        self.assertEqual(self.tube.latest_version, self.old)
+        new = self.add_version(dt.date(2024, 1, 1), tube_length=12.0)
+        self.tube.refresh_from_db()
+        self.assertEqual(self.tube.latest_version, new)
+        new.delete()
+        self.tube.refresh_from_db()
+        self.assertEqual(self.tube.latest_version, self.old)
+
+    def test_tubes_view_uses_latest_version(self):
+        self.add_version(dt.date(2024, 1, 1), tube_length=12.0, steel_grade='')
+        view = TubesView(kwargs={'pipe_id': self.tube.pipe_id})
+        with self.assertNumQueries(2):  # трубы и элементы обустройства
+            tube = view.get_queryset().get()
+            self.assertEqual(tube.latest_version.tube_length, 12.0)
+        self.assertEqual(tube.last_length, 12.0)
+        # пустая марка стали берётся из предыдущей версии
+        self.assertEqual(tube.last_steel_grade, '17Г1С')
+
+    def filterset(self):
+        view = TubesView()
+        view.setup(RequestFactory().get('/'), pipe_id=self.tube.pipe_id)
+        return TubeFilter(**view.get_filterset_kwargs(TubeFilter))
+
+    def test_filter_facets_are_stored_and_invalidated(self):
+        other = Tube.objects.create(pipe_id=self.tube.pipe_id, tube_num='2')
+        TubeVersion.objects.create(
+            tube=other, date=dt.date(2020, 1, 1), version_type='diagnostic',
+            tube_length=11.5, thickness=18.7, tube_type='two', diameter=1420
+        )
+        choices = list(self.filterset().form.fields['last_length'].choices)
+        self.assertEqual(choices[1:], [(11.5, '11.5 м (2)')])
+        with self.assertNumQueries(0):  # значения из памяти процесса
+            form = self.filterset().form
+            self.assertEqual(len(list(form.fields['last_type'].choices)), 3)
+        # ремонт меняет последнюю версию трубы
+        self.add_version(dt.date(2024, 1, 1), tube_length=12.0, version_type='repair')
+        self.assertFalse(FilterFacets.objects.exists())
+        choices = list(self.filterset().form.fields['last_length'].choices)
+        self.assertEqual(choices[1:], [(11.5, '11.5 м (1)'), (12.0, '12.0 м (1)')])
+
+    def test_filter_facets_follow_other_process(self):
+        self.filterset()
+        # import_ili в другом процессе: данные в обход сигналов и новая версия в БД
+        TubeVersion.objects.update(tube_length=13.0)
+        FilterFacets.objects.all().delete()
+        CacheVersion.objects.update_or_create(
+            key=FilterFacets.VERSION_KEY, defaults={'token': 'other'}
+        )
+        versions.reset()
+        choices = list(self.filterset().form.fields['last_length'].choices)
+        self.assertEqual(choices[1:], [(13.0, '13.0 м (1)')])
+
+    def test_stale_filter_facets_are_not_served(self):
+        self.filterset()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_version(dt.date(2024, 1, 1), tube_length=12.0, version_type='repair')
+            # сборка, начатая до ремонта, записывает значения после сброса
+            FilterFacets.objects.create(
+                scope='pipe', object_id=self.tube.pipe_id, content={}, version=''
+            )
+        choices = list(self.filterset().form.fields['last_length'].choices)
+        self.assertEqual(choices[1:], [(12.0, '12.0 м (1)')])
+        self.assertTrue(FilterFacets.objects.get(scope='pipe').version)
+
+    def test_filter_with_facets_does_not_query(self):
+        facets = {
+            'last_length': [[11.5, 2]], 'last_thickness': [[18.7, 2]],
+            'last_type': [['one', 2]], 'last_steel_grade': [['Х-70', 2]],
+        }
+        with self.assertNumQueries(0):
+            form = TubeFilter(queryset=Tube.objects.all(), facets=facets).form
+            self.assertEqual(list(form.fields['last_type'].choices)[1:], [('one', '1Ш (2)')])
+
+    def render_page(self):
+        view = TubesView(kwargs={'pipe_id': self.tube.pipe_id})
+        table = TubeTable(view.get_queryset())
+        RequestConfig(RequestFactory().get('/'), paginate={'per_page': 50}).configure(table)
+        return [[cell for cell in row] for row in table.paginated_rows]
+
+    def test_table_page_query_count_is_constant(self):
+        diagnostics = Diagnostics.objects.create(start_date=dt.date(2024, 8, 1))
+        TubeUnit.objects.create(tube=self.old, unit_type='mark')
+        with CaptureQueriesContext(connection) as queries:
+            self.render_page()
+        for num in range(2, 7):
+            self.tube = Tube.objects.create(pipe_id=self.tube.pipe_id, tube_num=str(num))
+            version = self.add_version(dt.date(2024, 8, 1), diagnostics=diagnostics)
+            TubeUnit.objects.create(tube=version, unit_type='mark')
+            TubeUnit.objects.create(tube=version, unit_type='tee')
+        with self.assertNumQueries(len(queries)):
+            rows = self.render_page()
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[-1][-2], 'Маркер, Тройник')
+        self.assertEqual(rows[-1][-1], 'ВТД, 01.08.2024 - ')
+
+
+class IliImportTest(TestCase):
+    """Пакетный импорт отчёта ВТД"""
+
+    def setUp(self):
+        pipeline = Pipeline.objects.create(title='Надым-Пунга 1')
+        self.pipe = Pipe.objects.create(pipeline=pipeline, start_point=0, end_point=10)
+        self.other = Pipe.objects.create(pipeline=pipeline, start_point=10, end_point=20)
+        Tube.objects.create(pipe=self.pipe, tube_num='2')
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.files = {
+            'tubes': self.workbook('tubes', [
+                ('Номер трубы', 'Расстояние, м', 'Длина трубы, м', 'Тип', 'Толщина, мм'),
+                ('1а', '0.000000', '2.450000', 'БШ', '30.000000', None, '461', '588', 'I', '1.34', ' ', None),
+                (2, '2.450000', '11.200000', '1Ш', '18.700000', '05:53', '461', '588', 'I', '1.34', None, 'Х-70'),
+                (3, '13.650000', '11.300000', '2Ш', '18.700000', '06:54', '461', '588', 'I', '1.34', None, 'Х-70'),
+                (9, '24.950000', '11.300000', '2Ш', '18.700000', '06:54', '461', '588', 'I', '1.34', None, 'Х-70'),
+            ]),
+            'units': self.workbook('units', [
+                ('Расстояние, м', 'Номер трубы', 'Тип особенности', 'Тип аббр,', 'описание', 'Комментарий'),
+                ('8.744000', 2, 'Тройник', 'TEE', None, 'Ду 1400 мм'),
+                ('30.000000', 9, 'Маркер', 'MARK', None, None),
+            ]),
+            'anomalies': self.workbook('anomalies', [
+                ('Расстояние, м', 'От левого шва до точки максимума, м'),
+                ('16.920000', '0.000000', '-0.031000', '-10.46', '-10.49', '-284', '-159', '95', '0', None,
+                 3, 'Смещение кромок', 'GWAN', None, '03:24', '03:44', '04:25', 0, 758, '4.169000',
+                 'EXT', 'Смещение кромок', None, '(c)'),
+            ]),
+            'bends': self.workbook('bends', [
+                ('Начало, м', 'Конец, м', 'Номер трубы'),
+                ('3.0', '12.0', 2, 2, '652.000000', 1, '0/1', 'Упруго-пластический изгиб', 'Вертикальная',
+                 'Радиус изгиба=459 D, координата=976.87, максимальное растяжение на 6.1 час. Прогиб 53.51 мм.'),
+                ('14.0', '20.0', 3, 1, '48.3', 7, None, 'Неизвестный', 'Горизонтальная', None),
+            ]),
+        }
+
+    def workbook(self, name, rows):
+        wb = Workbook()
+        for row in rows:
+            wb.active.append(row)
+        path = Path(self.tmp.name) / f'{name}.xlsx'
+        wb.save(path)
+        return path
+
+    def importer(self, **kwargs):
+        return IliImporter(
+            {self.pipe.id: '1а - 5', self.other.id: '6 - 10'},
+            '04.08.2025', '07.08.2025', **kwargs
+        )
+
+    def test_import(self):
+        importer = self.importer()
+        with self.assertNumQueries(30):
+            diagnostics = importer.run(self.files)
+        self.assertEqual(set(diagnostics.pipes.all()), {self.pipe, self.other})
+        self.assertEqual(Tube.objects.filter(pipe=self.pipe).count(), 3)
+        tube = Tube.objects.get(pipe=self.pipe, tube_num='2')
+        self.assertEqual(tube.latest_version.tube_length, 11.2)
+        self.assertEqual(tube.latest_version.tube_type, 'one')
+        self.assertEqual(Tube.objects.get(tube_num='9').pipe, self.other)
+        self.assertEqual(
+            set(TubeUnit.objects.values_list('tube__tube_num', 'unit_type')),
+            {('2', 'tee'), ('9', 'mark')}
+        )
+        anomaly = Anomaly.objects.get()
+        self.assertEqual((anomaly.tube.tube_num, anomaly.anomaly_nature, anomaly.location), ('3', 'gwan', 'ext'))
+        bend = Bend.objects.get()
+        self.assertEqual(bend.radius_in_diameters, 459)
+        self.assertEqual(bend.deflection, 53.51)
+        self.assertEqual([len(stat['errors']) for stat in importer.stats], [0, 0, 0, 1])
+        stats = DiagnosticStats.objects.get(diagnostics=diagnostics)
+        self.assertEqual(
+            (stats.tube_count, stats.unit_count, stats.bend_count, stats.anomaly_count),
+            (4, 2, 1, 1)
+        )
+        self.assertEqual(stats.danger_levels, {'(c)': 1})
+
+    def test_parallel_parse_matches_sequential(self):
+        parallel = self.importer(workers=4).parse(self.files)
+        sequential = self.importer(workers=1).parse(self.files)
+        for kind in self.files:
+            self.assertEqual(parallel[kind][:3], sequential[kind][:3])
+
+    def test_repeated_header_is_skipped(self):
+        header = ('Расстояние, м', 'Номер трубы', 'Тип особенности', 'Тип аббр,')
+        path = self.workbook('units_pages', [
+            header, ('8.744000', 2, 'Тройник', 'TEE'), header, ('30.0', 9, 'Маркер', 'MARK'),
+        ])
+        fields, rows, errors, _ = parse_workbook(path, 'units')
+        self.assertEqual([dict(zip(fields, row))['unit_type'] for row in rows], ['tee', 'mark'])
+        self.assertEqual(errors, [])
+
+    def test_repeated_import_requires_replace(self):
+        self.importer().run(self.files)
+        with self.assertRaises(ValueError):
+            self.importer().run(self.files)
+        counts = [model.objects.count() for model in (TubeUnit, Anomaly, Bend)]
+        deleted = []
+
+        def record_delete(sender, **kwargs):
+            deleted.append(sender)
+
+        # повторный импорт удаляет прежний прогон без сигналов на каждую строку
+        post_delete.connect(record_delete)
+        try:
+            self.importer(replace=True).run(self.files)
+        finally:
+            post_delete.disconnect(record_delete)
+        self.assertFalse(set(deleted) & {TubeVersion, TubeUnit, Anomaly, Bend, Defect})
+        self.assertEqual(TubeVersion.objects.count(), 4)
+        self.assertEqual(Tube.objects.count(), 4)
+        self.assertEqual([model.objects.count() for model in (TubeUnit, Anomaly, Bend)], counts)
+        self.assertFalse(Tube.objects.filter(latest_version__isnull=True).exists())
+
+    def test_replace_run_with_alignment(self):
+        earlier = IliImporter(
+            {self.pipe.id: '1а - 5', self.other.id: '6 - 10'}, '04.08.2020', '07.08.2020'
+        ).run(self.files)
+        later = self.importer().run(self.files)
+        align_runs(earlier, later)
+        self.assertTrue(TubeMatch.objects.exists())
+        self.assertTrue(AnomalyMatch.objects.exists())
+        IliImporter(
+            {self.pipe.id: '1а - 5', self.other.id: '6 - 10'}, '04.08.2020', '07.08.2020',
+            replace=True
+        ).run(self.files)
+        connection.check_constraints()
+        # сопоставления прежнего прогона удалены вместе с ним
+        self.assertFalse(RunAlignment.objects.exists())
+        self.assertFalse(TubeMatch.objects.exists())
+        self.assertFalse(AnomalyMatch.objects.exists())
+        self.assertEqual(TubeVersion.objects.filter(diagnostics=later).count(), 4)
+        self.assertEqual(align_runs(earlier, later).tube_count, 4)
+
+
+class BendCommentTest(TestCase):
+    """Разбор комментария отвода и заполнение полей загруженных отводов"""
+
+    def setUp(self):
+        self.version = TubeVersion.objects.create(
+            tube=Tube.objects.create(
+                pipe=Pipe.objects.create(
+                    pipeline=Pipeline.objects.create(title='Надым-Пунга 1'),
+                    start_point=0, end_point=10
+                ),
+                tube_num='1'
+            ),
+            date=dt.date(2024, 8, 1), version_type='diagnostic', tube_length=11.5, thickness=18.7,
+            diameter=1420
+        )
+
+    def test_parse(self):
+        self.assertEqual(
+            parse_bend_comment(
+                'Радиус изгиба=383 D, координата=6562.31, максимальное растяжение '
+                'на 0.1 час. Прогиб 155.24 мм. В зоне изгиба есть овальность.'
+            ),
+            {
+                'radius_in_diameters': 383, 'max_stress_coordinate': 6562.31,
+                'max_stress_orientation': '0.1', 'deflection': 155.24,
+            }
+        )
+        self.assertEqual(
+            parse_bend_comment('Косой стык. Отвод выпуклый вправо. Радиус отвода равен 45.7 Дн.'),
+            {'radius_in_diameters': 45.7}
+        )
+        self.assertEqual(parse_bend_comment('Косой стык на правом шве.'), {})
+        self.assertEqual(parse_bend_comment(None), {})
+
+    def test_backfill(self):
+        comment = 'Радиус изгиба=459 D, координата=8145.12, максимальное растяжение на 6 час. Прогиб 83.53 мм.'
+        bend = Bend.objects.create(
+            tube=self.version, start_point=1, end_point=2, radius=28.4,
+            bend_type='elastic_plastic', direction='vertical', comment=comment
+        )
+        self.assertEqual(bend.radius_in_diameters, 459)
+        plain = Bend.objects.create(
+            tube=self.version, start_point=3, end_point=4, radius=28.4,
+            bend_type='cold_bend', direction='vertical'
+        )
+        Bend.objects.update(
+            radius_in_diameters=None, max_stress_coordinate=None,
+            max_stress_orientation=None, deflection=None
+        )
+        call_command('backfill_bends', stdout=StringIO())
+        bend.refresh_from_db()
+        plain.refresh_from_db()
+        self.assertEqual(
+            (bend.radius_in_diameters, bend.max_stress_coordinate,
+             bend.max_stress_orientation, bend.deflection),
+            (459, 8145.12, '6', 83.53)
+        )
+        self.assertAlmostEqual(plain.radius_in_diameters, 20)
+
+
+class DiagnosticStatsTest(TestCase):
+    """Сводные количества ВТД вместо подсчёта в сериализаторе"""
+
+    def setUp(self):
+        self.pipeline = Pipeline.objects.create(title='Надым-Пунга 1')
+        self.user = ModuleUser.objects.create_user(username='engineer', password='password')
+        self.client.force_login(self.user)
+        self.diagnostics = self.create_diagnostics()
+
+    def create_diagnostics(self):
+        pipe = Pipe.objects.create(pipeline=self.pipeline, start_point=0, end_point=10)
+        diagnostics = Diagnostics.objects.create(start_date=dt.date(2024, 8, 1))
+        diagnostics.pipes.add(pipe)
+        for num in range(2):
+            version = TubeVersion.objects.create(
+                tube=Tube.objects.create(pipe=pipe, tube_num=str(num)),
+                diagnostics=diagnostics, date=dt.date(2024, 8, 1),
+                version_type='diagnostic', tube_length=11.5, thickness=18.7
+            )
+            TubeUnit.objects.create(tube=version, unit_type='mark')
+            for danger_level in ('(c)', '(b)'):
+                Anomaly.objects.create(
+                    tube=version, anomaly_nature='corr', danger_level=danger_level
+                )
+        Defect.objects.create(tube=version, defect_num=1, defect_type='dent')
+        return diagnostics
+
+    def test_refresh(self):
+        stats = DiagnosticStats.refresh([self.diagnostics.id])[self.diagnostics.id]
+        self.assertEqual(
+            (stats.tube_count, stats.unit_count, stats.bend_count,
+             stats.anomaly_count, stats.defects_count),
+            (2, 2, 0, 4, 1)
+        )
+        self.assertEqual(stats.danger_levels, {'(c)': 2, '(b)': 2})
+        self.assertEqual(stats.anomaly_natures, {'corr': 4})
+        self.assertEqual(stats.defect_types, {'dent': 1})
+
+    def test_refresh_upserts_existing_rows(self):
+        # пересчёты после двух коммитов: второй обновляет строку первого
+        DiagnosticStats.refresh([self.diagnostics.id])
+        with CaptureQueriesContext(connection) as queries:
+            stats = DiagnosticStats.refresh([self.diagnostics.id])[self.diagnostics.id]
+        self.assertFalse([query for query in queries if query['sql'].startswith('DELETE')])
+        self.assertEqual(stats.anomaly_count, 4)
+        self.assertEqual(DiagnosticStats.objects.get().anomaly_count, 4)
+
+    def test_read_does_not_write_stats(self):
+        diagnostics = DiagnosticStats.with_version(
+            Diagnostics.objects.select_related('stats')
+        ).get()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(DiagnosticStats.of(diagnostics).anomaly_count, 4)
+        self.assertFalse([query for query in queries if not query['sql'].startswith('SELECT')])
+        self.assertFalse(DiagnosticStats.objects.exists())
+        # изменение элемента пересчитывает статистику после коммита
+        with self.captureOnCommitCallbacks(execute=True):
+            Anomaly.objects.filter(danger_level='(b)').first().delete()
+        self.assertEqual(DiagnosticStats.objects.get().anomaly_count, 3)
+        # новая ВТД получает строку статистики после коммита
+        with self.captureOnCommitCallbacks(execute=True):
+            empty = Diagnostics.objects.create(start_date=dt.date(2024, 9, 1))
+        self.assertEqual(DiagnosticStats.objects.get(diagnostics=empty).tube_count, 0)
+
+    def test_stats_are_invalidated_on_edit(self):
+        DiagnosticStats.refresh([self.diagnostics.id])
+        Anomaly.objects.create(
+            tube=TubeVersion.objects.filter(diagnostics=self.diagnostics).first(),
+            anomaly_nature='dent', danger_level='(a)'
+        )
+        self.assertFalse(DiagnosticStats.objects.exists())
+        data = self.client.get(f'/api/diagnostics/{self.diagnostics.id}/').json()
+        self.assertEqual(data['anomaly_count'], 5)
+        self.assertEqual(data['danger_levels']['(a)'], 1)
+        self.assertEqual(data['pipeline'], 'Надым-Пунга 1')
+
+    def test_stale_stats_are_not_served(self):
+        DiagnosticStats.refresh([self.diagnostics.id])
+        with self.captureOnCommitCallbacks(execute=True):
+            Anomaly.objects.create(
+                tube=TubeVersion.objects.filter(diagnostics=self.diagnostics).first(),
+                anomaly_nature='dent', danger_level='(a)'
+            )
+            # пересчёт, начатый до изменения, записывает статистику после сброса
+            DiagnosticStats.objects.create(diagnostics=self.diagnostics, anomaly_count=4)
+        data = self.client.get(f'/api/diagnostics/{self.diagnostics.id}/').json()
+        self.assertEqual(data['anomaly_count'], 5)
+        # статистика импорта действует с новой версией после коммита
+        with self.captureOnCommitCallbacks(execute=True):
+            DiagnosticStats.refresh([self.diagnostics.id], renew=True)
+        diagnostics = Diagnostics.objects.select_related('stats').get(pk=self.diagnostics.id)
+        with self.assertNumQueries(1):  # только версия, без пересчёта
+            self.assertEqual(DiagnosticStats.of(diagnostics).version, diagnostics.stats.version)
+
+    def test_list_query_count_is_constant(self):
+        def list_queries():
+            DiagnosticStats.refresh(Diagnostics.objects.values_list('id', flat=True))
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/api/diagnostics/')
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        single = list_queries()
+        self.create_diagnostics()
+        self.create_diagnostics()
+        self.assertEqual(list_queries(), single)
+
+
+class NodeRootDepartmentTest(TestCase):
+    """Филиал узла хранится в узле и следует за подразделениями оборудования"""
+
+    def setUp(self):
+        self.root = Department.objects.create(name='Ново-Уренгойское ЛПУМГ')
+        self.service = Department.objects.create(name='Служба ЛЭС', parent=self.root)
+        self.other = Department.objects.create(name='Пангодинское ЛПУМГ')
+        self.equipment = Equipment.objects.create(name='Крановый узел 5')
+        self.equipment.departments.add(self.service)
+        self.node = Node.objects.create(
+            node_type='valve', pipeline=Pipeline.objects.create(title='Надым-Пунга 1'),
+            equipment=self.equipment, location_point=5
+        )
+
+    def assertRoot(self, department, name):
+        self.node.refresh_from_db()
+        self.assertEqual(self.node.root_department, department)
+        self.assertEqual(self.node.root_department_name, name)
+
+    def test_root_department(self):
+        self.assertRoot(self.root, 'Ново-Уренгойское ЛПУМГ')
+        node = Node.objects.select_related('pipeline').get()
+        with self.assertNumQueries(0):
+            self.assertEqual(str(node), 'Линейный кран 5.0 км г-да "Надым-Пунга 1"')
+            self.assertEqual(
+                NodeSerializer(node).data['department'],
+                {'id': self.root.pk, 'name': 'Ново-Уренгойское ЛПУМГ'}
+            )
+
+    def test_follows_changes(self):
+        self.equipment.departments.remove(self.service)
+        self.assertRoot(None, '')
+        # добавление со стороны подразделения (обратная сторона m2m)
+        self.other.equipments.add(self.equipment)
+        self.assertRoot(self.other, 'Пангодинское ЛПУМГ')
+        self.other.refresh_from_db()
+        self.other.name = 'Ямбургское ЛПУМГ'
+        self.other.save()
+        self.assertRoot(self.other, 'Ямбургское ЛПУМГ')
+        self.equipment.departments.set([self.service])
+        self.service.refresh_from_db()
+        self.other.refresh_from_db()
+        self.service.move_to(self.other)
+        self.assertRoot(self.other, 'Ямбургское ЛПУМГ')
+        self.other.delete()
+        self.assertRoot(None, '')
+
+    def test_new_department_does_not_scan_nodes(self):
+        with CaptureQueriesContext(connection) as queries:
+            Department.objects.create(name='Служба ЭВС', parent=self.root)
+        self.assertFalse(any('"pipelines_node"' in query['sql'] for query in queries))
+        self.assertRoot(self.root, 'Ново-Уренгойское ЛПУМГ')
+
+
+class CurrentPointersTest(TestCase):
+    """Указатели на текущие состояния и ограничения участков и узлов"""
+
+    def setUp(self):
+        pipeline = Pipeline.objects.create(title='Надым-Пунга 1')
+        self.pipe = Pipe.objects.create(pipeline=pipeline, start_point=0, end_point=10)
+        self.node = Node.objects.create(
+            node_type='valve', pipeline=pipeline, location_point=5,
+            equipment=Equipment.objects.create(name='Крановый узел 5')
+        )
+
+    def pointers(self):
+        pipe = Pipe.objects.get(pk=self.pipe.pk)
+        node = Node.objects.get(pk=self.node.pk)
+        return pipe.current_state_id, pipe.current_limit_id, node.current_state_id
+
+    def test_newer_record_supersedes_older(self):
+        older = PipeState.objects.create(
+            pipe=self.pipe, state_type='operation', start_date=dt.date(2025, 1, 1)
+        )
+        old_limit = PipeLimit.objects.create(
+            pipe=self.pipe, pressure_limit=50, start_date=dt.date(2025, 1, 1)
+        )
+        old_node_state = NodeState.objects.create(node=self.node, state_type='open')
+        self.assertEqual(self.pointers(), (older.pk, old_limit.pk, old_node_state.pk))
+        newer = PipeState.objects.create(
+            pipe=self.pipe, state_type='repair', start_date=dt.date(2025, 2, 1)
+        )
+        new_limit = PipeLimit.objects.create(
+            pipe=self.pipe, pressure_limit=45, start_date=dt.date(2025, 2, 1)
+        )
+        new_node_state = NodeState.objects.create(node=self.node, state_type='closed')
+        self.assertEqual(self.pointers(), (newer.pk, new_limit.pk, new_node_state.pk))
+        older.refresh_from_db()
+        self.assertEqual(older.end_date, dt.date(2025, 2, 1))
+        # правка закрытой записи не трогает указатель на текущую
+        older.description = 'Уточнение'
+        older.save()
+        old_limit.refresh_from_db()
+        old_limit.limit_reason = 'Уточнение'
+        old_limit.save()
+        old_node_state.refresh_from_db()
+        old_node_state.description = 'Уточнение'
+        old_node_state.save()
+        self.assertEqual(self.pointers(), (newer.pk, new_limit.pk, new_node_state.pk))
+
+    def test_closing_and_deleting_current(self):
+        state = PipeState.objects.create(
+            pipe=self.pipe, state_type='repair', start_date=dt.date(2025, 1, 1)
+        )
+        limit = PipeLimit.objects.create(
+            pipe=self.pipe, pressure_limit=50, start_date=dt.date(2025, 1, 1)
+        )
+        node_state = NodeState.objects.create(node=self.node, state_type='closed')
+        for record in (state, limit, node_state):
+            record.end_date = dt.date(2025, 3, 1)
+            record.save()
+        self.assertEqual(self.pointers(), (None, None, None))
+        state = PipeState.objects.create(
+            pipe=self.pipe, state_type='operation', start_date=dt.date(2025, 3, 1)
+        )
+        limit = PipeLimit.objects.create(
+            pipe=self.pipe, pressure_limit=45, start_date=dt.date(2025, 3, 1)
+        )
+        node_state = NodeState.objects.create(node=self.node, state_type='open')
+        self.assertEqual(self.pointers(), (state.pk, limit.pk, node_state.pk))
+        for record in (state, limit, node_state):
+            record.delete()
+        self.assertEqual(self.pointers(), (None, None, None))
+
+    def test_sync_command_backfills_pointers(self):
+        PipeState.objects.create(
+            pipe=self.pipe, state_type='operation', start_date=dt.date(2025, 1, 1)
+        )
+        state = PipeState.objects.create(
+            pipe=self.pipe, state_type='repair', start_date=dt.date(2025, 2, 1)
+        )
+        limit = PipeLimit.objects.create(
+            pipe=self.pipe, pressure_limit=50, start_date=dt.date(2025, 1, 1)
+        )
+        node_state = NodeState.objects.create(node=self.node, state_type='open')
+        other_pipe = Pipe.objects.create(
+            pipeline=self.pipe.pipeline, start_point=10, end_point=20
+        )
+        PipeState.objects.create(
+            pipe=other_pipe, state_type='operation', start_date=dt.date(2025, 1, 1),
+            end_date=dt.date(2025, 2, 1)
+        )
+        # ВТД, загруженная до появления статистики
+        diagnostics = Diagnostics.objects.create(start_date=dt.date(2024, 8, 1))
+        # данные, загруженные в обход save(): указатели пустые или устаревшие
+        Pipe.objects.update(current_state=None, current_limit=None)
+        Node.objects.update(current_state=None)
+        call_command('sync_current_states', stdout=StringIO())
+        self.assertEqual(self.pointers(), (state.pk, limit.pk, node_state.pk))
+        other_pipe.refresh_from_db()
+        self.assertIsNone(other_pipe.current_state_id)
+        self.assertTrue(DiagnosticStats.objects.filter(diagnostics=diagnostics).exists())
+
+
+class ObjectLabelsTest(TestCase):
+    """Филиалы и газопровод в списках ремонтов и ВТД из готовых подписей"""
+
+    def setUp(self):
+        self.root = Department.objects.create(name='Ново-Уренгойское ЛПУМГ')
+        self.service = Department.objects.create(name='Служба ЛЭС', parent=self.root)
+        self.other = Department.objects.create(name='Пангодинское ЛПУМГ')
+        self.pipeline = Pipeline.objects.create(title='Надым-Пунга 1')
+        self.sub_pipeline = Pipeline.objects.create(title='Надым-Пунга 2')
+        self.user = ModuleUser.objects.create_user(
+            username='admin', password='password', role=Role.ADMIN
+        )
+        self.client.force_login(self.user)
+        self.pipe = self.add_pipe(0)
+        equipment = Equipment.objects.create(name='Перемычка 5 км')
+        equipment.departments.add(self.service, self.other)
+        self.node = Node.objects.create(
+            node_type='bridge', pipeline=self.pipeline, sub_pipeline=self.sub_pipeline,
+            equipment=equipment, location_point=5
+        )
+
+    def add_pipe(self, num):
+        pipe = Pipe.objects.create(
+            pipeline=self.pipeline, start_point=num * 10, end_point=num * 10 + 10
+        )
+        PipeDepartment.objects.create(pipe=pipe, department=self.service)
+        Repair.objects.create(pipe=pipe, start_date=dt.date(2024, 6, 1))
+        diagnostics = Diagnostics.objects.create(start_date=dt.date(2024, 8, 1))
+        diagnostics.pipes.add(pipe)
+        return pipe
+
+    def test_labels(self):
+        self.assertEqual(
+            pipe_label(self.pipe.pk), ObjectLabel(('Ново-Уренгойское ЛПУМГ',), 'Надым-Пунга 1')
+        )
+        label = node_label(self.node.pk)
+        self.assertEqual(label.pipeline, 'Надым-Пунга 1  /  Надым-Пунга 2')
+        # оборудование узла закреплено за двумя филиалами
+        self.assertEqual(label.root_names(), 'Ново-Уренгойское ЛПУМГ / Пангодинское ЛПУМГ')
+        diagnostics = Diagnostics.objects.get()
+        other_pipe = Pipe.objects.create(pipeline=self.sub_pipeline, start_point=0, end_point=10)
+        PipeDepartment.objects.create(pipe=other_pipe, department=self.other)
+        diagnostics.pipes.add(other_pipe)
+        label = diagnostics_label(diagnostics.pk)
+        self.assertEqual(label.pipeline, 'Несколько (2)')
+        self.assertEqual(label.roots, ('Ново-Уренгойское ЛПУМГ', 'Пангодинское ЛПУМГ'))
+        self.assertEqual(diagnostics_label(0), EMPTY_LABEL)
+
+    def test_labels_follow_changes(self):
+        self.assertEqual(pipe_label(self.pipe.pk).root_names(), 'Ново-Уренгойское ЛПУМГ')
+        with self.assertNumQueries(0):
+            pipe_label(self.pipe.pk)
+        self.root.refresh_from_db()
+        self.root.name = 'Ямбургское ЛПУМГ'
+        self.root.save()
+        self.assertEqual(pipe_label(self.pipe.pk).root_names(), 'Ямбургское ЛПУМГ')
+        self.service.refresh_from_db()
+        self.other.refresh_from_db()
+        self.service.move_to(self.other)
+        self.assertEqual(pipe_label(self.pipe.pk).root_names(), 'Пангодинское ЛПУМГ')
+        self.pipeline.title = 'Надым-Пунга 3'
+        self.pipeline.save()
+        self.assertEqual(pipe_label(self.pipe.pk).pipeline, 'Надым-Пунга 3')
+
+    def test_labels_follow_other_process(self):
+        self.assertEqual(diagnostics_label(0), EMPTY_LABEL)
+        # import_ili в другом процессе: связь ВТД с участком и новая версия в БД
+        diagnostics = Diagnostics.objects.create(start_date=dt.date(2024, 9, 1))
+        Diagnostics.pipes.through.objects.bulk_create([
+            Diagnostics.pipes.through(diagnostics=diagnostics, pipe=self.pipe)
+        ])
+        CacheVersion.objects.update_or_create(
+            key=labels_version_key, defaults={'token': 'other'}
+        )
+        versions.reset()
+        self.assertEqual(diagnostics_label(diagnostics.pk).pipeline, 'Надым-Пунга 1')
+
+    def render_page(self, view_class):
+        request = RequestFactory().get('/')
+        request.user = self.user
+        view = view_class()
+        view.setup(request)
+        table = view.table_class(view.get_queryset())
+        RequestConfig(request, paginate={'per_page': view.paginate_by}).configure(table)
+        return [[cell for cell in row] for row in table.paginated_rows]
+
+    def test_node_repair_shows_all_branches(self):
+        Repair.objects.create(node=self.node, start_date=dt.date(2024, 7, 1))
+        rows = self.render_page(RepairsView)
+        self.assertIn(
+            'Ново-Уренгойское ЛПУМГ / Пангодинское ЛПУМГ', [row[0] for row in rows]
+        )
+
+    def test_list_query_count_is_constant(self):
+        get_labels()
+        DiagnosticStats.refresh(Diagnostics.objects.values_list('id', flat=True))
+        single = {}
+        for view_class in (RepairsView, DiagnosticsView):
+            with CaptureQueriesContext(connection) as queries:
+                self.render_page(view_class)
+            single[view_class] = len(queries)
+        for num in range(1, 4):
+            self.add_pipe(num)
+            # наименование узла не запрашивает подразделения (Node.root_department)
+            Repair.objects.create(node=self.node, start_date=dt.date(2024, 7, num))
+        get_labels()
+        DiagnosticStats.refresh(Diagnostics.objects.values_list('id', flat=True))
+        for view_class, query_count in single.items():
+            with self.assertNumQueries(query_count):
+                rows = self.render_page(view_class)
+            self.assertEqual(len(rows), 7 if view_class is RepairsView else 4)
+            self.assertEqual(rows[0][0], 'Ново-Уренгойское ЛПУМГ')
+            self.assertIn('Надым-Пунга 1', rows[0])
+
+
+class DiagnosticTilesTest(TestCase):
+    """Столбцовые данные прогона ВТД по окну одометра"""
+
+    def setUp(self):
+        pipe = Pipe.objects.create(
+            pipeline=Pipeline.objects.create(title='Надым-Пунга 1'),
+            start_point=0, end_point=10
+        )
+        self.diagnostics = Diagnostics.objects.create(start_date=dt.date(2024, 8, 1))
+        # 20 труб по 11.5 м, толщина растёт с номером
+        for num in range(20):
+            version = TubeVersion.objects.create(
+                tube=Tube.objects.create(pipe=pipe, tube_num=str(num)),
+                diagnostics=self.diagnostics, date=dt.date(2024, 8, 1),
+                version_type='diagnostic', odometr_data=num * 11.5,
+                tube_length=11.5, thickness=15 + num
+            )
+            if num % 5 == 0:
+                Anomaly.objects.create(
+                    tube=version, anomaly_nature='corr',
+                    odometr_data=num * 11.5 + 1, anomaly_depth=num
+                )
+        Bend.objects.create(tube=version, start_point=220, end_point=228, bend_angle=3.5)
+        self.url = f'/api/diagnostics/{self.diagnostics.id}/tiles/'
+        self.client.force_login(
+            ModuleUser.objects.create_user(username='engineer', password='password')
+        )
+
+    def column(self, layer, name):
+        return list(unpack(layer['columns'][name], 'd' if name == 'odometr' else 'f'))
+
+    def test_raw_window(self):
+        data = self.client.get(self.url, {'from': 20, 'to': 60}).json()
+        self.assertEqual(data['lod'], 0)
+        self.assertEqual(data['tubes']['count'], 4)
+        self.assertEqual(self.column(data['tubes'], 'odometr'), [23.0, 34.5, 46.0, 57.5])
+        self.assertEqual(self.column(data['tubes'], 'thickness'), [17, 18, 19, 20])
+        self.assertEqual(self.column(data['anomalies'], 'depth'), [5])
+        self.assertEqual(data['tubes']['dtypes']['odometr'], 'float64')
+
+    def test_aggregated_level_is_stored_and_invalidated(self):
+        data = self.client.get(self.url, {'from': 50, 'to': 150, 'lod': 2}).json()
+        self.assertEqual(data['bucket'], 100)
+        self.assertEqual(self.column(data['tubes'], 'odometr'), [0, 100])
+        self.assertEqual(self.column(data['tubes'], 'count'), [9, 9])
+        self.assertEqual(self.column(data['tubes'], 'thickness_min'), [15, 24])
+        self.assertEqual(self.column(data['anomalies'], 'depth_max'), [5, 15])
+        self.assertTrue(DiagnosticTile.objects.filter(diagnostics=self.diagnostics, lod=2).exists())
+        with CaptureQueriesContext(connection) as stored:
+            self.client.get(self.url, {'from': 150, 'to': 250, 'lod': 2})
+        self.assertFalse(any('GROUP BY' in query['sql'] for query in stored))
+        data = self.client.get(self.url, {'from': 150, 'to': 250, 'lod': 2}).json()
+        self.assertEqual(self.column(data['bends'], 'angle_max'), [3.5])
+        Anomaly.objects.create(
+            tube=TubeVersion.objects.get(tube__tube_num='19'),
+            anomaly_nature='dent', odometr_data=219, anomaly_depth=30
+        )
+        self.assertFalse(DiagnosticTile.objects.exists())
+        data = self.client.get(self.url, {'from': 150, 'to': 250, 'lod': 2}).json()
+        self.assertEqual(self.column(data['anomalies'], 'depth_max'), [15, 30])
+
+    def test_stale_level_is_not_served(self):
+        stale = self.client.get(self.url, {'from': 150, 'to': 250, 'lod': 2}).json()
+        content = DiagnosticTile.objects.get(lod=2).content
+        with self.captureOnCommitCallbacks(execute=True):
+            Anomaly.objects.create(
+                tube=TubeVersion.objects.get(tube__tube_num='19'),
+                anomaly_nature='dent', odometr_data=219, anomaly_depth=30
+            )
+            # сборка, начатая до изменения, записывает агрегаты после сброса
+            DiagnosticTile.objects.create(diagnostics=self.diagnostics, lod=2, content=content)
+        self.assertEqual(self.column(stale['anomalies'], 'depth_max'), [15])
+        data = self.client.get(self.url, {'from': 150, 'to': 250, 'lod': 2}).json()
+        self.assertEqual(self.column(data['anomalies'], 'depth_max'), [15, 30])
+
+    def test_window_parameters(self):
+        data = self.client.get(self.url).json()
+        self.assertEqual((data['from'], data['to'], data['lod']), (0, 218.5, 0))
+        self.assertEqual(data['tubes']['count'], 20)
+        self.assertEqual(self.client.get(self.url, {'from': 0, 'to': 90000}).json()['lod'], 2)
+        for params in (
+            {'from': 'x'}, {'lod': 7}, {'from': 0, 'to': 90000, 'lod': 0},
+            {'from': 'nan', 'to': 10}, {'to': 'inf'}, {'from': '-inf', 'to': 5},
+        ):
+            self.assertEqual(self.client.get(self.url, params).status_code, 400)
+
+
+class AnomalyAssessmentTest(TestCase):
+    """Оценка аномалий потери металла по модифицированной методике B31G"""
+
+    def setUp(self):
+        self.pipe = Pipe.objects.create(
+            pipeline=Pipeline.objects.create(title='Надым-Пунга 1'),
+            start_point=0, end_point=10
+        )
+        self.diagnostics = Diagnostics.objects.create(start_date=dt.date(2024, 8, 1))
+        self.version = TubeVersion.objects.create(
+            tube=Tube.objects.create(pipe=self.pipe, tube_num='1'),
+            diagnostics=self.diagnostics, date=dt.date(2024, 8, 1),
+            version_type='diagnostic', tube_length=11.5, thickness=18.7,
+            diameter=1420, yield_strength='461.000000', tear_strength='588 МПа'
+        )
+
+    def anomaly(self, depth, length=200, nature='corr', version=None):
+        return Anomaly.objects.create(
+            tube=version or self.version, anomaly_nature=nature,
+            anomaly_depth=depth, anomaly_length=length
+        )
+
+    def test_zero_strength_is_missing(self):
+        # так импорт записывает отсутствующие пределы текучести и прочности
+        reference = self.anomaly(50)
+        zero_tensile = TubeVersion.objects.create(
+            tube=Tube.objects.create(pipe=self.pipe, tube_num='2'),
+            diagnostics=self.diagnostics, date=dt.date(2024, 8, 1),
+            version_type='diagnostic', tube_length=11.5, thickness=18.7,
+            diameter=1420, yield_strength='461.000000', tear_strength='0.0'
+        )
+        zero_yield = TubeVersion.objects.create(
+            tube=Tube.objects.create(pipe=self.pipe, tube_num='3'),
+            diagnostics=self.diagnostics, date=dt.date(2024, 8, 1),
+            version_type='diagnostic', tube_length=11.5, thickness=18.7,
+            diameter=1420, yield_strength='0', tear_strength='0'
+        )
+        anomaly = self.anomaly(50, version=zero_tensile)
+        self.anomaly(50, version=zero_yield)
+        self.assertEqual(assess_diagnostics(self.diagnostics), 2)
+        assessment = anomaly.assessment
+        # без предела прочности напряжение течения = текучесть + 68,95 МПа
+        flow_stress = 461 + 68.95
+        self.assertAlmostEqual(
+            assessment.burst_pressure,
+            2 * flow_stress * 0.8277 * 18.7 / 1420 * 10.1972,
+            places=1,
+        )
+        self.assertAlmostEqual(assessment.burst_pressure, reference.assessment.burst_pressure)
+        self.assertFalse(assessment.exceeds_limit)
+
+    def test_assessment(self):
+        corrosion = self.anomaly(50)
+        deep = self.anomaly(85)
+        self.anomaly(50, nature='dent')
+        no_strength = TubeVersion.objects.create(
+            tube=Tube.objects.create(pipe=self.pipe, tube_num='2'),
+            diagnostics=self.diagnostics, date=dt.date(2024, 8, 1),
+            version_type='diagnostic', tube_length=11.5, thickness=18.7
+        )
+        self.anomaly(20, version=no_strength)
+        with self.assertNumQueries(5):  # выборка, удаление, вставка и точка сохранения
+            self.assertEqual(assess_diagnostics(self.diagnostics), 2)
+        assessment = corrosion.assessment
+        self.assertAlmostEqual(assessment.remaining_strength, 0.8277, places=4)
+        self.assertAlmostEqual(assessment.burst_pressure, 117.81, places=2)
+        self.assertAlmostEqual(assessment.safe_pressure, 84.76, places=2)
+        self.assertAlmostEqual(assessment.erf, 75.5 / 84.756, places=3)
+        self.assertFalse(assessment.exceeds_limit)
+        deep = AnomalyAssessment.objects.get(anomaly=deep)
+        self.assertEqual((deep.safe_pressure, deep.erf, deep.exceeds_limit), (0, None, True))
+
+    def test_erf_follows_pressure_limit(self):
+        anomaly = self.anomaly(50)
+        assess_diagnostics(self.diagnostics)
+        limit = PipeLimit.objects.create(
+            pipe=self.pipe, pressure_limit=90, start_date=dt.date(2024, 9, 1)
+        )
+        assessment = AnomalyAssessment.objects.get(anomaly=anomaly)
+        self.assertEqual(assessment.operating_pressure, 90)
+        self.assertTrue(assessment.exceeds_limit)
+        limit.delete()
+        assessment.refresh_from_db()
+        self.assertEqual(assessment.operating_pressure, 75.5)
+        self.assertFalse(assessment.exceeds_limit)
+
+
+class AnomalyClusteringTest(TestCase):
+    """Группировка взаимодействующих аномалий (расстояние не больше 6 толщин стенки)"""
+
+    def setUp(self):
+        self.pipe = Pipe.objects.create(
+            pipeline=Pipeline.objects.create(title='Надым-Пунга 1'),
+            start_point=0, end_point=10
+        )
+        self.diagnostics = Diagnostics.objects.create(start_date=dt.date(2024, 8, 1))
+        self.version = TubeVersion.objects.create(
+            tube=Tube.objects.create(pipe=self.pipe, tube_num='1'),
+            diagnostics=self.diagnostics, date=dt.date(2024, 8, 1),
+            version_type='diagnostic', tube_length=11.5, thickness=18.7,
+            diameter=1420, yield_strength='461.000000'
+        )
+
+    def anomaly(self, start, clock, depth=30, length=100, width=50):
+        return Anomaly.objects.create(
+            tube=self.version, anomaly_nature='corr', anomaly_depth=depth,
+            anomaly_length=length, anomaly_width=width,
+            from_left_weld_to_start=start, center_orientation=clock
+        )
+
+    def test_clusters(self):
+        first = self.anomaly(1.0, '03:00', length=200)
+        second = self.anomaly(1.25, '03:10', depth=45)
+        far = self.anomaly(5.0, '03:00')
+        before_noon = self.anomaly(8.0, '11:55')
+        after_noon = self.anomaly(8.05, '00:05')
+        self.assertEqual(cluster_diagnostics(self.diagnostics), 2)
+        first.refresh_from_db()
+        far.refresh_from_db()
+        cluster = first.cluster
+        self.assertEqual(cluster.anomaly_count, 2)
+        self.assertEqual(set(cluster.anomalies.all()), {first, second})
+        self.assertAlmostEqual(cluster.axial_start, 1.0)
+        self.assertAlmostEqual(cluster.length, 350)
+        self.assertAlmostEqual(cluster.width, 50 + np.pi * 1420 / 72, places=3)
+        self.assertEqual((cluster.center_orientation, cluster.max_depth), ('03:05', 45))
+        self.assertIsNone(far.cluster)
+        noon = Anomaly.objects.get(id=before_noon.id).cluster
+        self.assertEqual(noon, Anomaly.objects.get(id=after_noon.id).cluster)
+        self.assertEqual(noon.center_orientation, '00:00')
+
+        # повторный расчёт заменяет группы
+        self.assertEqual(cluster_diagnostics(self.diagnostics), 2)
+        self.assertEqual(AnomalyCluster.objects.count(), 2)
+
+    def test_assessment_uses_cluster_size(self):
+        first = self.anomaly(1.0, '03:00', length=200)
+        self.anomaly(1.25, '03:10', depth=45)
+        cluster_diagnostics(self.diagnostics)
+        assess_diagnostics(self.diagnostics)
+        _, remaining = modified_b31g(0.45, 350, 1420, 18.7, 461, np.nan)
+        self.assertAlmostEqual(
+            AnomalyAssessment.objects.get(anomaly=first).remaining_strength, float(remaining)
+        )
+
+
+class OdometerCalibrationTest(TestCase):
+    """Привязка одометра ВТД к километражу по кранам и маркерам"""
+
+    def setUp(self):
+        # версии в БД откатываются вместе с тестом, преобразования в памяти процесса — нет
+        ili_calibration._local.clear()
+        self.pipeline = Pipeline.objects.create(title='Надым-Пунга 1')
+        self.pipe = Pipe.objects.create(pipeline=self.pipeline, start_point=100, end_point=150)
+        self.nodes = [
+            Node.objects.create(
+                node_type='valve', pipeline=self.pipeline, location_point=km,
+                equipment=Equipment.objects.create(name=f'Крановый узел {km}'),
+            )
+            for km in (105, 120, 140)
+        ]
+        self.user = ModuleUser.objects.create_user(username='engineer', password='password')
+        self.client.force_login(self.user)
+
+    def create_run(self, start_km, km_per_metre):
+        """Прогон 0..50000 м, фактический километраж: start_km + одометр * km_per_metre"""
+        diagnostics = Diagnostics.objects.create(start_date=dt.date(2024, 8, 1))
+        diagnostics.pipes.add(self.pipe)
+        tube = Tube.objects.create(pipe=self.pipe, tube_num=str(diagnostics.pk))
+        for odometer in (0, 50000):
+            version = TubeVersion.objects.create(
+                tube=tube, diagnostics=diagnostics, date=dt.date(2024, 8, 1),
+                version_type='diagnostic', odometr_data=odometer,
+                tube_length=11.5, thickness=18.7
+            )
+        for node, unit_type in zip(self.nodes, ('valv', 'mark', 'valv')):
+            TubeUnit.objects.create(
+                tube=version, unit_type=unit_type,
+                odometr_data=(node.location_point - start_km) / km_per_metre,
+            )
+        TubeUnit.objects.create(tube=version, unit_type='tee', odometr_data=12000)
+        Anomaly.objects.create(tube=version, odometr_data=30000, anomaly_nature='corr')
+        return diagnostics
+
+    def test_forward_run(self):
+        diagnostics = self.create_run(100.3, 0.00099)
+        calibration = get_calibration(diagnostics.id)
+        self.assertEqual(calibration.reference_count, 3)
+        np.testing.assert_allclose(
+            to_km(calibration, [0, 30000, 50000, np.nan]),
+            [100.3, 100.3 + 29.7, 100.3 + 49.5, np.nan]
+        )
+        np.testing.assert_allclose(
+            to_odometer(calibration, [120, 149.8]), [19898.99, 50000], rtol=1e-6
+        )
+        # чтение не записывает привязку, её сохраняет пересчёт после коммита
+        self.assertFalse(OdometerCalibration.objects.exists())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.nodes[0].save()
+        stored = get_calibration(diagnostics.id)
+        self.assertEqual(stored.odometer, calibration.odometer)
+        self.assertEqual(stored.kilometres, calibration.kilometres)
+        # повторное чтение сверяет версию и отдаёт преобразование из памяти
+        with self.assertNumQueries(1):
+            self.assertIs(get_calibration(diagnostics.id), stored)
+
+    def test_reverse_run(self):
+        diagnostics = self.create_run(149.7, -0.00099)
+        calibration = get_calibration(diagnostics.id)
+        self.assertEqual(calibration.reference_count, 3)
+        self.assertEqual(calibration.kilometres, sorted(calibration.kilometres, reverse=True))
+        _, km = anomaly_kilometres(calibration)
+        np.testing.assert_allclose(km, [149.7 - 29.7])
+
+    def test_invalidated_and_api(self):
+        diagnostics = self.create_run(100.3, 0.00099)
+        get_calibration(diagnostics.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.nodes[1].location_point = 121
+            self.nodes[1].save()
+            self.assertFalse(OdometerCalibration.objects.exists())
+        data = self.client.get(f'/api/diagnostics/{diagnostics.id}/kilometres/').json()
+        self.assertEqual(data['reference_count'], 2)
+        self.assertEqual(len(data['anomalies']['km']), 1)
+        TubeUnit.objects.filter(unit_type='tee').delete()
+        self.assertFalse(OdometerCalibration.objects.exists())
+        unlinked = Diagnostics.objects.create(start_date=dt.date(2024, 9, 1))
+        response = self.client.get(f'/api/diagnostics/{unlinked.id}/kilometres/')
+        self.assertEqual(response.status_code, 400)
+
+    def test_rebuild_command(self):
+        diagnostics = self.create_run(100.3, 0.00099)
+        unlinked = Diagnostics.objects.create(start_date=dt.date(2024, 9, 1))
+        out = StringIO()
+        call_command('rebuild_ili_aggregates', '--all', stdout=out)
+        self.assertIn('привязок к километражу: 1', out.getvalue())
+        stored = OdometerCalibration.objects.get()
+        self.assertEqual(stored.diagnostics_id, diagnostics.id)
+        self.assertEqual(stored.reference_count, 3)
+        # сохранённая привязка читается без расчёта
+        with self.assertNumQueries(1):
+            self.assertEqual(get_calibration(diagnostics.id).odometer, stored.odometer)
+        self.assertFalse(OdometerCalibration.objects.filter(diagnostics=unlinked).exists())
+
+    def test_stale_calibration_is_not_served(self):
+        diagnostics = self.create_run(100.3, 0.00099)
+        stale = get_calibration(diagnostics.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.nodes[1].location_point = 121
+            self.nodes[1].save()
+            # расчёт, начатый до изменения узла, записывает привязку после сброса
+            stale.save(force_insert=True)
+        calibration = get_calibration(diagnostics.id)
+        self.assertEqual(calibration.reference_count, 2)
+        self.assertTrue(calibration.version)
+
+
+class BendSpatialIndexTest(TestCase):
+    """Поиск отводов ВТД по координатам"""
+
+    def setUp(self):
+        # версии в БД откатываются вместе с тестом, индексы в памяти процесса — нет
+        geo._local.clear()
+        self.diagnostics = Diagnostics.objects.create(start_date=dt.date(2024, 8, 1))
+        self.tube = TubeVersion.objects.create(
+            tube=Tube.objects.create(
+                pipe=Pipe.objects.create(
+                    pipeline=Pipeline.objects.create(title='Надым-Пунга 1'),
+                    start_point=0, end_point=10
+                ),
+                tube_num='1'
+            ),
+            diagnostics=self.diagnostics, date=dt.date(2024, 8, 1),
+            version_type='diagnostic', odometr_data=0, tube_length=11.5, thickness=18.7
+        )
+        self.user = ModuleUser.objects.create_user(username='engineer', password='password')
+        self.client.force_login(self.user)
+
+    def create_bend(self, start_point, latitude, longitude):
+        return Bend.objects.create(
+            tube=self.tube, start_point=start_point, end_point=start_point + 1,
+            latitude=latitude, longitude=longitude,
+        )
+
+    def test_matches_brute_force(self):
+        rng = np.random.default_rng(7)
+        # извилистая трасса около 50 км с разбросом точек
+        count = 5000
+        odometer = np.sort(rng.uniform(0, 50000, count))
+        latitude = 65.0 + odometer / 111320 * 0.8 + rng.normal(0, 0.0005, count)
+        longitude = 72.0 + np.sin(odometer / 5000) * 0.05 + rng.normal(0, 0.0005, count)
+        rows = [
+            (pk, start, lat, lon, np.nan)
+            for pk, start, lat, lon in zip(range(count), odometer, latitude, longitude)
+        ]
+        index = GridIndex.load(GridIndex.build(rows).dump())
+        x, y = index.project(latitude, longitude)
+        for lat, lon, k in ((65.1, 72.01, 5), (65.3, 72.2, 20), (60.0, 70.0, 3), (65.2, 72.0, 1)):
+            indices, distances = index.nearest(lat, lon, k)
+            qx, qy = index.project(lat, lon)
+            expected = np.sort(np.hypot(x - qx, y - qy))[:k]
+            np.testing.assert_allclose(distances, expected)
+            np.testing.assert_allclose(
+                np.hypot(index.points['x'][indices] - qx, index.points['y'][indices] - qy),
+                distances,
+            )
+        self.assertEqual(len(index.nearest(65.1, 72.0, count + 10)[0]), count)
+        south, west, north, east = 65.1, 72.0, 65.2, 72.04
+        inside = (
+            (latitude >= south) & (latitude <= north) & (longitude >= west) & (longitude <= east)
+        )
+        found = index.within(south, west, north, east)
+        self.assertEqual(
+            sorted(index.points['id'][found].tolist()), np.flatnonzero(inside).tolist()
+        )
+        self.assertEqual(len(index.within(60, 70, 61, 71)), 0)
+        # окна за пределами сетки и с бесконечными или неопределёнными границами
+        self.assertEqual(len(index.within(-90, -180, 90, 180)), count)
+        self.assertEqual(len(index.cells(-np.inf, -np.inf, np.inf, np.inf)), count)
+        self.assertEqual(len(index.cells(np.nan, 0, 1, 1)), 0)
+        self.assertEqual(len(index.nearest(np.nan, 72.0, 5)[0]), 0)
+
+    def test_persisted_and_invalidated(self):
+        self.create_bend(10, 65.0, 72.0)
+        self.create_bend(20, 65.0001, 72.0001)
+        self.create_bend(30, None, None)
+        index = get_index(self.diagnostics.id)
+        self.assertEqual(len(index), 2)
+        # чтение не записывает индекс, его сохраняет сборка после коммита
+        self.assertFalse(BendSpatialIndex.objects.exists())
+        with self.assertNumQueries(1):
+            self.assertIs(get_index(self.diagnostics.id), index)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_bend(40, 65.0002, 72.0002)
+        self.assertEqual(BendSpatialIndex.objects.get().point_count, 3)
+        self.assertEqual(len(get_index(self.diagnostics.id)), 3)
+        empty = Diagnostics.objects.create(start_date=dt.date(2024, 9, 1))
+        self.assertEqual(len(get_index(empty.id)), 0)
+        self.assertEqual(len(get_index(empty.id).nearest(65.0, 72.0, 5)[0]), 0)
+
+    def test_rebuild_command(self):
+        Bend.objects.bulk_create([
+            Bend(tube=self.tube, start_point=km, end_point=km + 1, latitude=65.0, longitude=72.0)
+            for km in (10, 20)
+        ])
+        out = StringIO()
+        call_command('rebuild_ili_aggregates', str(self.diagnostics.id), stdout=out)
+        self.assertIn('индексов отводов: 1', out.getvalue())
+        self.assertEqual(BendSpatialIndex.objects.get().point_count, 2)
+        self.assertEqual(len(get_index(self.diagnostics.id)), 2)
+
+    def test_stale_index_is_not_served(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_bend(10, 65.0, 72.0)
+        stale = BendSpatialIndex.objects.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_bend(20, 65.0001, 72.0001)
+            # сборка, начатая до изменения, записывает индекс после сброса
+            stale.save(force_insert=True)
+        self.assertEqual(len(get_index(self.diagnostics.id)), 2)
+        self.assertEqual(BendSpatialIndex.objects.get().point_count, 2)
+
+    def test_rebuilt_once_per_transaction(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            for km in range(5):
+                self.create_bend(km * 10, 65.0 + km * 0.001, 72.0)
+        with CaptureQueriesContext(connection) as queries:
+            for callback in callbacks:
+                callback()
+        sql = [query['sql'] for query in queries.captured_queries]
+        # версии всех ключей меняются одной записью, индекс и статистика считаются по разу
+        self.assertEqual(
+            len([q for q in sql if q.startswith('UPDATE') and 'cacheversion' in q]), 1
+        )
+        self.assertEqual(
+            len([q for q in sql if q.startswith('SELECT') and '"latitude" IS NOT NULL' in q]), 1
+        )
+        self.assertEqual(BendSpatialIndex.objects.get().point_count, 5)
+        self.assertEqual(DiagnosticStats.objects.get().bend_count, 5)
+
+    def test_api(self):
+        bends = [self.create_bend(km * 100, 65.0 + km * 0.001, 72.0) for km in range(10)]
+        url = f'/api/diagnostics/{self.diagnostics.id}'
+        data = self.client.get(f'{url}/bends-nearest/?lat=65.0041&lon=72.0&k=2').json()
+        self.assertEqual([item['id'] for item in data['bends']], [bends[4].id, bends[5].id])
+        self.assertIsNone(data['bends'][0]['altitude'])
+        self.assertAlmostEqual(data['bends'][0]['distance'], 11.13, places=1)
+        data = self.client.get(
+            f'{url}/bends-bbox/?south=65.0025&west=71.9&north=65.0065&east=72.1'
+        ).json()
+        self.assertEqual([item['id'] for item in data['bends']], [b.id for b in bends[3:7]])
+        self.assertFalse(data['truncated'])
+        for query in ('bends-nearest/?lat=65', 'bends-nearest/?lat=65&lon=72&k=0',
+                      'bends-nearest/?lat=nan&lon=72', 'bends-nearest/?lat=inf&lon=72',
+                      'bends-nearest/?lat=91&lon=72', 'bends-nearest/?lat=65&lon=-181',
+                      'bends-bbox/?south=-1e308&west=-1e308&north=1e308&east=1e308',
+                      'bends-bbox/?south=nan&west=71&north=65&east=72',
+                      'bends-bbox/?south=66&west=71&north=65&east=72'):
+            self.assertEqual(self.client.get(f'{url}/{query}').status_code, 400)
+        self.assertEqual(
+            self.client.get('/api/diagnostics/0/bends-nearest/?lat=65&lon=72').status_code, 404
+        )
+
+class RunAlignmentTest(TestCase):
+    """Сопоставление двух прогонов ВТД"""
+
+    LENGTHS = [11.2, 11.5, 2.4, 11.3, 10.9, 11.6, 11.4, 5.1, 11.5, 11.1, 11.3, 11.8]
+
+    def setUp(self):
+        self.pipe = Pipe.objects.create(
+            pipeline=Pipeline.objects.create(title='Надым-Пунга 1'),
+            start_point=0, end_point=10
+        )
+        self.earlier = Diagnostics.objects.create(start_date=dt.date(2019, 8, 1))
+        self.later = Diagnostics.objects.create(start_date=dt.date(2024, 8, 1))
+
+    def create_run(self, diagnostics, lengths, odometr, anomalies, tube_prefix):
+        versions = []
+        for num, (length, start) in enumerate(zip(lengths, odometr)):
+            versions.append(TubeVersion.objects.create(
+                tube=Tube.objects.create(pipe=self.pipe, tube_num=f'{tube_prefix}{num}'),
+                diagnostics=diagnostics, date=diagnostics.start_date,
+                version_type='diagnostic', odometr_data=start,
+                tube_length=length, thickness=20
+            ))
+        for num, position, clock, depth in anomalies:
+            Anomaly.objects.create(
+                tube=versions[num], anomaly_nature='corr',
+                odometr_data=versions[num].odometr_data + position,
+                from_left_weld_to_max=position, max_point_orientation=clock,
+                anomaly_depth=depth, anomaly_length=50
+            )
+        return versions
+
+    def test_alignment_with_drift_and_missing_weld(self):
+        earlier = self.create_run(
+            self.earlier, self.LENGTHS, np.cumsum([0] + self.LENGTHS[:-1]),
+            [(3, 4.0, '03:00', 10), (3, 4.1, '09:00', 12), (8, 7.5, '06:00', 20)], 'a'
+        )
+        # последующий прогон: другой номер труб, смещение и растяжение одометра,
+        # шов между трубами 5 и 6 не обнаружен
+        lengths = [length + 0.03 for length in self.LENGTHS]
+        lengths[5:7] = [lengths[5] + lengths[6]]
+        odometr = 3 + 1.004 * np.cumsum([0] + lengths[:-1])
+        later = self.create_run(
+            self.later, lengths, odometr,
+            [(3, 4.05, '03:10', 15), (3, 4.12, '08:50', 13), (7, 7.45, '06:20', 30)], 'b'
+        )
+        alignment = align_runs(self.earlier, self.later)
+        pairs = set(TubeMatch.objects.values_list('earlier_id', 'later_id'))
+        expected = {(earlier[i].id, later[i].id) for i in range(5)} | {
+            (earlier[i].id, later[i - 1].id) for i in range(7, 12)
+        }
+        self.assertEqual(pairs, expected)
+        self.assertEqual(alignment.tube_count, 10)
+        growth = {
+            match.earlier.anomaly_depth: round(match.depth_rate, 2)
+            for match in AnomalyMatch.objects.select_related('earlier')
+        }
+        years = (self.later.start_date - self.earlier.start_date).days / 365.25
+        self.assertEqual(growth, {
+            10: round(5 / years, 2), 12: round(1 / years, 2), 20: round(10 / years, 2)
+        })
+        self.assertAlmostEqual(
+            AnomalyMatch.objects.get(earlier__anomaly_depth=20).depth_rate_mm, 10 / years * 0.2
+        )
+        # сопоставления доступны и со стороны предыдущего прогона
+        self.assertEqual(
+            [match.later_id for match in earlier[3].later_matches.all()], [later[3].id]
+        )
+        self.assertEqual(
+            Anomaly.objects.get(anomaly_depth=20).later_matches.get().later.anomaly_depth, 30
+        )
+        # повторный расчёт заменяет сохранённые пары
+        align_runs(self.earlier, self.later)
+        self.assertEqual(RunAlignment.objects.count(), 1)
+        self.assertEqual(TubeMatch.objects.count(), 10)
+
+    def test_same_tubes_are_used_as_anchors(self):
+        earlier = self.create_run(self.earlier, self.LENGTHS, np.cumsum([0] + self.LENGTHS[:-1]), [], 'a')
+        # большой сдвиг одометра, концы прогонов не совпадают: опорой служат общие трубы
+        for version in earlier[2:10]:
+            TubeVersion.objects.create(
+                tube=version.tube, diagnostics=self.later, date=self.later.start_date,
+                version_type='diagnostic', odometr_data=version.odometr_data + 40,
+                tube_length=version.tube_length, thickness=20
+            )
+        self.assertEqual(align_runs(self.earlier, self.later).tube_count, 8)
+        self.assertEqual(
+            {round(shift, 6) for shift in TubeMatch.objects.values_list('odometr_shift', flat=True)},
+            {-40}
+        )
+
+    def test_later_run_must_be_later(self):
+        with self.assertRaises(ValueError):
+            align_runs(self.later, self.earlier)
+
+
+class OdometerPaginationTest(TestCase):
+    """Постраничный вывод по курсору одометра"""
+
+    def setUp(self):
+        pipe = Pipe.objects.create(
+            pipeline=Pipeline.objects.create(title='Надым-Пунга 1'),
+            start_point=0, end_point=10
+        )
+        self.pipe = pipe
+        self.diagnostics = Diagnostics.objects.create(start_date=dt.date(2024, 8, 1))
+        # повторяющиеся значения одометра и строка без одометра
+        for num, odometr in enumerate([None, 0, 12.5, 12.5, 12.5, 24.1, 36.0, 48.2, 60.3]):
+            tube = Tube.objects.create(pipe=pipe, tube_num=str(num))
+            TubeVersion.objects.create(
+                tube=tube, diagnostics=self.diagnostics, date=dt.date(2024, 8, 1),
+                version_type='diagnostic', odometr_data=odometr,
+                tube_length=11.5, thickness=18.7
+            )
+        self.versions = TubeVersion.objects.filter(diagnostics=self.diagnostics)
+        self.expected = [version.pk for version in self.versions.order_by('pk')]
+
+    def page(self, **params):
+        return paginate_by_odometer(self.versions, 'odometr_data', params, 2)
+
+    def test_walk_forward_and_back(self):
+        seen = []
+        page = self.page()
+        self.assertIsNone(page.previous_cursor)
+        while True:
+            seen += [row.pk for row in page]
+            if not page.next_cursor:
+                break
+            with self.assertNumQueries(1):
+                page = self.page(after=page.next_cursor)
+        self.assertEqual(seen, self.expected)
+        back = []
+        while page.previous_cursor:
+            page = self.page(before=page.previous_cursor)
+            back = [row.pk for row in page] + back
+        self.assertEqual(back, self.expected[:-1])
+
+    def test_jump_to_distance(self):
+        with self.assertNumQueries(2):  # страница и наличие предыдущих строк
+            page = self.page(distance='24,1')
+        self.assertEqual([row.odometr_data for row in page], [24.1, 36.0])
+        self.assertEqual(page.start, 24.1)
+        previous = self.page(before=page.previous_cursor)
+        self.assertEqual([row.odometr_data for row in previous], [12.5, 12.5])
+        self.assertEqual(len(self.page(after='bad cursor')), 2)
+
+    def test_diagnostic_tubes_view(self):
+        view = DiagnosticTubesView()
+        view.setup(RequestFactory().get('/', {'distance': 30}), diagnostic_id=self.diagnostics.id)
+        view.object_list = view.get_queryset()
+        table = view.get_table()
+        self.assertEqual([row.record.odometr_data for row in table.rows], [36.0, 48.2, 60.3])
+        self.assertIsNotNone(table.odometer_page.previous_cursor)
+        self.assertIsNone(table.odometer_page.next_cursor)
+
+    def test_cursor_table_is_rendered(self):
+        user = ModuleUser.objects.create_user(username='engineer', password='password')
+        self.client.force_login(user)
+        url = f'/pipelines/diagnostics/{self.diagnostics.id}/tubes/'
+        # сортировка по столбцу не применяется: страница идёт по одометру
+        response = self.client.get(url, {'distance': 30, 'sort': '-tube_length'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'module_app/table/cursor_table.html')
+        table = response.context['table']
+        self.assertEqual([row.record.odometr_data for row in table.rows], [36.0, 48.2, 60.3])
+        self.assertFalse(any(column.orderable for column in table.columns))
+        self.assertContains(response, 'name="distance"')
+        self.assertContains(response, 'value="36.0"')
+        self.assertContains(
+            response, 'before=' + quote(table.odometer_page.previous_cursor, safe='')
+        )
+
+    def test_api_pagination(self):
+        user = ModuleUser.objects.create_user(username='engineer', password='password')
+        self.client.force_login(user)
+        url = f'/api/pipes/{self.pipe.id}/tubes/'
+        self.assertEqual(len(self.client.get(url).json()), 9)
+        data = self.client.get(url, {'distance': 12.5, 'page_size': 2}).json()
+        self.assertEqual([tube['tube_num'] for tube in data['results']], ['2', '3'])
+        self.assertEqual(data['start'], 12.5)
+        data = self.client.get(data['next']).json()
+        self.assertEqual([tube['tube_num'] for tube in data['results']], ['4', '5'])
@@ -0,0 +1,153 @@
+"""
+Столбцовые данные прогона ВТД вдоль одометра для отрисовки на клиенте.
+
+Уровень 0 — отдельные трубы, аномалии и отводы в окне одометра.
+Уровни 1 и выше — агрегаты по интервалам LOD_BUCKETS[lod] метров,
+собранные один раз для всего прогона и сохранённые в DiagnosticTile.
+Каждый столбец — массив чисел little-endian в base64 (Float64Array/Float32Array
+на клиенте), пустые значения — NaN.
+"""
+import base64
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+
+from django.db.models import Count, F, Max, Min, Sum
+from django.db.models.functions import Floor
+
+from pipelines.models import Anomaly, Bend, DiagnosticTile, TubeVersion
+
+# Ширина интервала агрегирования, м; уровень 0 — без агрегирования
+LOD_BUCKETS = [None, 10, 100, 1000]
+# Наибольшее окно для уровня 0 и число интервалов, на которое подбирается уровень
+RAW_WINDOW = 20000
+MAX_BUCKETS = 5000
+
+# Тип столбца: 'd' — float64 (одометр), 'f' — float32
+DTYPES = {'d': 'float64', 'f': 'float32'}
+
+# (имя, queryset по ВТД, поле одометра, столбцы уровня 0, агрегаты)
+LAYERS = [
+    (
+        'tubes',
+        lambda diagnostics_id: TubeVersion.objects.filter(diagnostics_id=diagnostics_id),
+        'odometr_data',
+        {'length': 'tube_length', 'thickness': 'thickness'},
+        {
+            'length': Sum('tube_length'),
+            'thickness_min': Min('thickness'),
+            'thickness_max': Max('thickness'),
+        },
+    ),
+    (
+        'anomalies',
+        lambda diagnostics_id: Anomaly.objects.filter(tube__diagnostics_id=diagnostics_id),
+        'odometr_data',
+        {'depth': 'anomaly_depth'},
+        {'depth_max': Max('anomaly_depth')},
+    ),
+    (
+        'bends',
+        lambda diagnostics_id: Bend.objects.filter(tube__diagnostics_id=diagnostics_id),
+        'start_point',
+        {'angle': 'bend_angle'},
+        {'angle_max': Max('bend_angle')},
+    ),
+]
+
+
+def pack(values, typecode='f'):
+    buffer = array(typecode, (float('nan') if value is None else value for value in values))
+    if sys.byteorder == 'big':
+        buffer.byteswap()
+    return base64.b64encode(buffer.tobytes()).decode('ascii')
+
+
+def unpack(data, typecode='f'):
+    buffer = array(typecode)
+    buffer.frombytes(base64.b64decode(data))
+    if sys.byteorder == 'big':
+        buffer.byteswap()
+    return buffer
+
+
+def typecode(column):
+    return 'd' if column == 'odometr' else 'f'
+
+
+def columns(rows, names):
+    """Строки values_list -> упакованные столбцы, первый столбец — одометр"""
+    values = list(zip(*rows)) or [()] * len(names)
+    return {
+        'count': len(rows),
+        'columns': {name: pack(column, typecode(name)) for name, column in zip(names, values)},
+    }
+
+
+def raw_window(diagnostics_id, start, end):
+    """Уровень 0: элементы с одометром в [start, end]"""
+    layers = {}
+    for name, queryset, field, fields, _ in LAYERS:
+        rows = list(queryset(diagnostics_id).filter(
+            **{f'{field}__gte': start, f'{field}__lte': end}
+        ).order_by(field, 'pk').values_list(field, *fields.values()))
+        layers[name] = columns(rows, ['odometr', *fields])
+    return layers
+
+
+def build_level(diagnostics_id, lod):
+    """Агрегаты всего прогона: по одному сгруппированному запросу на тип элементов"""
+    size = LOD_BUCKETS[lod]
+    layers = {}
+    for name, queryset, field, _, aggregates in LAYERS:
+        rows = queryset(diagnostics_id).filter(
+            **{f'{field}__isnull': False}
+        ).annotate(
+            bucket=Floor(F(field) / size)
+        ).values('bucket').annotate(
+            count=Count('pk'), **aggregates
+        ).order_by('bucket').values_list('bucket', 'count', *aggregates)
+        rows = [(row[0] * size, *row[1:]) for row in rows]
+        layers[name] = columns(rows, ['odometr', 'count', *aggregates])
+    return layers
+
+
+def slice_level(layers, start, end, size):
+    """Интервалы уровня, пересекающиеся с окном [start, end]"""
+    result = {}
+    for name, layer in layers.items():
+        odometr = unpack(layer['columns']['odometr'], 'd')
+        first, last = bisect_left(odometr, start - size), bisect_right(odometr, end)
+        result[name] = {
+            'count': max(last - first, 0),
+            'columns': {
+                column: pack(unpack(data, typecode(column))[first:last], typecode(column))
+                for column, data in layer['columns'].items()
+            },
+        }
+    return result
+
+
+def choose_lod(start, end):
+    """Самый подробный уровень, укладывающийся в окно"""
+    if end - start <= RAW_WINDOW:
+        return 0
+    for lod, size in enumerate(LOD_BUCKETS[1:], 1):
+        if (end - start) / size <= MAX_BUCKETS:
+            return lod
+    return len(LOD_BUCKETS) - 1
+
+
+def window(diagnostics_id, start, end, lod):
+    """Столбцы окна [start, end] на уровне lod с описанием типов"""
+    if lod == 0:
+        layers = raw_window(diagnostics_id, start, end)
+    else:
+        size = LOD_BUCKETS[lod]
+        layers = slice_level(
+            DiagnosticTile.get(diagnostics_id, lod, lambda: build_level(diagnostics_id, lod)),
+            start, end, size
+        )
+    for layer in layers.values():
+        layer['dtypes'] = {column: DTYPES[typecode(column)] for column in layer['columns']}
+    return layers
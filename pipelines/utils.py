@@ -1,30 +1,29 @@
 import os
 import re
-import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date, datetime
 from pathlib import Path
 
 import django
+from django.conf import settings
+from django.db import models, transaction
 from openpyxl import load_workbook
 
-# BASE_URL = r"G:\WorkDocuments\Dev\module_app"
-BASE_URL = r"D:\Development\module_app"
-
-# Настройка Django окружения
-sys.path.append(BASE_URL)
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "module_app.settings")
-django.setup()
-
-
-from pipelines.models import (
-    Anomaly, Bend, Diagnostics, Pipe, Tube, TubeUnit, TubeVersion)
-
-Bend.objects.all().delete()
-Tube.objects.all().delete()
-TubeVersion.objects.all().delete()
-TubeUnit.objects.all().delete()
-Anomaly.objects.all().delete()
-Diagnostics.objects.all().delete()
+from pipelines.db import delete_rows, insert_rows
+from pipelines.models import (Anomaly, Bend, BendSpatialIndex, Diagnostics,
+                              DiagnosticStats, DiagnosticTile, FilterFacets,
+                              OdometerCalibration, Pipe, RunAlignment,
+                              SchemeSnapshot, Tube, TubeUnit, TubeVersion)
+
+# Каталог с отчётами ВТД: <DATA_DIR>/<name>/<префикс>_<name>.xlsx
+DATA_DIR = Path(settings.BASE_DIR) / 'fixtures' / 'data'
+FILE_PREFIXES = {
+    'tubes': 'tubes',
+    'units': 'tubeunits',
+    'anomalies': 'anomalies',
+    'bends': 'bends',
+}
 
 ''' импорт труб
 0 tube_num
@@ -94,6 +93,36 @@ Diagnostics.objects.all().delete()
 '''
 
 HEADER_KEYWORDS = ["Номер трубы", "Толщина", "Тип трубы", 'Расстояние, м']
+TUBE_TYPE_MAP = {
+    '1Ш': 'one',
+    '2Ш': 'two',
+    'СШ': 'spiral',
+    'БШ': 'without',
+}
+# тип элемента определяется по аббревиатуре из отчёта (VALV, TEE, ...)
+UNIT_TYPE_MAP = {
+    "кран": "valv",
+    "отвод": "offt",
+    "врезка": "offt",
+    "тройник": "tee",
+    "эхз": "cpco",
+    "окно": "wiwd",
+    "футляр-начало": "casb",
+    "футляр-конец": "case",
+    "маркер": "mark",
+    "пригруз": "anch",
+    "обустройство": "pfix",
+}
+BEND_TYPE_MAP = {
+    'Упруго-пластический изгиб': 'elastic_plastic',
+    'Отвод холодного гнутья': 'cold_bend',
+    'Отвод сегментный': 'segment_bend',
+}
+DIRECTION_MAP = {
+    'Вертикальная': 'vertical',
+    'Горизонтальная': 'horizontal',
+}
+
 DATA = [
     {
         'name': 'nord_uu',
@@ -103,10 +132,6 @@ DATA = [
             3: "5110 - 7351",
             4: "7353 - 7466",
         },
-        'filepath_tubes': BASE_URL + r"\fixtures\data\nord_uu\tubes_nord_uu.xlsx",
-        'filepath_units': BASE_URL + r"\fixtures\data\nord_uu\tubeunits_nord_uu.xlsx",
-        'filepath_anomalies': BASE_URL + r"\fixtures\data\nord_uu\anomalies_nord_uu.xlsx",
-        'filepath_bends': BASE_URL + r"\fixtures\data\nord_uu\bends_nord_uu.xlsx",
         'diagnostics_start': '04.08.2025',
         'diagnostics_end': '07.08.2025',
     },
@@ -118,10 +143,6 @@ DATA = [
             6: "133а - 2732",
             7: "2734 - 5452",
         },
-        'filepath_tubes': BASE_URL + r"\fixtures\data\south_uu\tubes_south_uu.xlsx",
-        'filepath_units': BASE_URL + r"\fixtures\data\south_uu\tubeunits_south_uu.xlsx",
-        'filepath_anomalies': BASE_URL + r"\fixtures\data\south_uu\anomalies_south_uu.xlsx",
-        'filepath_bends': BASE_URL + r"\fixtures\data\south_uu\bends_south_uu.xlsx",
         'diagnostics_start': '24.06.2023',
         'diagnostics_end': '29.06.2023',
     },
@@ -133,10 +154,6 @@ DATA = [
             9: "5159 - 7421",
             10: "7423 - 7498б",
         },
-        'filepath_tubes': BASE_URL + r"\fixtures\data\nord_c1\tubes_nord_c1.xlsx",
-        'filepath_units': BASE_URL + r"\fixtures\data\nord_c1\tubeunits_nord_c1.xlsx",
-        'filepath_anomalies': BASE_URL + r"\fixtures\data\nord_c1\anomalies_nord_c1.xlsx",
-        'filepath_bends': BASE_URL + r"\fixtures\data\nord_c1\bends_nord_c1.xlsx",
         'diagnostics_start': '06.03.2024',
         'diagnostics_end': '24.03.2024',
     },
@@ -148,10 +165,6 @@ DATA = [
             18: "118б - 2803",
             19: "2805 - 5600",
         },
-        'filepath_tubes': BASE_URL + r"\fixtures\data\south_uc1\tubes_south_uc1.xlsx",
-        'filepath_units': BASE_URL + r"\fixtures\data\south_uc1\tubeunits_south_uc1.xlsx",
-        'filepath_anomalies': BASE_URL + r"\fixtures\data\south_uc1\anomalies_south_uc1.xlsx",
-        'filepath_bends': BASE_URL + r"\fixtures\data\south_uc1\bends_south_uc1.xlsx",
         'diagnostics_start': '11.08.2025',
         'diagnostics_end': '15.08.2025',
     },
@@ -163,10 +176,6 @@ DATA = [
             15: "5196 - 7479",
             16: "7481 - 7538а",
         },
-        'filepath_tubes': BASE_URL + r"\fixtures\data\nord_c2\tubes_nord_c2.xlsx",
-        'filepath_units': BASE_URL + r"\fixtures\data\nord_c2\tubeunits_nord_c2.xlsx",
-        'filepath_anomalies': BASE_URL + r"\fixtures\data\nord_c2\anomalies_nord_c2.xlsx",
-        'filepath_bends': BASE_URL + r"\fixtures\data\nord_c2\bends_nord_c2.xlsx",
         'diagnostics_start': '04.04.2025',
         'diagnostics_end': '07.04.2025',
     },
@@ -178,10 +187,6 @@ DATA = [
             15: "133а - 2828а",
             16: "2830 - 5596",
         },
-        'filepath_tubes': BASE_URL + r"\fixtures\data\south_c2\tubes_south_c2.xlsx",
-        'filepath_units': BASE_URL + r"\fixtures\data\south_c2\tubeunits_south_c2.xlsx",
-        'filepath_anomalies': BASE_URL + r"\fixtures\data\south_c2\anomalies_south_c2.xlsx",
-        'filepath_bends': BASE_URL + r"\fixtures\data\south_c2\bends_south_c2.xlsx",
         'diagnostics_start': '19.08.2024',
         'diagnostics_end': '23.08.2024',
     },
@@ -193,10 +198,6 @@ DATA = [
             21: "5174 - 7432",
             22: "7434 - 7534",
         },
-        'filepath_tubes': BASE_URL + r"\fixtures\data\nord_e1\tubes_nord_e1.xlsx",
-        'filepath_units': BASE_URL + r"\fixtures\data\nord_e1\tubeunits_nord_e1.xlsx",
-        'filepath_anomalies': BASE_URL + r"\fixtures\data\nord_e1\anomalies_nord_e1.xlsx",
-        'filepath_bends': BASE_URL + r"\fixtures\data\nord_e1\bends_nord_e1.xlsx",
         'diagnostics_start': '13.02.2024',
         'diagnostics_end': '17.02.2024',
     },
@@ -208,10 +209,6 @@ DATA = [
             24: "104 - 2809",
             25: "2811 - 5575",
         },
-        'filepath_tubes': BASE_URL + r"\fixtures\data\south_e1\tubes_south_e1.xlsx",
-        'filepath_units': BASE_URL + r"\fixtures\data\south_e1\tubeunits_south_e1.xlsx",
-        'filepath_anomalies': BASE_URL + r"\fixtures\data\south_e1\anomalies_south_e1.xlsx",
-        'filepath_bends': BASE_URL + r"\fixtures\data\south_e1\bends_south_e1.xlsx",
         'diagnostics_start': '04.12.2024',
         'diagnostics_end': '10.12.2024',
     },
@@ -223,10 +220,6 @@ DATA = [
     #         27: "5242а - 7496",
     #         28: "7498 - 7651",
     #     },
-    #     'filepath_tubes': BASE_URL + r"\fixtures\data\nord_e2\tubes_nord_e2.xlsx",
-    #     'filepath_units': BASE_URL + r"\fixtures\data\nord_e2\tubeunits_nord_e2.xlsx",
-    #     'filepath_anomalies': BASE_URL + r"\fixtures\data\nord_e2\anomalies_nord_e2.xlsx",
-    #     'filepath_bends': BASE_URL + r"\fixtures\data\nord_e2\bends_nord_e2.xlsx",
     #     'diagnostics_start': '13.08.2024',
     #     'diagnostics_end': '17.08.2024',
     # },
@@ -238,10 +231,6 @@ DATA = [
             30: "56 - 2795",
             31: "2797 - 5581",
         },
-        'filepath_tubes': BASE_URL + r"\fixtures\data\south_e2\tubes_south_e2.xlsx",
-        'filepath_units': BASE_URL + r"\fixtures\data\south_e2\tubeunits_south_e2.xlsx",
-        'filepath_anomalies': BASE_URL + r"\fixtures\data\south_e2\anomalies_south_e2.xlsx",
-        'filepath_bends': BASE_URL + r"\fixtures\data\south_e2\bends_south_e2.xlsx",
         'diagnostics_start': '17.01.2023',
         'diagnostics_end': '21.01.2023',
     },
@@ -253,10 +242,6 @@ DATA = [
             33: "5242а - 7496",
             34: "7498 - 7651",
         },
-        'filepath_tubes': BASE_URL + r"\fixtures\data\nord_zg\tubes_nord_zg.xlsx",
-        'filepath_units': BASE_URL + r"\fixtures\data\nord_zg\tubeunits_nord_zg.xlsx",
-        'filepath_anomalies': BASE_URL + r"\fixtures\data\nord_zg\anomalies_nord_zg.xlsx",
-        'filepath_bends': BASE_URL + r"\fixtures\data\nord_zg\bends_nord_zg.xlsx",
         'diagnostics_start': '14.12.2023',
         'diagnostics_end': '18.12.2023',
     },
@@ -268,10 +253,6 @@ DATA = [
             36: "34 - 2753",
             37: "2755 - 5545",
         },
-        'filepath_tubes': BASE_URL + r"\fixtures\data\south_zg\tubes_south_zg.xlsx",
-        'filepath_units': BASE_URL + r"\fixtures\data\south_zg\tubeunits_south_zg.xlsx",
-        'filepath_anomalies': BASE_URL + r"\fixtures\data\south_zg\anomalies_south_zg.xlsx",
-        'filepath_bends': BASE_URL + r"\fixtures\data\south_zg\bends_south_zg.xlsx",
         'diagnostics_start': '05.10.2023',
         'diagnostics_end': '09.10.2023',
     },
@@ -283,10 +264,6 @@ DATA = [
             39: "5259 - 7430",
             40: "7432 - 7535",
         },
-        'filepath_tubes': BASE_URL + r"\fixtures\data\nord_t1\tubes_nord_t1.xlsx",
-        'filepath_units': BASE_URL + r"\fixtures\data\nord_t1\tubeunits_nord_t1.xlsx",
-        'filepath_anomalies': BASE_URL + r"\fixtures\data\nord_t1\anomalies_nord_t1.xlsx",
-        'filepath_bends': BASE_URL + r"\fixtures\data\nord_t1\bends_nord_t1.xlsx",
         'diagnostics_start': '23.08.2023',
         'diagnostics_end': '28.08.2023',
     },
@@ -298,10 +275,6 @@ DATA = [
             42: "140 - 2924",
             43: "2926 - 5718",
         },
-        'filepath_tubes': BASE_URL + r"\fixtures\data\south_yat1\tubes_south_yat1.xlsx",
-        'filepath_units': BASE_URL + r"\fixtures\data\south_yat1\tubeunits_south_yat1.xlsx",
-        'filepath_anomalies': BASE_URL + r"\fixtures\data\south_yat1\anomalies_south_yat1.xlsx",
-        'filepath_bends': BASE_URL + r"\fixtures\data\south_yat1\bends_south_yat1.xlsx",
         'diagnostics_start': '11.10.2024',
         'diagnostics_end': '15.10.2024',
     },
@@ -313,10 +286,6 @@ DATA = [
             45: "5219 - 7417",
             46: "7419 - 7503",
         },
-        'filepath_tubes': BASE_URL + r"\fixtures\data\nord_yat2\tubes_nord_yat2.xlsx",
-        'filepath_units': BASE_URL + r"\fixtures\data\nord_yat2\tubeunits_nord_yat2.xlsx",
-        'filepath_anomalies': BASE_URL + r"\fixtures\data\nord_yat2\anomalies_nord_yat2.xlsx",
-        'filepath_bends': BASE_URL + r"\fixtures\data\nord_yat2\bends_nord_yat2.xlsx",
         'diagnostics_start': '04.02.2025',
         'diagnostics_end': '07.02.2025',
     },
@@ -328,10 +297,6 @@ DATA = [
             48: "174 - 2910",
             49: "2912 - 5756",
         },
-        'filepath_tubes': BASE_URL + r"\fixtures\data\south_yat2\tubes_south_yat2.xlsx",
-        'filepath_units': BASE_URL + r"\fixtures\data\south_yat2\tubeunits_south_yat2.xlsx",
-        'filepath_anomalies': BASE_URL + r"\fixtures\data\south_yat2\anomalies_south_yat2.xlsx",
-        'filepath_bends': BASE_URL + r"\fixtures\data\south_yat2\bends_south_yat2.xlsx",
         'diagnostics_start': '16.10.2025',
         'diagnostics_end': '18.10.2025',
     },
@@ -343,10 +308,6 @@ DATA = [
             51: "5513 - 7791",
             52: "7793 - 7943",
         },
-        'filepath_tubes': BASE_URL + r"\fixtures\data\nord_pov\tubes_nord_pov.xlsx",
-        'filepath_units': BASE_URL + r"\fixtures\data\nord_pov\tubeunits_nord_pov.xlsx",
-        'filepath_anomalies': BASE_URL + r"\fixtures\data\nord_pov\anomalies_nord_pov.xlsx",
-        'filepath_bends': BASE_URL + r"\fixtures\data\nord_pov\bends_nord_pov.xlsx",
         'diagnostics_start': '01.07.2023',
         'diagnostics_end': '05.07.2023',
     },
@@ -358,10 +319,6 @@ DATA = [
             54: "137а - 2873а",
             55: "2875а - 5742",
         },
-        'filepath_tubes': BASE_URL + r"\fixtures\data\south_pov\tubes_south_pov.xlsx",
-        'filepath_units': BASE_URL + r"\fixtures\data\south_pov\tubeunits_south_pov.xlsx",
-        'filepath_anomalies': BASE_URL + r"\fixtures\data\south_pov\anomalies_south_pov.xlsx",
-        'filepath_bends': BASE_URL + r"\fixtures\data\south_pov\bends_south_pov.xlsx",
         'diagnostics_start': '20.02.2024',
         'diagnostics_end': '26.02.2024',
     },
@@ -373,10 +330,6 @@ DATA = [
             57: "5528 - 7825",
             58: "7827 - 7988",
         },
-        'filepath_tubes': BASE_URL + r"\fixtures\data\nord_srtou\tubes_nord_srtou.xlsx",
-        'filepath_units': BASE_URL + r"\fixtures\data\nord_srtou\tubeunits_nord_srtou.xlsx",
-        'filepath_anomalies': BASE_URL + r"\fixtures\data\nord_srtou\anomalies_nord_srtou.xlsx",
-        'filepath_bends': BASE_URL + r"\fixtures\data\nord_srtou\bends_nord_srtou.xlsx",
         'diagnostics_start': '07.02.2023',
         'diagnostics_end': '11.02.2023',
     },
@@ -388,16 +341,20 @@ DATA = [
             60: "132 - 2874",
             61: "2876 - 5662",
         },
-        'filepath_tubes': BASE_URL + r"\fixtures\data\south_srtou\tubes_south_srtou.xlsx",
-        'filepath_units': BASE_URL + r"\fixtures\data\south_srtou\tubeunits_south_srtou.xlsx",
-        'filepath_anomalies': BASE_URL + r"\fixtures\data\south_srtou\anomalies_south_srtou.xlsx",
-        'filepath_bends': BASE_URL + r"\fixtures\data\south_srtou\bends_south_srtou.xlsx",
         'diagnostics_start': '09.02.2025',
         'diagnostics_end': '12.02.2025',
     },
 ]
 
 
+def survey_files(name, data_dir=DATA_DIR):
+    """Пути к четырём файлам отчёта ВТД по имени из DATA"""
+    return {
+        kind: Path(data_dir) / name / f'{prefix}_{name}.xlsx'
+        for kind, prefix in FILE_PREFIXES.items()
+    }
+
+
 def is_header(row):
     """Определяем, является ли строка заголовком таблицы."""
     row_str = " ".join([str(x) for x in row if x])
@@ -438,463 +395,378 @@ def parse_range(range_str: str):
     return start, end
 
 
-def find_pipe_for_tube(tube_num, pipe_ranges):
-    """Определяем участок (Pipe) по номеру трубы."""
-    num, _ = extract_number_and_suffix(tube_num)
-    if num is None:
-        return None
-    for pipe_id, range_str in pipe_ranges.items():
-        start, end = parse_range(range_str)
-        # диапазон закрытый (включаем края)
-        if start <= num <= end:
-            try:
-                return Pipe.objects.get(id=pipe_id)
-            except Pipe.DoesNotExist:
-                print(f"⚠️ Pipe id={pipe_id} не найден")
-                return None
-    return None
-
-
-def get_or_create_diagnostics_for_pipes(pipe_ids, start_str, end_str):
-    """Создаёт (или получает) один объект Diagnostics, связанный со всеми участками."""
-    start_date = datetime.strptime(start_str, "%d.%m.%Y").date()
-    end_date = datetime.strptime(end_str, "%d.%m.%Y").date()
-
-    # Пробуем найти существующую диагностику
-    diagnostics = Diagnostics.objects.filter(
-        start_date=start_date,
-        end_date=end_date,
-    ).first()
-
-    if not diagnostics:
-        # Создаём без вызова full_clean()
-        diagnostics = Diagnostics.objects.create(
-            start_date=start_date,
-            end_date=end_date,
-            description=f"Диагностика участков {', '.join(map(str, pipe_ids))} ({start_date}–{end_date})"
-        )
-        print(f"🧾 Создан новый объект диагностики (id={diagnostics.id})")
-    else:
-        print(f"ℹ️ Найдена существующая диагностика ({start_date}–{end_date}) id={diagnostics.id}")
-
-    # Теперь безопасно добавляем участки (M2M)
-    for pipe_id in pipe_ids:
-        try:
-            pipe = Pipe.objects.get(id=pipe_id)
-            diagnostics.pipes.add(pipe)
-        except Pipe.DoesNotExist:
-            print(f"⚠️ Участок id={pipe_id} не найден")
-
-    # Теперь вызываем clean(), чтобы модель прошла проверку
-    diagnostics.full_clean()
-    diagnostics.save()
-    return diagnostics
-
-
-def import_tubes(
-        filepath,
-        filepath_units,
-        filepath_anomalies,
-        filepath_bends,
-        pipe_ranges: dict,
-        diagnostics_start: str,
-        diagnostics_end: str
-    ):
-    TUBE_TYPE_MAP = {
-        '1Ш': 'one',
-        '2Ш': 'two',
-        'СШ': 'spiral',
-        'БШ': 'without',
-    }
-    print(f"📘 Импорт из файла: {filepath}")
-    wb = load_workbook(filepath, read_only=True, data_only=True)
-    ws = wb.active
-    # создаём/находим диагностику, связанную со всеми участками
-    diagnostics = get_or_create_diagnostics_for_pipes(pipe_ranges.keys(), diagnostics_start, diagnostics_end)
-    header_found = False
-    created_versions = 0
-    created_tubes = 0
-
-    for i, row in enumerate(ws.iter_rows(values_only=True), start=1):
-        if is_header(row):
-            header_found = True
-            continue
-        if not header_found:
-            continue
-        if not row[1]:  # пустая строка
-            continue
-        if is_header(row):  # повторная шапка
-            continue
-
-        tube_num = str(row[0]).strip()
-        pipe = find_pipe_for_tube(tube_num, pipe_ranges)
-        if pipe is None:
-            continue
-
-        # --- Tube ---
-        tube, created = Tube.objects.get_or_create(
-            pipe=pipe,
-            tube_num=tube_num,
-            defaults={"active": True, "installed_date": date.today()},
-        )
-        if created:
-            created_tubes += 1
-
-        # --- TubeVersion ---
-        raw_type = str(row[3]).strip() if row[3] else None
-        tube_type = TUBE_TYPE_MAP.get(raw_type, 'without')
-        if tube_type is None:
-            raise ValueError(f'Неизвестный тип трубы: {raw_type}')
-        try:
-            TubeVersion.objects.create(
-                tube=tube,
-                diagnostics=diagnostics,
-                version_type="diagnostic",
-                date=diagnostics.end_date,
-                tube_num=tube_num,
-                odometr_data = float(row[1]) if row[1] else 0,
-                tube_length=float(row[2]) if row[2] else 0,
-                tube_type=tube_type,
-                thickness=float(row[4]) if row[4] else 0,
-                weld_position=str(row[5]).strip() if row[5] else None,
-                yield_strength=float(row[6]) if row[6] else 0,
-                tear_strength=float(row[7]) if row[7] else 0,
-                category=str(row[8]).strip() if row[8] else "II",
-                reliability_material=float(row[9]) if row[9] else None,
-                comment=str(row[10]).strip() if row[10] else None,
-                steel_grade=str(row[11]).strip() if row[11] else None,
-                # reliability_coef=float(row[12]) if row[12] else None,
-                # reliability_pressure=float(row[13]) if row[13] else None,
-                # working_conditions=float(row[14]) if row[14] else None,
-                # impact_strength=float(row[15]) if row[15] else None,
-                # from_reference_start=str(row[15]).strip() if row[15] else None,
-                # to_reference_end=str(row[16]).strip() if row[16] else None,
-            )
-            created_versions += 1
-        except Exception as e:
-            print(f"⚠️ Ошибка в строке {i}: {e}")
-            continue
-    print(f"\n✅ Импорт завершён:")
-    print(f"  • труб создано — {created_tubes}")
-    print(f"  • версий создано — {created_versions}")
-    print(f"  • диагностика ID={diagnostics.id}, диапазон {diagnostics_start}–{diagnostics_end}")
-    import_tube_units(filepath_units, diagnostics)
-    import_anomalies(filepath_anomalies, diagnostics)
-    import_bends(filepath_bends, diagnostics)
+def to_float(value, default=None):
+    value = clean_cell_value(value)
+    return default if value is None else value
 
 
-def import_tube_units(filepath, diagnostics):
-    """
-    Импорт элементов обустройства и привязка к TubeVersion последней диагностики.
-    """
-    print(f"📘 Импорт элементов обустройства из: {filepath}")
-    wb = load_workbook(filepath, read_only=True, data_only=True)
-    ws = wb.active
-    header_found = False
-    created_units = 0
+def to_int(value):
+    value = clean_cell_value(value)
+    return None if value is None else int(value)
 
-    for i, row in enumerate(ws.iter_rows(values_only=True), start=1):
-        # Пропуск мусора и шапок
-        if not any(row):
-            continue
-        row_str = " ".join([str(x) for x in row if x])
-        if any(keyword in row_str.lower() for keyword in ["тип", "одометр", "трубы"]):
-            header_found = True
-            continue
-        if not header_found:
-            continue
-        try:
-            tube_num = str(row[1]).strip()
-            unit_type_raw = str(row[3]).strip().lower() if row[3] else None
-            odometr = float(row[0]) if row[0] else None
-            description = str(row[4]).strip() if row[4] else None
-            comment = str(row[5]).strip() if row[5] else None
-        except Exception as e:
-            print(f"⚠️ Ошибка парсинга строки {i}: {e}")
-            continue
 
-        tube_version = TubeVersion.objects.filter(diagnostics=diagnostics, tube_num=tube_num).first()
-        if not tube_version:
-            # print(f"⚠️ Версия для трубы {tube_num} и диагностики {diagnostics.id} не найдена")
-            continue
+def to_str(value):
+    value = str(value).strip() if value is not None else ''
+    return value or None
 
-        # определяем тип элемента
-        UNIT_TYPE_MAP = {
-            "кран": "valv",
-            "отвод": "offt",
-            "врезка": "offt",
-            "тройник": "tee",
-            "эхз": "cpco",
-            "окно": "wiwd",
-            "футляр-начало": "casb",
-            "футляр-конец": "case",
-            "маркер": "mark",
-            "пригруз": "anch",
-            "обустройство": "pfix",
-        }
-        unit_type = "pfix"  # по умолчанию
-        for k, v in UNIT_TYPE_MAP.items():
-            if v in unit_type_raw:
-                unit_type = v
-                break
-        # создаём элемент
-        TubeUnit.objects.create(
-            tube=tube_version,
-            unit_type=unit_type,
-            odometr_data=odometr,
-            description=description,
-            comment=comment,
-        )
-        created_units += 1
-
-    print(f"\n✅ Импорт элементов завершён:")
-    print(f"  • создано элементов: {created_units}")
-    print(f"  • диагностика: {diagnostics.id} ({diagnostics.start_date} — {diagnostics.end_date})")
-
-
-def import_anomalies(filepath, diagnostics):
-    ANOMALY_NATURE_MAP = {
-        'Аномалия кольцевого шва': 'gwan',
-        'Аномалия спирального шва': 'swan',
-        'Аномалия продольного шва': 'lwan',
-        'Механическое повреждение': 'goug',
-        'Коррозия': 'corr',
-        'Вмятина': 'dent',
-        'Гофр': 'wrin',
-        'Технологический дефект': 'artd',
-        'Заводской дефект': 'mian',
-        'Зона продольных трещин': 'scc',
-        'Трещина на продольном шве': 'lwcr',
-        'Эллипсность': 'oval',
-    }
-    SIZE_CLASS_MAP = {
-        'Не указан': '',
-        'Обширный': 'gene',
-        'Каверна': 'pitt',
-        'Поперечная канавка': 'cigr',
-        'Продольная канавка': 'axgr',
-        'Продольный паз': 'axsl',
-        'Поперечный паз': 'cisl',
-    }
-    LOCATION_MAP = {
-        'INT': 'int',
-        'EXT': 'ext',
-        'MID': 'mid',
-        'N/A': 'n/a',
-    }
-    print(f"📘 Импорт аномалий из: {filepath}")
-    wb = load_workbook(filepath, read_only=True, data_only=True)
-    ws = wb.active
-    header_found = False
-    created_anomalies = 0
 
-    for i, row in enumerate(ws.iter_rows(values_only=True), start=1):
-        # пропускаем пустые строки
-        if not any(row):
-            continue
+def row_text(row):
+    return " ".join([str(x) for x in row if x]).lower()
 
-        # определяем строку с заголовками
-        row_str = " ".join([str(x) for x in row if x])
-        if "расстояние" in row_str.lower() and "шва" in row_str.lower():
-            header_found = True
-            continue
-        if not header_found:
-            continue
 
-        try:
-            # индекс колонок по структуре файла
-            odometr_data = float(row[0]) if row[0] else None
-            from_left_weld_to_max = float(row[1]) if row[1] else None
-            from_left_weld_to_start = float(row[2]) if row[2] else None
-            from_right_weld_to_max = float(row[3]) if row[3] else None
-            from_right_weld_to_start = float(row[4]) if row[4] else None
-            from_long_weld_to_start = float(row[5]) if row[5] else None
-            from_long_weld_to_max = float(row[6]) if row[6] else None
-            from_long_weld_to_center = float(row[7]) if row[7] else None
-            min_distance_to_long_weld = float(row[8]) if row[8] else None
-            min_distance_to_circ_weld = float(row[9]) if row[9] else None
-            tube_num = str(row[10]).strip() if row[10] else None
-            anomaly_description = str(row[11]) if row[11] else None
-            anomaly_nature = str(row[12]).strip().lower() if row[12] else None  # "Характер особенности"
-            size_class = str(row[13]).strip().lower() if row[13] else None      # "Класс размера"
-            start_point_orientation = str(row[14]) if row[14] else None
-            max_point_orientation = str(row[15]) if row[15] else None
-            center_orientation = str(row[16]) if row[16] else None
-            anomaly_length = int(row[17]) if row[17] else None
-            anomaly_width = int(row[18]) if row[18] else None
-            anomaly_depth = float(row[19]) if row[19] else None
-            location = str(row[20]).strip().lower() if row[20] else None        # "Расположение"
-            comment = str(row[21]) if row[21] else None
-            safe_pressure_coefficient = float(row[22]) if row[22] else None
-            danger_level = str(row[23]).strip() if len(row) > 23 and row[23] else None
-
-        except Exception as e:
-            print(f"⚠️ Ошибка парсинга строки {i}: {e}")
-            continue
+def parse_tube_row(row):
+    if not row[0] or not row[1]:  # пустая строка
+        return None
+    return {
+        'tube_num': str(row[0]).strip(),
+        'odometr_data': to_float(row[1], 0),
+        'tube_length': to_float(row[2], 0),
+        'tube_type': TUBE_TYPE_MAP.get(to_str(row[3]), 'without'),
+        'thickness': to_float(row[4], 0),
+        'weld_position': to_str(row[5]),
+        'yield_strength': to_float(row[6], 0),
+        'tear_strength': to_float(row[7], 0),
+        'category': to_str(row[8]) or 'II',
+        'reliability_material': to_float(row[9]),
+        'comment': to_str(row[10]),
+        'steel_grade': to_str(row[11]),
+    }
 
-        if not tube_num:
-            continue
 
-        version = TubeVersion.objects.filter(tube_num=tube_num, diagnostics=diagnostics).first()
-        if not version:
-            continue
+def parse_unit_row(row):
+    unit_type_raw = (to_str(row[3]) or '').lower()
+    unit_type = "pfix"  # по умолчанию
+    for code in UNIT_TYPE_MAP.values():
+        if code in unit_type_raw:
+            unit_type = code
+            break
+    return {
+        'tube_num': to_str(row[1]),
+        'unit_type': unit_type,
+        'odometr_data': to_float(row[0]),
+        'description': to_str(row[4]),
+        'comment': to_str(row[5]),
+    }
 
-        # создаём аномалию
-        try:
-            Anomaly.objects.create(
-                tube=version,
-                odometr_data=odometr_data,
-                from_left_weld_to_max=from_left_weld_to_max,
-                from_left_weld_to_start=from_left_weld_to_start,
-                from_right_weld_to_max=from_right_weld_to_max,
-                from_right_weld_to_start=from_right_weld_to_start,
-                from_long_weld_to_start=from_long_weld_to_start,
-                from_long_weld_to_max=from_long_weld_to_max,
-                from_long_weld_to_center=from_long_weld_to_center,
-                min_distance_to_long_weld=min_distance_to_long_weld,
-                min_distance_to_circ_weld=min_distance_to_circ_weld,
-                start_point_orientation=start_point_orientation,
-                max_point_orientation=max_point_orientation,
-                center_orientation=center_orientation,
-                anomaly_nature=anomaly_nature,
-                anomaly_description=anomaly_description,
-                size_class=size_class,
-                location=location,
-                anomaly_length=anomaly_length,
-                anomaly_width=anomaly_width,
-                anomaly_depth=anomaly_depth,
-                comment=comment,
-                safe_pressure_coefficient=safe_pressure_coefficient,
-                danger_level=danger_level,
-            )
-            created_anomalies += 1
-        except Exception as e:
-            print(f"⚠️ Ошибка создания аномалии (строка {i}): {e}")
 
-    print(f"\n✅ Импорт аномалий завершён:")
-    print(f"  • создано записей: {created_anomalies}")
-    print(f"  • диагностика: {diagnostics.id} ({diagnostics.start_date} — {diagnostics.end_date})")
+def parse_anomaly_row(row):
+    nature = to_str(row[12])
+    size_class = to_str(row[13])
+    location = to_str(row[20])
+    return {
+        'tube_num': to_str(row[10]),
+        'odometr_data': to_float(row[0]),
+        'from_left_weld_to_max': to_float(row[1]),
+        'from_left_weld_to_start': to_float(row[2]),
+        'from_right_weld_to_max': to_float(row[3]),
+        'from_right_weld_to_start': to_float(row[4]),
+        'from_long_weld_to_start': to_float(row[5]),
+        'from_long_weld_to_max': to_float(row[6]),
+        'from_long_weld_to_center': to_float(row[7]),
+        'min_distance_to_long_weld': to_float(row[8]),
+        'min_distance_to_circ_weld': to_float(row[9]),
+        'anomaly_description': to_str(row[11]),
+        # в отчёте указаны аббревиатуры, совпадающие с ключами choices
+        'anomaly_nature': nature.lower() if nature else None,
+        'size_class': size_class.lower() if size_class else None,
+        'start_point_orientation': to_str(row[14]),
+        'max_point_orientation': to_str(row[15]),
+        'center_orientation': to_str(row[16]),
+        'anomaly_length': to_int(row[17]),
+        'anomaly_width': to_int(row[18]),
+        'anomaly_depth': to_float(row[19]),
+        'location': location.lower() if location else None,
+        'comment': to_str(row[21]),
+        'safe_pressure_coefficient': to_float(row[22]),
+        'danger_level': to_str(row[23]),
+    }
 
 
-def import_bends(filepath, diagnostics):
-    # Словари для маппинга текстовых значений на ключи choices
-    BEND_TYPE_MAP = {
-        'Упруго-пластический изгиб': 'elastic_plastic',
-        'Отвод холодного гнутья': 'cold_bend',
-        'Отвод сегментный': 'segment_bend',
+def parse_bend_row(row):
+    bend_type_text = to_str(row[7])
+    direction_text = to_str(row[8])
+    record = {
+        'tube_num': to_str(row[2]),
+        'start_point': to_float(row[0]),
+        'end_point': to_float(row[1]),
+        'segment_count': to_int(row[3]),
+        'radius': to_float(row[4]),
+        'bend_angle': to_float(row[5]),
+        'projection_angle': to_str(row[6]),
+        'bend_type': BEND_TYPE_MAP.get(bend_type_text),
+        'direction': DIRECTION_MAP.get(direction_text),
+        'comment': to_str(row[9]),
+        'latitude': to_float(row[10]),
+        'longitude': to_float(row[11]),
+        'altitude': to_float(row[12]),
+        'safety_status': to_str(row[13]),
     }
-    DIRECTION_MAP = {
-        'Вертикальная': 'vertical',
-        'Горизонтальная': 'horizontal',
-    }
-    print(f"📘 Импорт отводов из: {filepath}")
+    if not record['start_point'] or not record['end_point']:
+        raise ValueError('отсутствуют начало или конец отвода')
+    if not record['bend_type'] or not record['direction']:
+        raise ValueError(f'неизвестный тип или направление: {bend_type_text}, {direction_text}')
+    return record
+
+
+# Распознавание шапки, разбор строки, число колонок и колонка с числом,
+# по которой строка данных отличается от шапки, для каждого файла отчёта
+READERS = {
+    'tubes': (is_header, parse_tube_row, 12, 1),
+    'units': (
+        lambda row: any(k in row_text(row) for k in ["тип", "одометр", "трубы"]),
+        parse_unit_row,
+        6,
+        0,
+    ),
+    'anomalies': (
+        lambda row: "расстояние" in row_text(row) and "шва" in row_text(row),
+        parse_anomaly_row,
+        24,
+        0,
+    ),
+    'bends': (
+        lambda row: all(k in row_text(row) for k in ["начало", "конец", "номер трубы"]),
+        parse_bend_row,
+        14,
+        0,
+    ),
+}
+
+
+def parse_workbook(filepath, kind):
+    """
+    Читает файл отчёта потоково (read_only).
+    Возвращает имена полей, строки в виде кортежей (компактно передаются
+    между процессами), ошибки разбора (номер строки, текст) и время разбора.
+    """
+    started = time.monotonic()
+    header_test, parser, width, number_column = READERS[kind]
+    fields = None
+    records = []
+    errors = []
     wb = load_workbook(filepath, read_only=True, data_only=True)
-    ws = wb.active
-
-    header_found = False
-    created_bends = 0
-
-    for i, row in enumerate(ws.iter_rows(values_only=True), start=1):
-        # пропускаем пустые строки
-        if not any(row):
+    try:
+        header_found = False
+        for i, row in enumerate(wb.active.iter_rows(values_only=True), start=1):
+            if not any(row):
+                continue
+            # строка данных начинается с числа, шапку (она может повторяться
+            # на каждой странице отчёта) проверяем только для остальных строк
+            is_data = (
+                header_found and len(row) > number_column
+                and clean_cell_value(row[number_column]) is not None
+            )
+            if not is_data and header_test(row):
+                header_found = True
+                continue
+            if not header_found:
+                continue
+            row = tuple(row) + (None,) * (width - len(row))
+            try:
+                record = parser(row)
+            except (ValueError, TypeError) as e:
+                errors.append((i, str(e)))
+                continue
+            if record is None or not record['tube_num']:
+                continue
+            if fields is None:
+                fields = tuple(record)
+            records.append(tuple(record.values()))
+    finally:
+        wb.close()
+    return fields, records, errors, time.monotonic() - started
+
+
+def clean_record(model, record):
+    """
+    Оставляет только поля модели и обрезает строки по max_length,
+    чтобы одна строка отчёта не сорвала пакетную вставку.
+    """
+    values = {}
+    for field in model._meta.concrete_fields:
+        if field.name not in record:
             continue
+        value = record[field.name]
+        if isinstance(field, models.CharField) and isinstance(value, str):
+            value = value[:field.max_length]
+        values[field.name] = value
+    return values
 
-        # определяем строку с заголовками
-        row_str = " ".join([str(x) for x in row if x])
-        if "начало" in row_str.lower() and "конец" in row_str.lower() and "номер трубы" in row_str.lower():
-            header_found = True
-            continue
-        if not header_found:
-            continue
 
-        try:
-            # индекс колонок по структуре файла
-            start_point = float(row[0]) if row[0] else None
-            end_point = float(row[1]) if row[1] else None
-            tube_num = str(row[2]).strip() if row[2] else None
-            segment_count = int(row[3]) if row[3] else None
-            radius = float(row[4]) if row[4] else None
-            bend_angle = float(row[5]) if row[5] else None
-            projection_angle = str(row[6]) if row[6] else None
-
-            # Поля choices - маппинг текста на ключи
-            bend_type_text = str(row[7]).strip() if row[7] else None  # "Тип"
-            direction_text = str(row[8]).strip() if row[8] else None  # "Направление"
-            # Преобразуем текстовые значения в ключи choices
-            bend_type = BEND_TYPE_MAP.get(bend_type_text)
-            direction = DIRECTION_MAP.get(direction_text)
-
-            comment = str(row[9]) if row[9] else None
-
-            # Географические координаты (если есть в данных)
-            latitude = float(row[10]) if len(row) > 10 and row[10] else None
-            longitude = float(row[11]) if len(row) > 11 and row[11] else None
-            altitude = float(row[12]) if len(row) > 12 and row[12] else None
-
-            # Статус безопасности
-            safety_status = str(row[13]) if len(row) > 13 and row[13] else None
-
-        except Exception as e:
-            print(f"⚠️ Ошибка парсинга строки {i}: {e}")
-            continue
+class IliImporter:
+    """
+    Импорт отчёта ВТД (трубы, элементы обустройства, аномалии, отводы).
+    Файлы разбираются параллельно в пуле процессов, запись в БД идёт
+    пакетными вставками в одной транзакции.
+    """
 
-        if not tube_num or not start_point or not end_point:
-            print(f"⚠️ Пропуск строки {i}: отсутствуют обязательные данные (труба, начало, конец)")
-            continue
+    def __init__(self, pipe_ranges, diagnostics_start, diagnostics_end,
+                 batch_size=2000, replace=False, workers=None):
+        self.pipe_ranges = [
+            (*parse_range(range_str), int(pipe_id))
+            for pipe_id, range_str in pipe_ranges.items()
+        ]
+        self.diagnostics_start = datetime.strptime(diagnostics_start, "%d.%m.%Y").date()
+        self.diagnostics_end = datetime.strptime(diagnostics_end, "%d.%m.%Y").date()
+        self.batch_size = batch_size
+        self.replace = replace
+        self.workers = workers
+        self.stats = []
+        self.warnings = []
+
+    def pipe_for_tube(self, tube_num):
+        """Определяем участок по номеру трубы (диапазон закрытый, включаем края)"""
+        num, _ = extract_number_and_suffix(tube_num)
+        if num is None:
+            return None
+        for start, end, pipe_id in self.pipe_ranges:
+            if start <= num <= end:
+                return pipe_id
+        return None
 
-        version = TubeVersion.objects.filter(tube_num=tube_num, diagnostics=diagnostics).first()
-        if not version:
-            continue
-        # создаём отвод
-        try:
-            bend = Bend.objects.create(
-                tube=version,
-                start_point=start_point,
-                end_point=end_point,
-                tube_num=tube_num,
-                segment_count=segment_count,
-                radius=radius,
-                bend_angle=bend_angle,
-                projection_angle=projection_angle,
-                bend_type=bend_type,
-                direction=direction,
-                comment=comment,
-                latitude=latitude,
-                longitude=longitude,
-                altitude=altitude,
-                safety_status=safety_status,
+    def run(self, files):
+        """files: словарь {'tubes': путь, 'units': путь, ...}; трубы обязательны"""
+        files = {kind: path for kind, path in files.items() if path}
+        return self.write(files, self.parse(files))
+
+    def parse(self, files):
+        """
+        Разбирает все файлы одновременно, общее время ограничено самым большим файлом.
+        workers=1 разбирает файлы последовательно в текущем процессе.
+        """
+        workers = self.workers or min(len(files), os.cpu_count() or 1)
+        if workers <= 1:
+            return {kind: parse_workbook(path, kind) for kind, path in files.items()}
+        # initializer нужен для запуска через spawn (Windows): дочернему процессу
+        # при импорте pipelines.utils требуется настроенный Django
+        with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as executor:
+            futures = {
+                kind: executor.submit(parse_workbook, path, kind)
+                for kind, path in files.items()
+            }
+            return {kind: future.result() for kind, future in futures.items()}
+
+    @transaction.atomic
+    def write(self, files, parsed):
+        pipes = Pipe.objects.in_bulk([pipe_id for _, _, pipe_id in self.pipe_ranges])
+        for pipe_id in {pipe_id for _, _, pipe_id in self.pipe_ranges} - set(pipes):
+            self.warnings.append(f'Участок id={pipe_id} не найден')
+        self.pipe_ranges = [r for r in self.pipe_ranges if r[2] in pipes]
+        diagnostics = self.get_diagnostics(pipes)
+        versions = self.import_tubes(files['tubes'], parsed['tubes'], diagnostics)
+        if 'units' in parsed:
+            self.import_related(files['units'], parsed['units'], TubeUnit, versions)
+        if 'anomalies' in parsed:
+            self.import_related(files['anomalies'], parsed['anomalies'], Anomaly, versions)
+        if 'bends' in parsed:
+            self.import_related(
+                files['bends'], parsed['bends'], Bend, versions, Bend.fill_derived
             )
-            # Вызываем save для автоматического вычисления radius_in_diameters и парсинга комментария
-            bend.save()
-            created_bends += 1
-            # Отладочная информация для первых нескольких записей
-            if created_bends <= 5:
-                print(f"✅ Создан отвод: труба {tube_num}, тип: {bend_type_text} -> {bend_type}, направление: {direction_text} -> {direction}")
-
-        except Exception as e:
-            print(f"⚠️ Ошибка создания отвода (строка {i}): {e}")
-            print(f"   Параметры: type={bend_type}, direction={direction}")
-    print(f"\n✅ Импорт отводов завершён:")
-    print(f"  • создано записей: {created_bends}")
-    print(f"  • диагностика: {diagnostics.id} ({diagnostics.start_date} — {diagnostics.end_date})")
-
-
-if __name__ == "__main__":
-    for diagnostic_data in DATA:
-        pipe_ranges = diagnostic_data.get('pipe_ranges')
-        diagnostics_start = diagnostic_data.get('diagnostics_start')
-        diagnostics_end = diagnostic_data.get('diagnostics_end')
-        filepath_tubes = diagnostic_data.get('filepath_tubes')
-        filepath_units = diagnostic_data.get('filepath_units')
-        filepath_anomalies = diagnostic_data.get('filepath_anomalies')
-        filepath_bends = diagnostic_data.get('filepath_bends')
-        report_type = diagnostic_data.get('report_type')
-        import_tubes(
-            filepath_tubes,
-            filepath_units,
-            filepath_anomalies,
-            filepath_bends,
-            pipe_ranges,
-            diagnostics_start,
-            diagnostics_end
+        # bulk_create не вызывает save() и сигналы
+        Tube.refresh_latest_versions(Tube.objects.filter(pipe_id__in=pipes))
+        SchemeSnapshot.invalidate()
+        FilterFacets.invalidate(pipe_ids=list(pipes), diagnostics_ids=[diagnostics.id])
+        DiagnosticStats.refresh([diagnostics.id], renew=True)
+        DiagnosticTile.invalidate([diagnostics.id])
+        OdometerCalibration.invalidate([diagnostics.id])
+        BendSpatialIndex.invalidate([diagnostics.id])
+        return diagnostics
+
+    def get_diagnostics(self, pipes):
+        """Создаёт (или получает) диагностику, связанную со всеми участками"""
+        diagnostics, created = Diagnostics.objects.get_or_create(
+            start_date=self.diagnostics_start,
+            end_date=self.diagnostics_end,
+            defaults={
+                'description': (
+                    f"Диагностика участков {', '.join(map(str, pipes))} "
+                    f"({self.diagnostics_start}–{self.diagnostics_end})"
+                )
+            },
         )
+        if not created and diagnostics.tubeversion_set.exists():
+            if not self.replace:
+                raise ValueError(
+                    f'Диагностика id={diagnostics.id} уже импортирована, '
+                    'для повторного импорта укажите replace'
+                )
+            # сопоставления с другими прогонами описывают прежние данные и пересчитываются
+            delete_rows(RunAlignment.objects.filter(
+                models.Q(earlier=diagnostics) | models.Q(later=diagnostics)
+            ))
+            # каскад ORM отправил бы сигналы для каждой строки прогона
+            delete_rows(TubeVersion.objects.filter(diagnostics=diagnostics))
+            Tube.refresh_latest_versions(Tube.objects.filter(pipe__pipe_diagnostics=diagnostics))
+        diagnostics.pipes.add(*pipes.values())
+        return diagnostics
+
+    def import_tubes(self, filepath, parsed, diagnostics):
+        """Создаёт недостающие трубы и версии; возвращает версии по номеру трубы"""
+        started = time.monotonic()
+        fields, rows, errors, parse_seconds = parsed
+        records = [dict(zip(fields, row)) for row in rows]
+        pipe_ids = {pipe_id for _, _, pipe_id in self.pipe_ranges}
+        tubes = {
+            (pipe_id, tube_num): tube_id
+            for tube_id, pipe_id, tube_num in Tube.objects.filter(
+                pipe_id__in=pipe_ids
+            ).values_list('id', 'pipe_id', 'tube_num')
+        }
+        tube_rows = []
+        new_tubes = {}
+        for record in records:
+            pipe_id = self.pipe_for_tube(record['tube_num'])
+            if pipe_id is None:
+                continue
+            key = (pipe_id, record['tube_num'])
+            if key not in tubes and key not in new_tubes:
+                new_tubes[key] = Tube(
+                    pipe_id=pipe_id, tube_num=record['tube_num'],
+                    active=True, installed_date=date.today(),
+                )
+            tube_rows.append((key, record))
+        Tube.objects.bulk_create(new_tubes.values(), batch_size=self.batch_size)
+        tubes.update({key: tube.pk for key, tube in new_tubes.items()})
+        new_versions = [
+            TubeVersion(
+                tube_id=tubes[key],
+                diagnostics=diagnostics,
+                version_type='diagnostic',
+                date=diagnostics.end_date,
+                **clean_record(TubeVersion, record),
+            )
+            for key, record in tube_rows
+        ]
+        TubeVersion.objects.bulk_create(new_versions, batch_size=self.batch_size)
+        versions = {}
+        for version in new_versions:
+            versions.setdefault(version.tube_num, version)
+        self.add_stats(filepath, records, len(new_versions), errors, parse_seconds, started)
+        return versions
+
+    def import_related(self, filepath, parsed, model, versions, prepare=None):
+        """Элементы обустройства, аномалии и отводы привязываются к версии по номеру трубы"""
+        started = time.monotonic()
+        fields, rows, errors, parse_seconds = parsed
+        records = [dict(zip(fields, row)) for row in rows]
+        objects = []
+        for record in records:
+            version = versions.get(record['tube_num'])
+            if version is None:
+                continue
+            obj = model(tube=version, **clean_record(model, record))
+            if prepare:
+                prepare(obj)
+            objects.append(obj)
+        model.objects.bulk_create(objects, batch_size=self.batch_size)
+        self.add_stats(filepath, records, len(objects), errors, parse_seconds, started)
+
+    def add_stats(self, filepath, records, created, errors, parse_seconds, started):
+        self.stats.append({
+            'file': Path(filepath).name,
+            'rows': len(records) + len(errors),
+            'created': created,
+            'errors': errors,
+            'parse_seconds': parse_seconds,
+            'write_seconds': time.monotonic() - started,
+        })
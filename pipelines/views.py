@@ -1,7 +1,6 @@
-from multiprocessing import Pipe
-
 from django.contrib.auth.decorators import login_required
-from django.db.models import CharField, Exists, FloatField, OuterRef, Subquery
+from django.db.models import CharField, F, OuterRef, Prefetch, Q, Subquery, Value
+from django.db.models.functions import Coalesce, NullIf
 from django.shortcuts import get_object_or_404, redirect, render
 from django_filters.views import FilterView
 from django_tables2 import SingleTableMixin
@@ -9,14 +8,16 @@ from django_tables2 import SingleTableMixin
 from equipments.models import Equipment
 from pipelines.filters import (AnomalyFilter, BendFilter, DiagnosticsFilter,
                                RepairFilter, TubeFilter, TubeUnitFilter,
-                               TubeVersionFilter)
+                               TubeVersionFilter, build_facets, get_facets)
+from pipelines.pagination import OdometerPaginationMixin
 from pipelines.tables import (AnomalyTable, BendTable, DiagnosticsTable,
                               RepairTable, TubeTable, TubeUnitTable,
                               TubeVersionTable)
+from users.access import branch_scope
 from users.models import ModuleUser, Role
 
-from .models import (Anomaly, Bend, ComplexPlan, Diagnostics, Pipe,
-                     PipeDepartment, Pipeline, PipeState, Repair, Tube,
+from .models import (Anomaly, Bend, ComplexPlan, Diagnostics, DiagnosticStats,
+                     Pipe, PipeDepartment, Pipeline, PipeState, Repair, Tube,
                      TubeUnit, TubeVersion)
 
 
@@ -77,24 +78,22 @@ class RepairsView(SingleTableMixin, FilterView):
     filterset_class = RepairFilter
 
     def get_queryset(self):
-        queryset = super().get_queryset()
+        # участок и узел для типа и наименования объекта, филиал и газопровод
+        # строки берутся из pipelines.labels
+        queryset = super().get_queryset().select_related(
+            'pipe__pipeline', 'node__pipeline', 'node__sub_pipeline'
+        )
         user = self.request.user
 
         if user.role == Role.ADMIN:
             return queryset  # ADMIN видит все ремонты
 
         else:
-            if user.department:
-                root_department = user.department.get_root()
-                departments = root_department.get_descendants(include_self=True)
-                pipe_repairs = queryset.filter(
-                    pipe__pipedepartment__department__in=departments
-                ).distinct()
-                node_repairs = queryset.filter(
-                    node__equipment__departments__in=departments
-                ).distinct()
-                return (pipe_repairs | node_repairs).distinct()
-            return queryset.none()
+            # ремонты участков и узлов ветки пользователя (users.access)
+            scope = branch_scope(user)
+            return queryset.filter(
+                Q(pipe_id__in=scope.pipe_ids) | Q(node_id__in=scope.node_ids)
+            )
 
 
 class DiagnosticsView(SingleTableMixin, FilterView):
@@ -109,24 +108,18 @@ class DiagnosticsView(SingleTableMixin, FilterView):
         user = self.request.user
         # diagnostic_id = self.kwargs['diagnostic_id']
 
-        # Базовая оптимизация запросов
-        queryset = queryset.prefetch_related(
-            'pipes__pipeline',
-            'pipes__pipedepartment_set__department'
+        # Базовая оптимизация запросов; филиалы и газопровод строки из pipelines.labels
+        queryset = DiagnosticStats.with_version(
+            queryset.select_related('stats').prefetch_related('pipes__pipeline')
         )
 
         if user.role == Role.ADMIN:
             return queryset
 
         else:
-            if user.department:
-                root_department = user.department.get_root()
-                departments = root_department.get_descendants(include_self=True)
-
-                return queryset.filter(
-                    pipes__pipedepartment__department__in=departments
-                ).distinct()
-            return queryset.none()
+            return queryset.filter(
+                pipes__in=branch_scope(user).pipe_ids
+            ).distinct()
 
     # def get_context_data(self, **kwargs):
     #     """
@@ -137,12 +130,11 @@ class DiagnosticsView(SingleTableMixin, FilterView):
     #     return context
 
 
-class DiagnosticTubesView(SingleTableMixin, FilterView):
+class DiagnosticTubesView(OdometerPaginationMixin, SingleTableMixin, FilterView):
     model = TubeVersion
     table_class = TubeVersionTable
     template_name = 'pipelines/diagnostic_tubes.html'
     filterset_class = TubeVersionFilter
-    paginate_by = 50
 
     def get_queryset(self):
         return (
@@ -151,24 +143,31 @@ class DiagnosticTubesView(SingleTableMixin, FilterView):
             .order_by('odometr_data')
         )
 
+    def get_filterset_kwargs(self, filterset_class):
+        kwargs = super().get_filterset_kwargs(filterset_class)
+        kwargs['facets'] = get_facets(
+            'diagnostics',
+            self.kwargs['diagnostic_id'],
+            lambda: build_facets(kwargs['queryset'], filterset_class.FACET_FIELDS),
+        )
+        return kwargs
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['diagnostic_id'] = self.kwargs['diagnostic_id']
         return context
 
 
-class DiagnosticTubeUnitsView(SingleTableMixin, FilterView):
+class DiagnosticTubeUnitsView(OdometerPaginationMixin, SingleTableMixin, FilterView):
     model = TubeUnit
     table_class = TubeUnitTable
     template_name = 'pipelines/diagnostic_tubeunits.html'
     filterset_class = TubeUnitFilter
-    paginate_by = 50
 
     def get_queryset(self):
         diagnostic_id = self.kwargs['diagnostic_id']
         queryset = TubeUnit.objects.filter(tube__diagnostics_id=diagnostic_id)
-        # return queryset.select_related('tube')
-        return queryset
+        return queryset.select_related('tube')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -176,12 +175,12 @@ class DiagnosticTubeUnitsView(SingleTableMixin, FilterView):
         return context
 
 
-class DiagnosticBendsView(SingleTableMixin, FilterView):
+class DiagnosticBendsView(OdometerPaginationMixin, SingleTableMixin, FilterView):
     model = Bend
     table_class = BendTable
     template_name = 'pipelines/diagnostic_bends.html'
     filterset_class = BendFilter
-    paginate_by = 50
+    odometer_field = 'start_point'
 
     def get_queryset(self):
         diagnostic_id = self.kwargs['diagnostic_id']
@@ -212,22 +211,16 @@ class DiagnosticAnomaliesView(SingleTableMixin, FilterView):
         return context
 
 
-class TubesView(SingleTableMixin, FilterView):
+class TubesView(OdometerPaginationMixin, SingleTableMixin, FilterView):
     model = Tube
     table_class = TubeTable
     template_name = 'pipelines/pipe_tubes.html'
     filterset_class = TubeFilter
-    paginate_by = 50
+    odometer_field = 'last_odometr'
 
     def get_queryset(self):
         pipe_id = self.kwargs['pipe_id']
-        # Базовый подзапрос последней версии
-        last_version_qs = (
-            TubeVersion.objects
-            .filter(tube=OuterRef('pk'))
-            .order_by('-date')
-        )
-        # Последняя версия с НЕ пустой маркой стали
+        # Последняя версия с НЕ пустой маркой стали, если у последней версии она не указана
         last_steel_qs = (
             TubeVersion.objects
             .filter(tube=OuterRef('pk'))
@@ -235,43 +228,32 @@ class TubesView(SingleTableMixin, FilterView):
             .exclude(steel_grade='')
             .order_by('-date')
         )
-        # Проверка наличия элементов обустройства у последней версии
-        unit_exists_qs = TubeUnit.objects.filter(
-            tube=Subquery(last_version_qs.values('id')[:1])
-        )
         queryset = (
             Tube.objects
             .filter(pipe_id=pipe_id, active=True)
+            .select_related(
+                'pipe__pipeline',
+                'latest_version__diagnostics',
+                'latest_version__repair',
+            )
+            # типы элементов обустройства последней версии для всей страницы одним запросом
+            .prefetch_related(Prefetch(
+                'latest_version__tube_units',
+                queryset=TubeUnit.objects.only('id', 'tube_id', 'unit_type').order_by('id'),
+                to_attr='unit_list'
+            ))
             .annotate(
-                last_version_id=Subquery(
-                    last_version_qs.values('id')[:1]
-                ),
-                last_length=Subquery(
-                    last_version_qs.values('tube_length')[:1],
-                    output_field=FloatField()
-                ),
-                last_thickness=Subquery(
-                    last_version_qs.values('thickness')[:1],
-                    output_field=FloatField()
-                ),
-                last_diameter=Subquery(
-                    last_version_qs.values('diameter')[:1]
-                ),
-                last_category=Subquery(
-                    last_version_qs.values('category')[:1]
-                ),
-                last_type=Subquery(
-                    last_version_qs.values('tube_type')[:1]
-                ),
-                last_odometr=Subquery(
-                    last_version_qs.values('odometr_data')[:1],
-                    output_field=FloatField()
-                ),
-                last_steel_grade=Subquery(
-                    last_steel_qs.values('steel_grade')[:1],
+                last_length=F('latest_version__tube_length'),
+                last_thickness=F('latest_version__thickness'),
+                last_diameter=F('latest_version__diameter'),
+                last_category=F('latest_version__category'),
+                last_type=F('latest_version__tube_type'),
+                last_odometr=F('latest_version__odometr_data'),
+                last_steel_grade=Coalesce(
+                    NullIf('latest_version__steel_grade', Value('')),
+                    Subquery(last_steel_qs.values('steel_grade')[:1]),
                     output_field=CharField()
                 ),
-                has_units=Exists(unit_exists_qs),
             )
             .order_by('last_odometr', 'tube_num')
         )
@@ -283,6 +265,13 @@ class TubesView(SingleTableMixin, FilterView):
         """
         kwargs = super().get_filterset_kwargs(filterset_class)
         kwargs['queryset'] = self.get_queryset()
+        # значения выпадающих списков хранятся готовыми (в БД и в памяти процесса),
+        # сбрасываются при импорте ВТД и ремонтах
+        kwargs['facets'] = get_facets(
+            'pipe',
+            self.kwargs['pipe_id'],
+            lambda: build_facets(kwargs['queryset'], filterset_class.FACET_FIELDS),
+        )
         return kwargs
 
     def get_context_data(self, **kwargs):
@@ -12,6 +12,7 @@ from django.utils import timezone
 from mptt.models import TreeForeignKey
 
 from equipments.models import Department, EquipmentType
+from equipments.trees import department_tree
 from notifications.models import Notification
 from users.models import ModuleUser, UserAppRoute
 
@@ -128,15 +129,9 @@ class Proposal(models.Model):
         return f'№{self.reg_num}, {self.title}'
 
     def get_ks(self):
-        if self.department:
-            # Получаем корень ветки
-            root = self.department.get_root()
-            # Получаем всех потомков корня
-            descendants = root.get_descendants(include_self=True)
-            # Фильтруем элементы второго уровня
-            second_level = descendants.filter(level=1)
-            if second_level.exists():
-                return second_level.first()
+        if self.department_id:
+            # Первый элемент второго уровня в ветке (из дерева в памяти)
+            return department_tree.first_at_level(self.department_id, 1)
         return None
 
 
@@ -8,7 +8,8 @@ from django_filters.views import FilterView
 from django_tables2 import SingleTableMixin
 
 from equipments.models import Department
-from users.models import ModuleUser, Role
+from users.access import role_scope
+from users.models import ModuleUser
 
 from .filters import AnnualPlanFilter, ProposalFilter
 from .forms import ProposalForm
@@ -50,26 +51,12 @@ def filter_by_user_role(user: ModuleUser, queryset: QuerySet, department_field:
     :param department_field: Название поля, связанного с department (по умолчанию 'department').
     :return: Отфильтрованный queryset.
     """
-    if user.role == Role.ADMIN:
-        # ADMIN видит всё
+    # ADMIN видит всё, MANAGER — всю свою ветку,
+    # EMPLOYEE — своё подразделение и дочерние (users.access.role_scope)
+    scope = role_scope(user)
+    if scope is None:
         return queryset
-    elif user.role == Role.MANAGER:
-        # MANAGER видит всё оборудование своей ветки, начиная со второго уровня
-        if user.department:
-            root = user.department.get_root()
-            descendants = root.get_descendants(include_self=True)
-            return queryset.filter(**{f"{department_field}__in": descendants, f"{department_field}__level__gte": 0})
-        else:
-            return queryset.none()
-    elif user.role == Role.EMPLOYEE:
-        # EMPLOYEE видит всё оборудование своей ветки, начиная с уровня своего оборудования
-        if user.department:
-            descendants = user.department.get_descendants(include_self=True)
-            return queryset.filter(**{f"{department_field}__in": descendants})
-        else:
-            return queryset.none()
-    else:
-        return queryset.none()
+    return queryset.filter(**{f"{department_field}__in": scope.department_ids})
 
 
 @login_required
@@ -2,7 +2,9 @@ import django_filters as df
 from django.db.models import Q
 
 from equipments.models import Department, Equipment
+from equipments.trees import equipment_tree
 from module_app.utils import create_choices
+from users.access import role_scope
 from users.models import Role
 
 from .mixins import EquipmentAccessMixin
@@ -53,30 +55,23 @@ class ValveFilter(df.FilterSet):
         #     self.filters['department'].field.queryset = Department.objects.all()
         #     self.filters['department'].field.label_from_instance = lambda obj: f"{'..' * obj.level} {obj.name}"
 
-        self.base_queryset = Equipment.objects.none()
-
-        if user.role == Role.ADMIN:
+        scope = role_scope(user)
+        if scope is None:
             self.base_queryset = Equipment.objects.all()
-        elif user.role == Role.MANAGER and user.department:
-            root = user.department.get_root()
-            departments = root.get_descendants(include_self=True)
-            self.base_queryset = Equipment.objects.filter(departments__in=departments)
-        elif user.role == Role.EMPLOYEE and user.department:
-            departments = user.department.get_descendants(include_self=True)
-            self.base_queryset = Equipment.objects.filter(departments__in=departments)
+        else:
+            self.base_queryset = Equipment.objects.filter(pk__in=scope.equipment_ids)
 
         if 'equipment' in self.filters:
             # Получаем полные пути для всех equipment
             equipment_with_paths = []
-            for eq in self.base_queryset.order_by('tree_id', 'lft'):
-                path = ' - '.join([anc.name for anc in eq.get_ancestors(include_self=True)])
-                equipment_with_paths.append((eq.id, path))
+            for eq_id in self.base_queryset.order_by('tree_id', 'lft').values_list('id', flat=True):
+                equipment_with_paths.append((eq_id, equipment_tree.path_label(eq_id)))
+            paths = dict(equipment_with_paths)
 
             # Создаем новый queryset и подменяем label_from_instance
             self.filters['equipment'].field.queryset = self.base_queryset
-            self.filters['equipment'].field.label_from_instance = lambda obj: next(
-                (path for (id_, path) in equipment_with_paths if id_ == obj.id),
-                obj.name  # fallback
+            self.filters['equipment'].field.label_from_instance = lambda obj: paths.get(
+                obj.id, obj.name  # fallback
             )
 
     def filter_by_equipment(self, queryset, name, value):
@@ -1,39 +1,30 @@
-from django.core.cache import cache
 from django.db.models import Q
 
 from equipments.models import Department, Equipment
+from equipments.trees import equipment_tree
+from users.access import branch_scope
 from users.models import Role
 
 
 class EquipmentAccessMixin:
     """Миксин для контроля доступа к оборудованию"""
 
-    CACHE_TIMEOUT = 60 * 15  # 15 минут кеширования
-
     def get_accessible_equipment(self, user):
-        """Возвращает queryset доступного оборудования с иерархией"""
-        cache_key = f'accessible_equipment_{user.id}_{user.role}'
-        cached = cache.get(cache_key)
-
-        if cached:
-            return Equipment.objects.filter(pk__in=cached)
-
+        """
+        Возвращает queryset доступного оборудования с иерархией.
+        id оборудования ветки берутся из области видимости (users.access).
+        """
         if user.role == Role.ADMIN:
-            qs = Equipment.objects.all()
-        elif user.role in [Role.MANAGER, Role.EMPLOYEE] and user.department:
-            departments = user.department.get_root().get_descendants(include_self=True)
-            qs = Equipment.objects.filter(departments__in=departments)
-        else:
-            qs = Equipment.objects.none()
-
-        cache.set(cache_key, list(qs.values_list('pk', flat=True)), self.CACHE_TIMEOUT)
-        return qs
+            return Equipment.objects.all()
+        if user.role in [Role.MANAGER, Role.EMPLOYEE]:
+            return Equipment.objects.filter(pk__in=branch_scope(user).equipment_ids)
+        return Equipment.objects.none()
 
     def get_equipment_hierarchy_labels(self, queryset):
         """Генерирует метки с иерархией для выпадающего списка"""
         return [
-            (eq.id, ' - '.join(anc.name for anc in eq.get_ancestors(include_self=True)))
-            for eq in queryset.order_by('tree_id', 'lft')
+            (eq_id, equipment_tree.path_label(eq_id))
+            for eq_id in queryset.order_by('tree_id', 'lft').values_list('id', flat=True)
         ]
 
     def setup_department_filter(self, user):
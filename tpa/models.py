@@ -2,6 +2,7 @@ from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 
 from equipments.models import Equipment
+from equipments.trees import department_tree
 from module_app.utils import compress_image
 from users.models import ModuleUser
 
@@ -225,18 +226,11 @@ class Valve(models.Model):
         """
         if self.equipment:
             # Получаем все подразделения, связанные с оборудованием
-            departments = self.equipment.departments.all()
-            if departments.exists():
-                # Берем первое подразделение (можно добавить логику выбора при необходимости)
-                department = departments.first()
-                # Получаем корень иерархии подразделений
-                root = department.get_root()
-                # Получаем всех потомков корня (включая сам корень)
-                descendants = root.get_descendants(include_self=True)
-                # Фильтруем элементы второго уровня
-                second_level = descendants.filter(level=1)
-                if second_level.exists():
-                    return second_level.first()
+            # Берем первое подразделение (можно добавить логику выбора при необходимости)
+            department_id = self.equipment.departments.values_list('id', flat=True).first()
+            if department_id:
+                # Первый элемент второго уровня в дереве подразделения (из дерева в памяти)
+                return department_tree.first_at_level(department_id, 1)
         return None
 
     def __str__(self):
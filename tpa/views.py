@@ -7,7 +7,7 @@ from django_filters.views import FilterView
 from django_tables2 import SingleTableMixin
 
 from equipments.models import Equipment
-from users.models import Role
+from users.access import role_scope
 
 from .filters import ValveFilter
 from .forms import ValveForm
@@ -31,28 +31,12 @@ class ValveView(SingleTableMixin, FilterView):
 
 
 def filter_valves_by_user_role(user):
-    if user.role == Role.ADMIN:
-        # ADMIN видит всё оборудование
+    # ADMIN видит всё оборудование, MANAGER — всей своей ветки,
+    # EMPLOYEE — своего подразделения и дочерних (users.access.role_scope)
+    scope = role_scope(user)
+    if scope is None:
         return Valve.objects.all()
-    elif user.role == Role.MANAGER:
-        # MANAGER видит всё оборудование своей ветки и дочерних подразделений
-        if user.department:
-            root = user.department.get_root()
-            departments = root.get_descendants(include_self=True)
-            equipments = Equipment.objects.filter(departments__in=departments)
-            return Valve.objects.filter(equipment__in=equipments)
-        else:
-            return Valve.objects.none()
-    elif user.role == Role.EMPLOYEE:
-        # EMPLOYEE видит всё оборудование своей ветки, начиная с уровня своего оборудования
-        if user.department:
-            descendants = user.department.get_descendants(include_self=True)
-            equipments = Equipment.objects.filter(departments__in=descendants)
-            return Valve.objects.filter(equipment__in=equipments)
-        else:
-            return Valve.objects.none()
-    else:
-        return Valve.objects.none()
+    return Valve.objects.filter(equipment_id__in=scope.equipment_ids)
 
 
 @login_required
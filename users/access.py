@@ -0,0 +1,112 @@
+"""
+Области видимости пользователей: id подразделений, оборудования, участков
+и крановых узлов, доступных пользователю.
+
+Область определяется ролью и подразделением пользователя, поэтому хранится
+по ключу (вид области, подразделение) и общая для пользователей одного
+подразделения: смена роли или подразделения пользователя просто выбирает
+другой ключ. Области хранятся в памяти процесса под общей версией в БД
+(equipments.versions); версия меняется сигналами ниже при изменении деревьев
+подразделений и оборудования, связей участков и оборудования
+с подразделениями и крановых узлов — в том числе в других процессах.
+Видимые объекты отбираются простым фильтром id IN (...).
+"""
+from dataclasses import dataclass
+
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from mptt.signals import node_moved
+
+from equipments import versions
+from equipments.models import Department, Equipment
+from equipments.trees import department_tree
+from pipelines.models import Node, PipeDepartment
+from users.models import Role
+
+VERSION_KEY = 'access_scope'
+
+
+@dataclass(frozen=True)
+class AccessScope:
+    department_ids: frozenset
+    equipment_ids: frozenset
+    pipe_ids: frozenset
+    # узлы на оборудовании области; пограничные узлы видны всем (Node.is_shared)
+    node_ids: frozenset
+
+
+EMPTY_SCOPE = AccessScope(frozenset(), frozenset(), frozenset(), frozenset())
+
+# Области текущей версии в памяти процесса
+_local = {'version': None, 'scopes': {}}
+
+
+def invalidate(**kwargs):
+    """Меняет версию областей; сигнатура позволяет подключать функцию к сигналам"""
+    versions.bump(VERSION_KEY)
+
+
+def build_scope(department_ids):
+    equipment_ids = frozenset(
+        Equipment.objects.filter(departments__in=department_ids).values_list('id', flat=True)
+    )
+    return AccessScope(
+        department_ids=frozenset(department_ids),
+        equipment_ids=equipment_ids,
+        pipe_ids=frozenset(
+            PipeDepartment.objects.filter(
+                department_id__in=department_ids
+            ).values_list('pipe_id', flat=True)
+        ),
+        node_ids=frozenset(
+            Node.objects.filter(equipment_id__in=equipment_ids).values_list('id', flat=True)
+        ),
+    )
+
+
+def get_scope(kind, department_id):
+    """kind: 'branch' — вся ветка подразделения от корня, 'subtree' — подразделение с потомками"""
+    version = versions.current(VERSION_KEY)
+    if _local['version'] != version:
+        _local['version'], _local['scopes'] = version, {}
+    scopes = _local['scopes']
+    scope = scopes.get((kind, department_id))
+    if scope is None:
+        if kind == 'branch':
+            department_ids = department_tree.root_descendant_ids(department_id)
+        else:
+            department_ids = department_tree.descendant_ids(department_id, include_self=True)
+        scope = scopes[(kind, department_id)] = build_scope(department_ids)
+    return scope
+
+
+def branch_scope(user):
+    """Вся ветка подразделения пользователя: корень и его потомки"""
+    if not user.department_id:
+        return EMPTY_SCOPE
+    return get_scope('branch', user.department_id)
+
+
+def role_scope(user):
+    """
+    Область по роли: None — без ограничений (ADMIN), MANAGER — вся ветка,
+    EMPLOYEE — своё подразделение с потомками.
+    """
+    if user.role == Role.ADMIN:
+        return None
+    if not user.department_id:
+        return EMPTY_SCOPE
+    if user.role == Role.MANAGER:
+        return get_scope('branch', user.department_id)
+    if user.role == Role.EMPLOYEE:
+        return get_scope('subtree', user.department_id)
+    return EMPTY_SCOPE
+
+
+for model in (Department, Equipment):
+    post_save.connect(invalidate, sender=model, weak=False)
+    post_delete.connect(invalidate, sender=model, weak=False)
+    node_moved.connect(invalidate, sender=model, weak=False)
+for model in (PipeDepartment, Node):
+    post_save.connect(invalidate, sender=model, weak=False)
+    post_delete.connect(invalidate, sender=model, weak=False)
+m2m_changed.connect(invalidate, sender=Equipment.departments.through, weak=False)
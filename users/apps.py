@@ -5,3 +5,7 @@ class UsersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'users'
     verbose_name = 'Модуль Пользователи'
+
+    def ready(self):
+        # сброс областей видимости при изменении подразделений, оборудования и узлов
+        import users.access
@@ -1,3 +1,75 @@
 from django.test import TestCase
 
-# Create your tests here.
+from equipments import versions
+from equipments.models import CacheVersion, Department, Equipment
+from pipelines.models import Node, Pipe, PipeDepartment, Pipeline
+from users.access import EMPTY_SCOPE, VERSION_KEY, branch_scope, role_scope
+from users.models import ModuleUser, Role
+
+
+class AccessScopeTest(TestCase):
+    """Области видимости пользователей"""
+
+    def setUp(self):
+        self.root = Department.objects.create(name='ЛПУМГ')
+        self.service = Department.objects.create(name='Служба ЛЭС', parent=self.root)
+        self.other = Department.objects.create(name='Другой филиал')
+        pipeline = Pipeline.objects.create(title='Надым-Пунга 1')
+        self.pipe = Pipe.objects.create(pipeline=pipeline, start_point=0, end_point=10)
+        PipeDepartment.objects.create(pipe=self.pipe, department=self.root)
+        self.equipment = Equipment.objects.create(name='Крановый узел 1')
+        self.equipment.departments.add(self.service)
+        self.node = Node.objects.create(
+            node_type='valve', pipeline=pipeline, equipment=self.equipment, location_point=5
+        )
+        self.user = ModuleUser.objects.create_user(
+            username='engineer', password='password', department=self.service, role=Role.EMPLOYEE
+        )
+
+    def test_scopes(self):
+        branch = branch_scope(self.user)
+        self.assertEqual(branch.department_ids, {self.root.pk, self.service.pk})
+        self.assertEqual(branch.pipe_ids, {self.pipe.pk})
+        self.assertEqual(branch.equipment_ids, {self.equipment.pk})
+        self.assertEqual(branch.node_ids, {self.node.pk})
+        # EMPLOYEE видит своё подразделение с потомками, участок корня ему не виден
+        subtree = role_scope(self.user)
+        self.assertEqual(subtree.department_ids, {self.service.pk})
+        self.assertEqual(subtree.pipe_ids, set())
+        with self.assertNumQueries(0):
+            self.assertIs(branch_scope(self.user), branch)
+
+        self.user.role = Role.MANAGER
+        self.assertEqual(role_scope(self.user), branch)
+        self.user.role = Role.ADMIN
+        self.assertIsNone(role_scope(self.user))
+        self.user.department = None
+        self.assertEqual(branch_scope(self.user), EMPTY_SCOPE)
+
+    def test_invalidated_on_changes(self):
+        self.assertEqual(branch_scope(self.user).pipe_ids, {self.pipe.pk})
+        self.equipment.departments.remove(self.service)
+        self.assertEqual(branch_scope(self.user).equipment_ids, set())
+        PipeDepartment.objects.filter(pipe=self.pipe).delete()
+        self.assertEqual(branch_scope(self.user).pipe_ids, set())
+        self.service.refresh_from_db()
+        self.other.refresh_from_db()
+        self.service.move_to(self.other)
+        self.assertEqual(branch_scope(self.user).department_ids, {self.other.pk, self.service.pk})
+
+    def test_changes_from_other_process(self):
+        self.assertEqual(branch_scope(self.user).pipe_ids, {self.pipe.pk})
+        # загрузка в другом процессе: строки без сигналов и новая версия в БД
+        other_pipe = Pipe.objects.create(pipeline=self.pipe.pipeline, start_point=10, end_point=20)
+        PipeDepartment.objects.bulk_create([PipeDepartment(pipe=other_pipe, department=self.root)])
+        CacheVersion.objects.update_or_create(key=VERSION_KEY, defaults={'token': 'other'})
+        versions.reset()
+        self.assertEqual(branch_scope(self.user).pipe_ids, {self.pipe.pk, other_pipe.pk})
+
+    def test_version_written_on_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.equipment.departments.remove(self.service)
+        self.assertFalse(CacheVersion.objects.filter(key=VERSION_KEY).exists())
+        for callback in callbacks:
+            callback()
+        self.assertTrue(CacheVersion.objects.filter(key=VERSION_KEY).exists())